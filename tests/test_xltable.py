@@ -1,10 +1,23 @@
 import unittest
+import tempfile
+import sqlite3
+import shutil
+import zipfile
+import gzip
+import csv
+import os
+import openpyxl
 import pandas as pa
 from xltable import *
 
 
 class XLTableTest(unittest.TestCase):
 
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.filename = os.path.join(self.tempdir, "test.xlsx")
+
     def test_simple_table(self):
         """test writing a couple of dataframes to a worksheet"""
         worksheet = Worksheet()
@@ -96,3 +109,878 @@ class XLTableTest(unittest.TestCase):
 
         self.assertEqual(data[0].tolist(), ["SP"])
         self.assertEqual(data[1].tolist(), ["=SUMPRODUCT('Sheet1'!$A$2:$A$4,'Sheet1'!$B$2:$B$4)"])
+
+    def test_formula_columns(self):
+        """test formula columns and repeated expressions resolve the same as per-cell expressions"""
+        workbook = Workbook()
+
+        df = pa.DataFrame({
+            "col_1": [1, 2, 3],
+            "col_2": [4, 5, 6],
+            "col_3": Cell("col_1") + Cell("col_2", row_offset=-1),
+        }, columns=["col_1", "col_2", "col_3"])
+        df.loc[1, "col_3"] = Formula("SUM", Column("col_1"))
+
+        table = Table("table", df, formula_columns={"col_4": Cell("col_1") * Cell("col_1", row=2)})
+        sheet = Worksheet("Sheet1")
+        sheet.add_table(table, row=1, col=1)
+        workbook.add_sheet(sheet)
+
+        self.assertEqual(table.width, 4)
+        self.assertEqual(table.get_column_offset("col_4"), 3)
+
+        data = table.get_data(workbook, 1, 1)
+        self.assertEqual(data[0].tolist(), ["col_1", "col_2", "col_3", "col_4"])
+        self.assertEqual(data[1].tolist(), [1, 4, "='Sheet1'!B3+'Sheet1'!C2", "='Sheet1'!B3*'Sheet1'!$B$5"])
+        self.assertEqual(data[2].tolist(), [2, 5, "=SUM('Sheet1'!$B$3:$B$5)", "='Sheet1'!B4*'Sheet1'!$B$5"])
+        self.assertEqual(data[3].tolist(), [3, 6, "='Sheet1'!B5+'Sheet1'!C4", "='Sheet1'!B5*'Sheet1'!$B$5"])
+
+    def test_fast_path_columns(self):
+        """test only object columns are scanned, and the source dataframe isn't modified"""
+        workbook = Workbook()
+
+        df = pa.DataFrame({
+            "A": [1.0, 2.0, 3.0],
+            "B": pa.date_range("2020-01-01", periods=3),
+            "C": [Value(1, style="pct"), "x", Cell("A")],
+        }, columns=["A", "B", "C"])
+
+        table = Table("table", df)
+        sheet = Worksheet("Sheet1")
+        sheet.add_table(table)
+        workbook.add_sheet(sheet)
+
+        data = table.get_data(workbook, 0, 0)
+        self.assertEqual(table.fast_path_columns, 2)
+        self.assertEqual(data[1:, 2].tolist(), [1, "x", "='Sheet1'!A4"])
+        self.assertIsInstance(df["C"][0], Value)
+        self.assertIsInstance(df["C"][2], Cell)
+
+    def test_multiindex_headers(self):
+        """test column headers and index with a MultiIndex on both axes"""
+        index = pa.MultiIndex.from_tuples([("a", 1), ("a", 2), ("b", 1)], names=["k1", None])
+        columns = pa.MultiIndex.from_tuples([("X", "p"), ("X", "q")], names=["L1", "L2"])
+        df = pa.DataFrame([[1, 2.5], [3, 4.5], [5, 6.5]], index=index, columns=columns)
+
+        table = Table("table", df, include_index=True)
+        self.assertEqual((table.height, table.width), (5, 4))
+
+        data = table.get_data(None, 0, 0)
+        self.assertEqual(data.tolist(), [
+            [None, None, "X", "X"],
+            ["k1", "", "p", "q"],
+            ["a", 1, 1, 2.5],
+            ["a", 2, 3, 4.5],
+            ["b", 1, 5, 6.5],
+        ])
+
+    def test_low_memory_xlsx(self):
+        """test writing in low memory mode, recording the memory used by each phase if asked"""
+        workbook = Workbook(self.filename)
+        for name in ("Sheet1", "Sheet2"):
+            df = pa.DataFrame({"A": [1, 2, 3], "B": Cell("A") * 2}, columns=["A", "B"])
+            sheet = Worksheet(name)
+            sheet.add_table(Table("table", df))
+            workbook.add_sheet(sheet)
+
+        workbook.to_xlsx(low_memory=True)
+        self.assertEqual(workbook.memory_stats, [])
+
+        workbook.to_xlsx(low_memory=True, memory_stats=True)
+
+        phases = [(sheet, phase) for sheet, phase, peak in workbook.memory_stats]
+        self.assertEqual(phases, [
+            ("Sheet1", "styles"),
+            ("Sheet1", "cells"),
+            ("Sheet2", "styles"),
+            ("Sheet2", "cells"),
+            (None, "close"),
+        ])
+        self.assertTrue(all(peak > 0 for sheet, phase, peak in workbook.memory_stats))
+
+    def test_cell_styles(self):
+        """test styled Values are found in the dataframe and the index is updated when invalidated"""
+        df = pa.DataFrame({
+            "A": [1.0, 2.0, 3.0],
+            "B": [Value(1, style="pct"), 2, Value(3)],
+        }, index=["x", "y", "z"], columns=["A", "B"])
+
+        table = Table("table", df, include_index=True)
+        self.assertTrue(table.has_cell_styles)
+        self.assertEqual(table.get_cell_style_offsets(), [(1, 2, Table._named_styles["pct"])])
+        self.assertEqual(table.cell_styles, {("x", "B"): Table._named_styles["pct"]})
+
+        table.dataframe = df.assign(B=[1, 2, 3])
+        self.assertFalse(table.has_cell_styles)
+        self.assertEqual(table.cell_styles, {})
+
+    def test_offsets(self):
+        """test row and column offsets for unique, non-unique and MultiIndex labels"""
+        index = pa.MultiIndex.from_tuples([("a", 1), ("a", 2), ("b", 1)])
+        df = pa.DataFrame([[1, 2, 3]] * 3, index=index, columns=["x", "y", "x"])
+        table = Table("table", df, include_index=True)
+
+        self.assertEqual(table.get_column_offset("y"), 3)
+        self.assertEqual(table.get_column_offset("x"), [2, 4])
+        self.assertEqual(table.get_row_offset(("a", 2)), 2)
+        self.assertEqual(table.get_row_offset("a"), range(1, 3))
+        self.assertEqual(table.get_row_offsets([("b", 1), ("a", 1)]), [3, 1])
+        self.assertEqual(table.get_column_offsets(["y", "x"]), [3, [2, 4]])
+        self.assertRaises(KeyError, table.get_column_offset, "z")
+        self.assertRaises(KeyError, table.get_row_offsets, [("a", 1), ("c", 1)])
+
+        workbook = Workbook()
+        sheet = Worksheet("Sheet1")
+        sheet.add_table(table)
+        workbook.add_sheet(sheet)
+        workbook.active_table = table
+        self.assertEqual(Range("x", "x", "a", "a").get_formula(workbook, 0, 0), "='Sheet1'!$C$2:$E$3")
+        self.assertRaises(KeyError, Cell("x").get_formula, workbook, 1, 0)
+
+        df = pa.DataFrame({"y": range(100)}, index=["r%d" % i for i in range(100)])
+        table = Table("table", df)
+        self.assertEqual(table.get_row_offsets(["r0", "r99"]), [1, 100])
+        table.dataframe = df.iloc[::-1]
+        self.assertEqual(table.get_row_offset("r0"), 100)
+
+    def test_iterrows_side_by_side(self):
+        """test rows are merged from tables starting on different rows and columns"""
+        worksheet = Worksheet()
+
+        df = pa.DataFrame({"A": [1, 2, 3]})
+        worksheet.add_table(Table("table_1", df), row=0, col=0)
+        worksheet.add_table(Table("table_2", df.rename(columns={"A": "B"})), row=2, col=2)
+        worksheet.add_table(Table("table_3", df.rename(columns={"A": "C"})), row=1, col=1)
+        worksheet.add_value("x", 6, 0)
+
+        rows = list(worksheet.iterrows())
+        self.assertEqual(rows, [
+            ["A", None, None],
+            [1, "C", None],
+            [2, 1, "B"],
+            [3, 2, 1],
+            [None, 3, 2],
+            [None, None, 3],
+            ["x", None, None],
+        ])
+
+    def test_overlapping_tables(self):
+        """test overlapping tables are reported and array formula cells are found"""
+        worksheet = Worksheet()
+        df = pa.DataFrame({"A": [1, 2, 3]})
+        worksheet.add_table(Table("table_1", df))
+        worksheet.add_table(ArrayFormula("array", Formula("TRANSPOSE", Column("A", table="table_1")), 3, 1),
+                            row=0, col=2)
+
+        with self.assertLogs("xltable.worksheet", level="WARNING") as logs:
+            worksheet.add_table(Table("table_2", df), row=3, col=0)
+            worksheet.add_value(1, 0, 3)
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn("'table_2' overlaps table 'table_1'", logs.output[0])
+        self.assertIn("overlaps table 'array'", logs.output[1])
+
+        self.assertTrue(worksheet._is_in_array_formula_table(0, 4))
+        self.assertFalse(worksheet._is_in_array_formula_table(0, 5))
+        self.assertFalse(worksheet._is_in_array_formula_table(1, 2))
+
+    def test_style_layers(self):
+        """test stripes, column and cell styles are combined and rows with the same styles are shared"""
+        worksheet = Worksheet()
+        df = pa.DataFrame({
+            "A": [1.0, 2.0, 3.0, 4.0],
+            "B": [1, Value(2, style=CellStyle(bold=True)), 3, 4],
+        }, columns=["A", "B"])
+        table = Table("table",
+                      df,
+                      style=TableStyle(stripe_colors=(0x111111, 0x222222)),
+                      column_styles={"A": "2dp"})
+        worksheet.add_table(table)
+
+        styles = worksheet._get_all_styles()
+        self.assertEqual(len(styles), 10)
+        self.assertTrue(styles[(0, 0)].bold)
+        self.assertEqual(styles[(1, 0)].bg_color, 0x111111)
+        self.assertEqual(styles[(1, 0)].excel_number_format, "0.00")
+        self.assertEqual(styles[(2, 1)].bg_color, 0x222222)
+        self.assertTrue(styles[(2, 1)].bold)
+        self.assertEqual(styles[(4, 1)].bg_color, 0x222222)
+        self.assertFalse(styles[(4, 1)].bold)
+
+        layers = worksheet._get_style_layers()
+        self.assertIs(layers.get_row(1), layers.get_row(3))
+        self.assertIsNot(layers.get_row(2), layers.get_row(4))
+
+    def test_cell_style_interned(self):
+        """test equal styles are the same instance, are immutable and compose to shared styles"""
+        style = CellStyle(bold=True, size="large", border={"top": 1})
+        self.assertIs(style, CellStyle(bold=True, size=16, border={"top": 1}))
+        self.assertEqual(hash(style), hash(CellStyle(bold=True, size=16, border={"top": 1})))
+        self.assertNotEqual(style, CellStyle(bold=False))
+        self.assertRaises(AttributeError, setattr, style, "bold", False)
+
+        pct = CellStyle(is_percentage=True, decimal_places=2)
+        self.assertEqual(pct.excel_number_format, "0.00%")
+        self.assertEqual(CellStyle(date_format="%Y-%m-%d").excel_number_format, "yyyy-mm-dd")
+        self.assertIsNone(CellStyle().excel_number_format)
+
+        combined = style + pct
+        self.assertIs(combined, style + pct)
+        self.assertIs(combined, CellStyle(bold=True, size=16, border={"top": 1},
+                                          is_percentage=True, decimal_places=2))
+        self.assertEqual(combined.format_key[:2], (True, "0.00%"))
+
+    def test_constant_memory_xlsx(self):
+        """test writing with xlsxwriter's constant_memory option gives the same cells and groups"""
+        def build():
+            df = pa.DataFrame({"A": [1, 2, 3], "B": Cell("A") * 2}, columns=["A", "B"])
+            table_1 = Table("table_1", df)
+            table_2 = Table("table_2", pa.DataFrame({"C": [1.5, 2.5]}))
+            array = ArrayFormula("array", Formula("TRANSPOSE", Column("A", table="table_1")), 3, 1)
+
+            sheet = Worksheet("Sheet1")
+            sheet.add_table(table_1)
+            sheet.add_table(array, row=1, col=3)
+            sheet.add_table(table_2)
+            sheet.add_row_group([table_2])
+
+            workbook = Workbook(self.filename)
+            workbook.add_sheet(sheet)
+            return workbook
+
+        def read():
+            ws = openpyxl.load_workbook(self.filename)["Sheet1"]
+            cells = {}
+            for row in ws.iter_rows():
+                for cell in row:
+                    if cell.value is not None:
+                        value = cell.value
+                        cells[cell.coordinate] = getattr(value, "text", value)
+            levels = {i: d.outline_level for i, d in ws.row_dimensions.items() if d.outline_level}
+            return cells, levels
+
+        build().to_xlsx()
+        expected = read()
+
+        build().to_xlsx(constant_memory=True)
+        cells, levels = read()
+
+        self.assertEqual(cells, expected[0])
+        self.assertEqual(levels, expected[1])
+        self.assertEqual(cells["D2"], "=TRANSPOSE('Sheet1'!$A$2:$A$4)")
+        self.assertEqual(cells["B4"], "='Sheet1'!A4*2")
+        self.assertEqual(sorted(levels), [6, 7, 8, 9])
+
+    def test_nan_policy_xlsx(self):
+        """test columns are written by type and NaN values follow the workbook's nan policy"""
+        from xltable.worksheet import _XlsxTableWriter
+
+        df = pa.DataFrame({"A": [1.5, float("nan"), 3.0],
+                           "B": pa.to_datetime(["2020-01-01", None, "2020-01-03"]),
+                           "C": ["x", "y", "z"],
+                           "D": Cell("A") * 2,
+                           "E": [1, "y", None]},
+                          columns=["A", "B", "C", "D", "E"])
+
+        def read():
+            ws = openpyxl.load_workbook(self.filename)["Sheet1"]
+            return [[cell.value for cell in row] for row in ws.iter_rows(min_row=2)]
+
+        results = {}
+        for policy in ("blank", "#N/A", "zero"):
+            sheet = Worksheet("Sheet1")
+            sheet.add_table(Table("table", df))
+            workbook = Workbook(self.filename)
+            workbook.add_sheet(sheet)
+            workbook.set_nan_policy(policy)
+            workbook.to_xlsx()
+            results[policy] = read()
+
+        self.assertEqual(results["blank"][0][0], 1.5)
+        self.assertEqual(results["blank"][0][1], 43831)
+        self.assertEqual(results["blank"][0][2:], ["x", "='Sheet1'!A2*2", 1])
+        self.assertEqual(results["blank"][1][:2], [None, None])
+        self.assertEqual(results["#N/A"][1][:2], ["=NA()", "=NA()"])
+        self.assertEqual(results["zero"][1][:2], [0, 0])
+        self.assertEqual(results["blank"][2][0], 3)
+        self.assertRaises(AssertionError, Workbook().set_nan_policy, "nan")
+
+        sheet = Worksheet("Sheet1")
+        table = Table("table", df)
+        sheet.add_table(table)
+        workbook = Workbook()
+        workbook.add_sheet(sheet)
+        xl_workbook = workbook.to_xlsx()
+        ws = xl_workbook.get_worksheet_by_name("Sheet1")
+        writer = _XlsxTableWriter(sheet, ws, table, 0, 0, table.get_data(workbook, 0, 0), {}, "blank")
+        self.assertEqual(writer.kinds, ["number", "datetime", "string", "formula", "object"])
+
+    def test_threaded_xlsx(self):
+        """test preparing sheets in a thread pool writes the same cells as writing them serially"""
+        def build():
+            workbook = Workbook(self.filename)
+            for i in range(8):
+                df = pa.DataFrame({"A": list(range(50)), "B": Cell("A") * 2}, columns=["A", "B"])
+                if i:
+                    df["C"] = Column("A", table="'Sheet0'!table_0")
+                sheet = Worksheet("Sheet%d" % i)
+                sheet.add_table(Table("table_%d" % i, df))
+                sheet.add_value(Cell("A", table="table_%d" % i, row_offset=2), 60, 0)
+                workbook.add_sheet(sheet)
+            return workbook
+
+        def read():
+            wb = openpyxl.load_workbook(self.filename)
+            return {ws.title: [[c.value for c in row] for row in ws.iter_rows()] for ws in wb}
+
+        build().to_xlsx()
+        expected = read()
+
+        build().to_xlsx(threads=4)
+        cells = read()
+
+        self.assertEqual(cells, expected)
+        self.assertEqual(cells["Sheet3"][1], [0, "='Sheet3'!A2*2", "='Sheet0'!$A$2:$A$51"])
+
+    def test_native_xlsx(self):
+        """test the native xlsx engine writes the same cells, styles, widths and groups as xlsxwriter"""
+        def build():
+            df = pa.DataFrame({"A": [1.5, float("nan"), 3.0, 4.0],
+                               "B": pa.to_datetime(["2020-01-01 12:00", None, "2020-01-03 00:00", "2020-01-04 00:00"]),
+                               "C": ["x", "y & <z>", " z", "w"],
+                               "D": [True, False, True, False],
+                               "E": [1, "y", None, 2.5],
+                               "F": Cell("A") * 2},
+                              columns=["A", "B", "C", "D", "E", "F"])
+            table_1 = Table("table_1", df,
+                            column_styles={"A": CellStyle(bold=True, decimal_places=2, border=1)},
+                            column_widths={"C": 20})
+            table_2 = Table("table_2", pa.DataFrame({"X": [1.0, 2.0, 3.0], "Y": [4, 5, 6]}), include_index=True)
+
+            sheet = Worksheet("Sheet1")
+            sheet.add_table(table_1)
+            sheet.add_table(table_2)
+            sheet.add_value(Cell("X", table="table_2", row_offset=1), 10, 0)
+            sheet.add_row_group([table_2])
+
+            workbook = Workbook(self.filename)
+            workbook.add_sheet(sheet)
+            workbook.set_nan_policy("#N/A")
+            return workbook
+
+        def read():
+            ws = openpyxl.load_workbook(self.filename)["Sheet1"]
+            cells = {}
+            for row in ws.iter_rows():
+                for cell in row:
+                    if cell.value is not None:
+                        cells[cell.coordinate] = (cell.value,
+                                                  cell.number_format,
+                                                  cell.font.b,
+                                                  cell.fill.fgColor.rgb if cell.fill.fill_type else None,
+                                                  cell.border.left.style)
+            widths = {k: d.width for k, d in ws.column_dimensions.items() if d.customWidth}
+            levels = {i: (d.outline_level, d.hidden) for i, d in ws.row_dimensions.items() if d.outline_level}
+            return cells, widths, levels
+
+        build().to_xlsx()
+        expected = read()
+
+        build().to_xlsx(engine="native")
+        cells, widths, levels = read()
+
+        self.assertEqual(cells, expected[0])
+        self.assertEqual(widths, expected[1])
+        self.assertEqual(levels, expected[2])
+        self.assertEqual(cells["A3"][0], "=NA()")
+        self.assertEqual(cells["A2"][1:3], ("0.00", True))
+        self.assertEqual(cells["F2"][0], "='Sheet1'!A2*2")
+        self.assertEqual(sorted(levels), [7, 8, 9, 10, 11])
+
+    def test_csv(self):
+        """test writing a workbook to csv files, with formulas or their values"""
+        df = pa.DataFrame({"A": [1.5, 2.0, 3.0],
+                           "B": ["x", "y", "z"],
+                           "C": Cell("A") * 2,
+                           "D": [Formula("SUM", Cell("A"), value=5), "=A1", 1]},
+                          columns=["A", "B", "C", "D"])
+        sheet_1 = Worksheet("Sheet1")
+        sheet_1.add_table(Table("table_1", df))
+        sheet_1.add_value(Formula("SUM", Column("A", table="table_1"), value=6.5), 5, 1)
+
+        sheet_2 = Worksheet("Sheet2")
+        sheet_2.add_table(Table("table_2", pa.DataFrame({"X": [Cell("A", table="Sheet1!table_1")]})))
+
+        sheet_3 = Worksheet("Sheet3")
+        sheet_3.add_table(Table("table_3", pa.DataFrame({"N": [1.0, float("nan")],
+                                                         "T": [pa.Timestamp("2020-01-01"), pa.NaT],
+                                                         "O": ["a", float("nan")]},
+                                                        columns=["N", "T", "O"])))
+
+        workbook = Workbook(worksheets=[sheet_1, sheet_2, sheet_3])
+
+        filenames = workbook.to_csv(self.tempdir)
+        with open(filenames[0], newline="") as fh:
+            rows = list(csv.reader(fh))
+        with open(filenames[1], newline="") as fh:
+            rows_2 = list(csv.reader(fh))
+        with open(filenames[2], newline="") as fh:
+            rows_3 = list(csv.reader(fh))
+
+        filenames = workbook.to_csv(self.tempdir, values=True, compression="gzip", threads=2)
+        self.assertEqual([os.path.basename(x) for x in filenames],
+                         ["Sheet1.csv.gz", "Sheet2.csv.gz", "Sheet3.csv.gz"])
+        with gzip.open(filenames[0], "rt", newline="") as fh:
+            values = list(csv.reader(fh))
+        with gzip.open(filenames[2], "rt", newline="") as fh:
+            values_3 = list(csv.reader(fh))
+
+        # the csv matches iterating over the rows
+        expected = [["" if x is None else str(x) for x in row] for row in workbook.worksheets[0].iterrows(workbook)]
+        self.assertEqual(rows, expected)
+        self.assertEqual(rows[1], ["1.5", "x", "='Sheet1'!A2*2", "=SUM('Sheet1'!A2)"])
+        self.assertEqual(rows[5], ["", "=SUM('Sheet1'!$A$2:$A$4)", "", ""])
+        self.assertEqual(rows_2[1], ["='Sheet1'!A2"])
+
+        # formulas are replaced by their values, or blanks
+        self.assertEqual(values[1], ["1.5", "x", "", "5"])
+        self.assertEqual(values[2], ["2.0", "y", "", ""])
+        self.assertEqual(values[3], ["3.0", "z", "", "1"])
+        self.assertEqual(values[5], ["", "6.5", "", ""])
+
+        # NaN and NaT are written as empty fields
+        self.assertEqual(rows_3[1:], [["1.0", "2020-01-01 00:00:00", "a"], ["", "", ""]])
+        self.assertEqual(values_3, rows_3)
+
+    def test_evaluate_formulas(self):
+        """test formula values are calculated from the dataframes and written to the xlsx file"""
+        df = pa.DataFrame({"a": [1.0, 2.0, float("nan"), 4.0],
+                           "b": [10, 20, 30, 40],
+                           "s": ["x", "y", "z", "w"]},
+                          columns=["a", "b", "s"])
+        table = Table("table_1", df, formula_columns={
+            "c": Cell("a") + Cell("b"),
+            "d": Formula("SUM", Column("b")),
+            "e": Formula("IF", Cell("b") > 15, Cell("s") & "!", "no"),
+            "f": Formula("ROUND", Cell("a") / 3, 2),
+            "g": Formula("SUMPRODUCT", Column("a"), Column("b")),
+            "h": Formula("VLOOKUP", Cell("a"), Range("a", "b"), 2),
+            "i": Cell("b") / (Cell("b") - 20),
+            "j": Cell("b", row_offset=-1) + 1,
+            "k": Formula("SUM", Column("i")),
+        })
+        sheet = Worksheet("Sheet1")
+        sheet.add_table(table)
+        sheet.add_value(Formula("MAX", Column("c", table="table_1")), 6, 0)
+
+        workbook = Workbook(self.filename, [sheet])
+        workbook.set_evaluate_formulas()
+        workbook.set_calc_mode("auto", calc_on_load=False)
+        workbook.to_xlsx()
+        ws = openpyxl.load_workbook(self.filename, data_only=True)["Sheet1"]
+        rows = [[cell.value for cell in row] for row in ws.iter_rows(min_row=2, max_row=5)]
+        max_c = ws["A7"].value
+
+        # NaN is written as a blank, which is 0 in arithmetic and ignored by SUMPRODUCT
+        # and errors are written as Excel's error values
+        self.assertEqual([row[3] for row in rows], [11, 22, 30, 44])
+        self.assertEqual([row[4] for row in rows], [100] * 4)
+        self.assertEqual([row[5] for row in rows], ["no", "y!", "z!", "w!"])
+        self.assertEqual([row[6] for row in rows], [0.33, 0.67, 0, 1.33])
+        self.assertEqual([row[7] for row in rows], [210] * 4)
+        self.assertEqual([row[8] for row in rows], [0] * 4)
+        self.assertEqual([row[9] for row in rows], [-1, "#DIV/0!", 3, 2])
+        self.assertEqual([row[10] for row in rows], ["#VALUE!", 11, 21, 31])
+        self.assertEqual([row[11] for row in rows], ["#DIV/0!"] * 4)
+        self.assertEqual(max_c, 44)
+
+    def test_table_registry(self):
+        """test tables are looked up by name, including tables added after the sheet"""
+        sheet_1 = Worksheet("Sheet1")
+        sheet_1.add_table(Table("table_1", pa.DataFrame({"A": [1, 2]})))
+        workbook = Workbook(worksheets=[sheet_1])
+
+        sheet_2 = Worksheet("Sheet2")
+        workbook.add_sheet(sheet_2)
+        table_2 = Table("table_2", pa.DataFrame({"B": [3]}))
+        sheet_2.add_table(table_2)
+
+        self.assertEqual(workbook.get_table("table_2"), (table_2, sheet_2))
+        self.assertEqual(workbook.get_table("'Sheet2'!table_2"), (table_2, sheet_2))
+        self.assertRaises(KeyError, workbook.get_table, "Sheet1!table_2")
+        self.assertRaises(KeyError, workbook.get_table, "table_3")
+
+        # the same bare name on another sheet is reported when it's added
+        with self.assertLogs("xltable.workbook", level="WARNING"):
+            sheet_1.add_table(Table("table_2", pa.DataFrame({"C": [4]})))
+        self.assertIs(workbook.get_table("Sheet1!table_2")[1], sheet_1)
+        self.assertIs(workbook.get_table("table_2")[1], sheet_1)
+
+        # sheets appended to the list directly are found too
+        sheet_3 = Worksheet("Sheet3")
+        table_3 = Table("table_3", pa.DataFrame({"D": [5]}))
+        sheet_3.add_table(table_3)
+        workbook.worksheets.append(sheet_3)
+        self.assertEqual(workbook.get_table("table_3"), (table_3, sheet_3))
+
+        # and resolved expressions use the registry
+        sheet_3.add_value(Cell("A", table="Sheet1!table_1", row=1), 5, 0)
+        for sheet in workbook.itersheets():
+            rows = list(sheet.iterrows(workbook))
+        self.assertEqual(rows[5][0], "='Sheet1'!$A$3")
+
+    def test_table_registry_replaced_sheet(self):
+        """test the registry is rebuilt when a sheet is replaced in the list directly"""
+        sheets = []
+        for name in ("A", "B"):
+            sheet = Worksheet(name)
+            sheet.add_table(Table("t_" + name, pa.DataFrame({"x": [1, 2]})))
+            sheets.append(sheet)
+        workbook = Workbook(worksheets=sheets)
+        self.assertIs(workbook.get_table("B!t_B")[1], sheets[1])
+
+        sheet_c = Worksheet("C")
+        table_c = Table("t_C", pa.DataFrame({"x": [3]}))
+        sheet_c.add_table(table_c)
+        workbook.worksheets[1] = sheet_c
+        self.assertEqual(workbook.get_table("C!t_C"), (table_c, sheet_c))
+        self.assertRaises(KeyError, workbook.get_table, "B!t_B")
+
+        # removing a sheet and appending another keeps the same number of sheets
+        workbook.worksheets.remove(sheet_c)
+        workbook.worksheets.append(sheets[1])
+        sheets[1].add_value(Cell("x", table="A!t_A", row=1), 4, 0)
+        self.assertEqual(workbook.validate(), [])
+        self.assertRaises(KeyError, workbook.get_table, "C!t_C")
+        workbook.to_xlsx()
+
+        # and so is assigning a new list of sheets
+        workbook.worksheets = [sheet_c]
+        self.assertEqual(workbook.get_table("C!t_C"), (table_c, sheet_c))
+        self.assertRaises(KeyError, workbook.get_table, "A!t_A")
+
+    def test_formula_parentheses(self):
+        """test formulas only include the parentheses needed, and sheet names and strings are quoted"""
+        df = pa.DataFrame({"a": [1], "b": [2], "c": [3]}, columns=["a", "b", "c"])
+        table = Table("table_1", df)
+        sheet = Worksheet("Bob's")
+        sheet.add_table(table, col=701)
+        workbook = Workbook(worksheets=[sheet])
+        workbook.active_table = table
+        workbook.active_worksheet = sheet
+
+        a, b, c = Cell("a"), Cell("b"), Cell("c")
+        self.assertEqual((a + b).get_formula(workbook, 1, 0), "='Bob''s'!ZZ2+'Bob''s'!AAA2")
+        self.assertEqual(((a + b) * c).get_formula(workbook, 1, 0),
+                         "=('Bob''s'!ZZ2+'Bob''s'!AAA2)*'Bob''s'!AAB2")
+        self.assertEqual((a + b * c).get_formula(workbook, 1, 0),
+                         "='Bob''s'!ZZ2+'Bob''s'!AAA2*'Bob''s'!AAB2")
+        self.assertEqual((a - (b - c)).get_formula(workbook, 1, 0),
+                         "='Bob''s'!ZZ2-('Bob''s'!AAA2-'Bob''s'!AAB2)")
+        self.assertEqual(((a - b) - c).get_formula(workbook, 1, 0),
+                         "='Bob''s'!ZZ2-'Bob''s'!AAA2-'Bob''s'!AAB2")
+        self.assertEqual(Formula("IF", a > b, (a + b) & 'say "hi"', None).get_formula(workbook, 1, 0),
+                         "=IF('Bob''s'!ZZ2>'Bob''s'!AAA2,'Bob''s'!ZZ2+'Bob''s'!AAA2&\"say \"\"hi\"\"\",)")
+
+    def test_expression_keys(self):
+        """test equal expressions have equal keys and are resolved once per table"""
+        self.assertEqual((Cell("a") + 1).key, (Cell("a") + 1).key)
+        self.assertNotEqual((Cell("a") + 1).key, (Cell("a") + True).key)
+        self.assertNotEqual(Cell("a").key, Cell("a", table="t").key)
+        self.assertEqual(Formula("SUM", Column("a"), 1).key, Formula("SUM", Column("a"), 1).key)
+
+        expr = Formula("SUM", Column("a", table="Sheet1!table_1"))
+        self.assertIs(Formula("SUM", Column("a", table="Sheet1!table_1")).intern(), expr.intern())
+
+        # the same expressions in two tables resolve to different cells, and each cell
+        # can be a separate instance of an equal expression
+        df_1 = pa.DataFrame({"a": [1, 2]})
+        df_1["b"] = [Cell("a") * 2 for _ in range(2)]
+        df_2 = pa.DataFrame({"x": [0], "a": [3]}, columns=["x", "a"])
+        df_2["b"] = [Cell("a") * 2]
+        df_2["c"] = [Formula("SUM", Column("a", table="Sheet1!table_1"))]
+        sheet = Worksheet("Sheet1")
+        sheet.add_table(Table("table_1", df_1))
+        sheet.add_table(Table("table_2", df_2))
+        workbook = Workbook(worksheets=[sheet])
+
+        filenames = workbook.to_csv(self.tempdir)
+        with open(filenames[0]) as fh:
+            rows = [line.rstrip("\n").split(",") for line in fh]
+
+        self.assertIsNone(workbook.formula_cache)
+        self.assertEqual(rows[1][1], "='Sheet1'!A2*2")
+        self.assertEqual(rows[2][1], "='Sheet1'!A3*2")
+        self.assertEqual(rows[5][2:], ["='Sheet1'!B6*2", "=SUM('Sheet1'!$A$2:$A$3)"])
+
+    def test_expression_subclass_keys(self):
+        """test subclasses of expressions don't share keys or resolved formulas with their base classes"""
+        class Neg(Cell):
+            def resolve(self, workbook, row, col):
+                return "-" + super(Neg, self).resolve(workbook, row, col)
+
+        self.assertNotEqual(Neg("a").key, Cell("a").key)
+
+        df = pa.DataFrame({"a": [1, 2], "b": [Cell("a"), Neg("a")], "c": [Neg("a"), Neg("a")]},
+                          columns=["a", "b", "c"])
+        sheet = Worksheet("S")
+        sheet.add_table(Table("t", df))
+        workbook = Workbook(worksheets=[sheet])
+
+        expected = [["a", "b", "c"], ["1", "='S'!A2", "=-'S'!A2"], ["2", "=-'S'!A3", "=-'S'!A3"]]
+        rows = [[str(x) for x in row] for row in sheet.iterrows(workbook)]
+        self.assertEqual(rows, expected)
+
+        filenames = workbook.to_csv(self.tempdir)
+        with open(filenames[0], newline="") as fh:
+            self.assertEqual(list(csv.reader(fh)), expected)
+
+    def test_shared_formulas(self):
+        """test formulas filled down a column are written as shared formulas by the native engine"""
+        df = pa.DataFrame({"a": [1, 2, 3, 4], "b": [5, 6, 7, 8]}, columns=["a", "b"])
+        df["c"] = [Cell("a") * 2] * 3 + [Cell("b") * 2]
+        table = Table("table_1", df, formula_columns={
+            "d": Cell("a") + Cell("b", row=0),
+            "e": Cell("a", row=0, row_fixed=False) + Cell("a"),
+        })
+        sheet = Worksheet("Sheet1")
+        sheet.add_table(table)
+
+        workbook = Workbook(self.filename, [sheet])
+        workbook.to_xlsx(engine="native")
+        expected = [[cell.value for cell in row] for row in openpyxl.load_workbook(self.filename)["Sheet1"].iter_rows()]
+
+        workbook.to_xlsx(engine="native", shared_formulas=True)
+        with zipfile.ZipFile(self.filename) as zf:
+            xml = zf.read("xl/worksheets/sheet1.xml").decode("utf-8")
+        rows = [[cell.value for cell in row] for row in openpyxl.load_workbook(self.filename)["Sheet1"].iter_rows()]
+
+        # openpyxl fills shared formulas in to each cell when reading them
+        self.assertEqual(rows, expected)
+        self.assertIn('<c r="C2" s="2"><f t="shared" ref="C2:C4" si="0">\'Sheet1\'!A2*2</f>', xml)
+        self.assertIn('<c r="D2" s="2"><f t="shared" ref="D2:D5" si="1">', xml)
+        self.assertIn('<c r="D5" s="3"><f t="shared" si="1"/>', xml)
+        self.assertIn('<c r="C5" s="3"><f>', xml)
+
+        # the relative reference to a fixed row can't be shared
+        self.assertIn('<c r="E2" s="2"><f>', xml)
+        self.assertRaises(AssertionError, workbook.to_xlsx, shared_formulas=True)
+
+    def test_excel_tables(self):
+        """test tables are written as Excel tables with built-in or custom table styles"""
+        df = pa.DataFrame({"a": [1.0, 2.0], "b": ["x", "y"], 3: [4, 5]}, columns=["a", "b", 3])
+        tables = [
+            Table("table 1", df, include_index=True, style="excel", column_styles={"a": CellStyle(bold=True)}),
+            Table("table_1", df, style=TableStyle(excel_table_style="Table Style Light 9")),
+        ]
+        with self.assertLogs("xltable.table", level="WARNING"):
+            Table("table_2", df, include_columns=False, style="excel")
+
+        results = {}
+        for engine in ("xlsxwriter", "native"):
+            sheet = Worksheet("Sheet1")
+            for table in tables:
+                sheet.add_table(table)
+            Workbook(self.filename, [sheet]).to_xlsx(engine=engine)
+            ws = openpyxl.load_workbook(self.filename)["Sheet1"]
+            results[engine] = ws
+            with zipfile.ZipFile(self.filename) as zf:
+                styles_xml = zf.read("xl/styles.xml").decode("utf-8")
+
+        for engine, ws in results.items():
+            excel_tables = sorted(ws.tables.values(), key=lambda t: t.ref)
+            self.assertEqual([(t.name, t.ref) for t in excel_tables], [("table_1", "A1:D3"), ("table_1_2", "A5:C7")])
+            self.assertEqual([c.name for c in excel_tables[0].tableColumns], ["Column1", "a", "b", "3"])
+            self.assertEqual([c.value for c in ws[1]], ["Column1", "a", "b", "3"])
+            self.assertEqual(excel_tables[1].tableStyleInfo.name, "TableStyleLight9")
+            self.assertTrue(excel_tables[0].tableStyleInfo.showFirstColumn)
+
+            # column styles are still applied to the cells
+            self.assertTrue(ws["B2"].font.b)
+            self.assertFalse(ws["B6"].fill.fgColor.rgb.endswith("EAF1FA"))
+
+        # xlsxwriter can't write custom table styles, so the stripes are written on the cells
+        self.assertIsNone(results["xlsxwriter"].tables["table_1"].tableStyleInfo.name)
+        self.assertEqual(results["xlsxwriter"]["C2"].fill.fgColor.rgb, "FFEAF1FA")
+
+        # the native engine makes a table style with the stripes instead
+        self.assertEqual(results["native"].tables["table_1"].tableStyleInfo.name, "xltable1")
+        self.assertNotEqual(results["native"]["C2"].fill.fgColor.rgb, "FFEAF1FA")
+        self.assertFalse(results["native"]["A1"].font.b)
+        self.assertIn('<tableStyle name="xltable1" pivot="0" count="4">', styles_xml)
+        self.assertIn('<tableStyleElement type="firstRowStripe" dxfId="1"/>', styles_xml)
+
+        # xlsxwriter can't add tables in constant_memory mode, so they're styled cell by cell
+        sheet = Worksheet("Sheet1")
+        sheet.add_table(tables[1])
+        Workbook(self.filename, [sheet]).to_xlsx(constant_memory=True)
+        ws = openpyxl.load_workbook(self.filename)["Sheet1"]
+        self.assertEqual(dict(ws.tables), {})
+        self.assertTrue(ws["A1"].font.b)
+        self.assertEqual(ws["A2"].fill.fgColor.rgb, "FFEAF1FA")
+
+    def test_conditional_stripes(self):
+        """test stripes are written as conditional formats, leaving out cells with their own background"""
+        df = pa.DataFrame({"a": [1, 2, 3, 4],
+                           "b": [Value(1, CellStyle(bg_color=0xFF0000)), 2, 3, 4],
+                           "c": [1, 2, 3, 4]},
+                          columns=["a", "b", "c"])
+        table = Table("table_1", df, include_index=True, column_styles={"c": CellStyle(bg_color=0x00FF00)})
+
+        for engine in ("xlsxwriter", "native"):
+            sheet = Worksheet("Sheet1")
+            sheet.add_table(table, row=1)
+            workbook = Workbook(self.filename, [sheet])
+            workbook.set_stripe_mode("conditional")
+            workbook.to_xlsx(engine=engine)
+
+            ws = openpyxl.load_workbook(self.filename)["Sheet1"]
+            formats = [(str(cf.sqref), rule.formula, rule.dxf.fill.bgColor.rgb)
+                       for cf in ws.conditional_formatting for rule in cf.rules]
+            self.assertEqual(sorted(formats), [("A3:B6 C4:C6", ["MOD(ROW()-3,2)=0"], "FFEAF1FA"),
+                                               ("A3:B6 C4:C6", ["MOD(ROW()-3,2)=1"], "FFFFFFFF")])
+
+            # only cells with their own styles are formatted
+            self.assertEqual(ws["B3"].fill.fill_type, None)
+            self.assertEqual(ws["C3"].fill.fgColor.rgb, "FFFF0000")
+            self.assertEqual(ws["D4"].fill.fgColor.rgb, "FF00FF00")
+
+    def test_incremental(self):
+        """test only changed tables and the tables referring to them are resolved again"""
+        from unittest import mock
+
+        df_a = pa.DataFrame({"x": [1, 2, 3]})
+        df_b = pa.DataFrame({"y": [Cell("x", table="a"), Cell("x", table="a"), 0]})
+        df_c = pa.DataFrame({"z": [4, 5, 6]})
+        table_a = Table("a", df_a)
+        table_b = Table("b", df_b)
+        table_c = Table("c", df_c, formula_columns={"w": Cell("z") * 2})
+
+        sheet = Worksheet("Sheet1")
+        sheet.add_table(table_a)
+        sheet.add_table(table_b)
+        sheet.add_table(table_c)
+        other_sheet = Worksheet("Sheet2")
+        other_sheet.add_table(Table("d", pa.DataFrame({"v": [Formula("SUM", Column("y", table="Sheet1!b"))]})))
+        workbook = Workbook(worksheets=[sheet, other_sheet])
+        workbook.set_incremental()
+
+        def export():
+            with mock.patch.object(Table, "get_data", autospec=True, side_effect=Table.get_data) as get_data:
+                rows = {ws.name: list(ws.iterrows(workbook)) for ws in workbook.itersheets()}
+            return rows, sorted(call.args[0].name for call in get_data.call_args_list)
+
+        rows, resolved = export()
+        self.assertEqual(resolved, ["a", "b", "c", "d"])
+        self.assertEqual(rows["Sheet1"][6], ["='Sheet1'!A2", None])
+
+        rows_again, resolved = export()
+        self.assertEqual(resolved, [])
+        self.assertEqual(rows_again, rows)
+
+        # changing a table in place resolves it and the tables that refer to it
+        df_a.iloc[0, 0] = 10
+        rows, resolved = export()
+        self.assertEqual(resolved, ["a", "b", "d"])
+        self.assertEqual(rows["Sheet1"][1], [10, None])
+
+        workbook.invalidate(table_c)
+        self.assertEqual(export()[1], ["c"])
+
+        # adding to a sheet resolves the tables referring to tables on it
+        table_e = Table("e", pa.DataFrame({"u": [1]}))
+        sheet.add_table(table_e, row=20)
+        self.assertEqual(export()[1], ["b", "d", "e"])
+
+        workbook.invalidate()
+        self.assertEqual(export()[1], ["a", "b", "c", "d", "e"])
+
+    def test_validate(self):
+        """test all the bad references in a workbook are found without resolving any formulas"""
+        table_a = Table("a", pa.DataFrame({"x": [1, 2]}), formula_columns={"y": Cell("x", table="b")})
+        table_b = Table("b", pa.DataFrame({"x": [Cell("x", table="a"), Cell("bad", table="a")]},
+                                          index=["r1", "r2"]))
+        table_c = Table("c", pa.DataFrame({"z": [Cell("x", row="r3", table="b"),
+                                                 Index(table="a"),
+                                                 Cell("q", table="d"),
+                                                 Cell("q", table="Sheet2!d")]}))
+        sheet_1 = Worksheet("Sheet1")
+        sheet_1.add_table(table_a)
+        sheet_1.add_table(table_b)
+        sheet_1.add_table(table_c)
+        sheet_2 = Worksheet("Sheet2")
+        sheet_2.add_table(Table("d", pa.DataFrame({"q": [Cell("x", table="Sheet1!e")]})))
+        sheet_2.add_value(Cell("q"), 5, 0)
+        workbook = Workbook(worksheets=[sheet_1, sheet_2])
+
+        self.assertEqual(workbook.validate(), [
+            "Worksheet 'Sheet1', table 'b': Column 'bad' not found in table a",
+            "Worksheet 'Sheet1', table 'c': Row 'r3' not found in table b",
+            "Worksheet 'Sheet1', table 'c': Table 'a' has no index",
+            "Worksheet 'Sheet1', table 'c': Table 'd' is on worksheet 'Sheet2' and must be referred to as 'Sheet2!d'",
+            "Worksheet 'Sheet2', table 'd': Table 'Sheet1!e' not found",
+            "Worksheet 'Sheet2', value at (5, 0): Expressions outside of tables must name the table they refer to",
+            "Tables refer to each other in a cycle: Sheet1!a -> Sheet1!b -> Sheet1!a",
+        ])
+
+        sheet = Worksheet("Sheet1")
+        sheet.add_table(Table("a", pa.DataFrame({"x": [1, 2]}), formula_columns={"y": Cell("x") * 2}))
+        self.assertEqual(Workbook(worksheets=[sheet]).validate(), [])
+
+        # lazy tables of unknown height can only be referred to as a whole once they've been written
+        sheet_1 = Worksheet("Sheet1")
+        sheet_1.add_table(Table("total", pa.DataFrame({"n": [Formula("SUM", Column("x", table="lz"))]})))
+        sheet_1.add_table(LazyTable("lz", iter([pa.DataFrame({"x": [1, 2]})]), ["x"]))
+        sheet_2 = Worksheet("Sheet2")
+        sheet_2.add_table(Table("count", pa.DataFrame({"n": [Formula("COUNT", Column("x", table="Sheet1!lz"))]})))
+        workbook = Workbook(worksheets=[sheet_1, sheet_2])
+        self.assertEqual(workbook.validate(), [
+            "Worksheet 'Sheet1', table 'total': Table 'lz' has an unknown number of rows "
+            "so can only be referred to as a whole from later worksheets",
+        ])
+        self.assertRaises(RuntimeError, workbook.to_xlsx)
+
+    def test_lazy_table(self):
+        """test lazy tables are read a chunk at a time from iterators and cursors as they're written"""
+        def make_cursor():
+            db = sqlite3.connect(":memory:")
+            db.execute("create table t (a integer, b real)")
+            db.executemany("insert into t values (?, ?)", [(i, i * 0.5) for i in range(10)])
+            return db.execute("select a, b from t order by a")
+
+        def make_chunks():
+            for i in range(0, 6, 2):
+                yield pa.DataFrame({"x": [i, i + 1], "y": [Cell("x") * 2] * 2})
+
+        for engine in ("xlsxwriter", "native"):
+            # a table with a known number of rows can be referred to before it's written
+            cursor_table = LazyTable("lazy", make_cursor(), {"a": "int64", "b": "float64"},
+                                     num_rows=10, chunk_size=3, formula_columns={"c": Cell("b") + 1})
+            sheet_1 = Worksheet("Sheet1")
+            sheet_1.add_table(Table("total", pa.DataFrame({"n": [Formula("SUM", Column("b", table="lazy"))]})))
+            sheet_1.add_table(cursor_table)
+
+            # a table with an unknown number of rows must be last on its sheet
+            chunks_table = LazyTable("tail", make_chunks(), ["x", "y"])
+            sheet_2 = Worksheet("Sheet2")
+            sheet_2.add_table(chunks_table)
+            sheet_3 = Worksheet("Sheet3")
+            sheet_3.add_table(Table("count", pa.DataFrame({"n": [Formula("COUNT", Column("x", table="Sheet2!tail"))]})))
+
+            workbook = Workbook(self.filename, [sheet_1, sheet_2, sheet_3])
+            workbook.to_xlsx(engine=engine)
+            self.assertEqual(chunks_table.height, 7)
+
+            wb = openpyxl.load_workbook(self.filename)
+            ws = wb["Sheet1"]
+            self.assertEqual(ws["A2"].value, "=SUM('Sheet1'!$B$5:$B$14)")
+            self.assertEqual([c.value for c in ws[4]], ["a", "b", "c"])
+            self.assertEqual([c.value for c in ws[14]], [9, 4.5, "='Sheet1'!B14+1"])
+            self.assertEqual(ws.max_row, 14)
+
+            ws = wb["Sheet2"]
+            self.assertEqual([[c.value for c in row] for row in ws.iter_rows()],
+                             [["x", "y"]] + [[i, "='Sheet2'!A%d*2" % (i + 2)] for i in range(6)])
+            self.assertEqual(wb["Sheet3"]["A2"].value, "=COUNT('Sheet2'!$A$2:$A$7)")
+
+            # the data can only be read once
+            self.assertRaises(AssertionError, workbook.to_xlsx, engine=engine)
@@ -97,6 +97,10 @@ Classes
 
 .. autoclass:: ArrayFormula
 
+.. autoclass:: LazyTable
+
+    .. automethod:: iter_chunks
+
 .. autoclass:: Expression
 
 .. autoclass:: ArrayExpression
@@ -120,7 +124,7 @@ Classes
 """
 from .expression import Column, Index, Cell, Range, Formula, ConstExpr, Expression, ArrayExpression
 from .style import CellStyle, TableStyle
-from .table import Table, Value, ArrayFormula
+from .table import Table, Value, ArrayFormula, LazyTable
 from .chart import Chart
 from .worksheet import Worksheet
 from .workbook import Workbook
@@ -133,6 +137,7 @@ __all__ = [
     "Value",
     "Formula",
     "ArrayFormula",
+    "LazyTable",
     "CellStyle",
     "TableStyle",
     "Column",
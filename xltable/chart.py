@@ -92,3 +92,10 @@ class Chart(object):
             if "categories" in series:
                 series["categories"] = series["categories"].get_formula(workbook, row, col)
             yield series
+
+    def _iter_expressions(self):
+        """yield the expressions for the values and categories of the chart's series"""
+        for series in self.__series:
+            yield series["values"]
+            if "categories" in series:
+                yield series["categories"]
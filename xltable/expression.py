@@ -2,7 +2,12 @@
 Expressions for building excel formulas without having to use concrete positions.
 """
 import operator
+import logging
 import re
+import weakref
+import numpy as np
+
+_log = logging.getLogger(__name__)
 
 
 class Expression(object):
@@ -52,8 +57,136 @@ class Expression(object):
     def __and__(self, other):
         return BinOp(self, _make_expr(other), "&")
 
+    @property
+    def key(self):
+        """
+        Hashable key identifying the structure of the expression, so that equal
+        expressions have equal keys. Expressions can't be used as dict keys themselves
+        as the comparison operators build new expressions.
+        None if the expression (or any part of it) doesn't support keys.
+        Values set on expressions are not part of the key. Keys include the expressions'
+        classes, so instances of subclasses never have the same keys as their base classes.
+        """
+        return self._key_info[0]
+
+    # (key, True if the formula depends on the row, True if it depends on the active table or sheet)
+    __key_info = None
+
+    @property
+    def _key_info(self):
+        key_info = self.__key_info
+        if key_info is None:
+            key_info = self.__key_info = self._get_key_info()
+        return key_info
+
+    def _get_key_info(self):
+        # expressions that don't implement this aren't cached
+        return None, True, True
+
+    def _get_table_names(self):
+        """
+        return the set of names of the tables the expression refers to, with None for
+        the table the expression is in, or None if the expression doesn't know.
+        """
+        references = self._get_references()
+        if references is None:
+            return None
+        return {reference[0] for reference in references}
+
+    def _get_references(self):
+        """
+        return a list of (table name, column labels, row labels, index, to_bottom) for each
+        reference the expression makes to a table, where the table name is None for the table
+        the expression is in, index is True if the table's index is referred to and to_bottom
+        is True if the reference extends to the bottom of the table (so needs its height), or
+        None if the expression doesn't know what it refers to.
+        """
+        return None
+
+    def intern(self):
+        """
+        Return the first live expression with the same key as this one (or this one if
+        there isn't one), so that repeated expressions can share a single instance.
+        Expressions with values set, or without keys, are returned unchanged.
+        """
+        key = self.key
+        if key is None or (self.has_value and not isinstance(self, ConstExpr)):
+            return self
+        return _interned.setdefault(key, self)
+
     def get_formula(self, workbook, row, col):
-        return "=%s" % self._strip(self.resolve(workbook, row, col))
+        out = ["="]
+        self._write(workbook, row, col, out)
+        return "".join(out)
+
+    def get_formulas(self, workbook, rows, col):
+        """
+        Return an array of formulas for this expression resolved at each of
+        `rows` in column `col`.
+
+        The expression is resolved once to a :py:class:`FormulaTemplate` and
+        the row numbers are substituted in for all rows together, rather than
+        resolving the expression separately for every row. While the workbook is
+        being written the template is cached by the expression's key, so it's
+        reused for equal expressions.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        template = None
+        if len(rows) > 1:
+            template = self.get_template(workbook, int(rows[0]), col)
+        if template is None:
+            result = np.empty(len(rows), dtype=object)
+            result[:] = [self.get_formula(workbook, int(r), col) for r in rows]
+            return result
+        return template.render(rows)
+
+    def get_template(self, workbook, row, col):
+        """
+        Return a :py:class:`FormulaTemplate` for this expression in column `col`,
+        or None if the expression can't be compiled to a template.
+
+        While the workbook is being written the template is cached by the
+        expression's key.
+
+        :param row: Row used to check the template against :py:meth:`get_formula`.
+        """
+        cache = _get_formula_cache(workbook)
+        if cache is None or self.key is None:
+            return self._get_template(workbook, row, col)
+        cache_key = ("template", self.key, _get_context(workbook, self))
+        template = cache.get(cache_key, _MISSING)
+        if template is _MISSING:
+            template = cache[cache_key] = self._get_template(workbook, row, col)
+        return template
+
+    def _get_template(self, workbook, row, col):
+        """return a new template for this expression (see get_template)"""
+        try:
+            template = FormulaTemplate(self.get_formula(workbook, _RowVar(), col))
+        except Exception:
+            # expressions that do arithmetic on the row other than adding
+            # offsets can't be templated, and are resolved row by row instead
+            return None
+        if template.render_row(row) != self.get_formula(workbook, row, col):
+            return None
+        return template
+
+    def evaluate(self, workbook, rows, col):
+        """
+        Calculate this expression's value at each of `rows` in column `col` (as passed
+        to :py:meth:`get_formulas`) from the tables' dataframes, without Excel.
+
+        :return: Object array of values, with None for any values that couldn't be
+                 calculated, or None if the expression can't be evaluated.
+        """
+        return FormulaEvaluator(workbook).evaluate(self, rows, col)
+
+    def _evaluate(self, evaluator, rows, col):
+        """
+        Return the value of the expression for each of `rows` as an array, or a
+        _RangeValue for expressions referencing a range of cells.
+        """
+        raise _EvaluationError("%s can't be evaluated" % self.__class__.__name__)
 
     @property
     def value(self):
@@ -82,14 +215,19 @@ class Expression(object):
     def value(self, value):
         self.__value = value
 
-    @staticmethod
-    def _strip(x):
-        # strip off the outer parentheses if they match
-        return re.sub("^\((.*)\)$", r"\1", x)
-
     def resolve(self, workbook, worksheet, col, row):
         raise NotImplementedError("Expression.resolve")
 
+    def _write(self, workbook, row, col, out, precedence=0, right=False):
+        """
+        Append the resolved expression to the list of strings `out`.
+
+        :param int precedence: Precedence of the operator this expression is an operand of,
+                               used by operators to only add the parentheses needed.
+        :param bool right: True if this expression is the right hand operand.
+        """
+        out.append(self.resolve(workbook, row, col))
+
 
 class Cell(Expression):
     """
@@ -112,14 +250,21 @@ class Cell(Expression):
         self.__col_fixed = col_fixed
         self.__row_fixed = row_fixed
 
+    def _get_key_info(self):
+        key = (type(self), self.__col, self.__row, self.__row_offset, self.__table, self.__col_fixed, self.__row_fixed)
+        return _key_info(key, self.__row is None, _uses_context(self.__table))
+
+    def _get_references(self):
+        return [(self.__table, [self.__col], [] if self.__row is None else [self.__row], False, False)]
+
     def resolve(self, workbook, row, col):
         table, worksheet = workbook.get_table(self.__table)
         top, left = worksheet.get_table_pos(table.name)
-        col_offset = table.get_column_offset(self.__col)
+        col_offset = _single_offset(table.get_column_offset(self.__col), "Column", self.__col, table)
 
         # if the row has been given use fixed references in the formula unless they've been set explicitly
         if self.__row is not None:
-            row = table.get_row_offset(self.__row)
+            row = _single_offset(table.get_row_offset(self.__row), "Row", self.__row, table)
             row_fixed = self.__row_fixed if self.__row_fixed is not None else True
             col_fixed = self.__col_fixed if self.__col_fixed is not None else True
         else:
@@ -133,6 +278,14 @@ class Cell(Expression):
                         row_fixed=row_fixed,
                         col_fixed=col_fixed)
 
+    def _evaluate(self, evaluator, rows, col):
+        table, worksheet = evaluator.workbook.get_table(self.__table)
+        col_offset = _single_offset(table.get_column_offset(self.__col), "Column", self.__col, table)
+        if self.__row is not None:
+            row = _single_offset(table.get_row_offset(self.__row), "Row", self.__row, table)
+            rows = np.full(len(rows), row, dtype=np.int64)
+        return evaluator.get_column(table, worksheet, col_offset).take(rows + self.__row_offset)
+
     
 class Column(Expression):
     """
@@ -153,21 +306,36 @@ class Column(Expression):
         self.__col_fixed = col_fixed
         self.__row_fixed = row_fixed
 
+    def _get_key_info(self):
+        key = (type(self), self.__col, self.__include_header, self.__table, self.__col_fixed, self.__row_fixed)
+        return _key_info(key, False, _uses_context(self.__table))
+
+    def _get_references(self):
+        return [(self.__table, [self.__col], [], False, True)]
+
     def resolve(self, workbook, row, col):
         table, worksheet = workbook.get_table(self.__table)
         top, left = worksheet.get_table_pos(table.name)
-        col_offset = table.get_column_offset(self.__col)
-        row_offset = 0 if self.__include_header else table.header_height 
-        return "'%s'!%s:%s" % (
-                    worksheet.name,
+        col_offset = _single_offset(table.get_column_offset(self.__col), "Column", self.__col, table)
+        row_offset = 0 if self.__include_header else table.header_height
+        return "%s%s:%s" % (
+                    _sheet_prefix(worksheet.name),
                     _to_addr(None, top + row_offset, left + col_offset,
                              row_fixed=self.__row_fixed,
                              col_fixed=self.__col_fixed),
-                    _to_addr(None, top + table.height - 1, left + col_offset,
+                    _to_addr(None, top + _get_height(table) - 1, left + col_offset,
                              row_fixed=self.__row_fixed,
                              col_fixed=self.__col_fixed))
 
 
+    def _evaluate(self, evaluator, rows, col):
+        table, worksheet = evaluator.workbook.get_table(self.__table)
+        col_offset = _single_offset(table.get_column_offset(self.__col), "Column", self.__col, table)
+        row_offset = 0 if self.__include_header else table.header_height
+        values = evaluator.get_column(table, worksheet, col_offset).slice(row_offset, table.height)
+        return _RangeValue(values.reshape(-1, 1))
+
+
 class Index(Expression):
     """
     Reference to a table's index.
@@ -185,20 +353,34 @@ class Index(Expression):
         self.__col_fixed = col_fixed
         self.__row_fixed = row_fixed
 
+    def _get_key_info(self):
+        key = (type(self), self.__include_header, self.__table, self.__col_fixed, self.__row_fixed)
+        return _key_info(key, False, _uses_context(self.__table))
+
+    def _get_references(self):
+        return [(self.__table, [], [], True, True)]
+
     def resolve(self, workbook, row, col):
         table, worksheet = workbook.get_table(self.__table)
         top, left = worksheet.get_table_pos(table.name)
         col_offset = table.get_index_offset()
         row_offset = 0 if self.__include_header else table.header_height
-        return "'%s'!%s:%s" % (
-                    worksheet.name,
+        return "%s%s:%s" % (
+                    _sheet_prefix(worksheet.name),
                     _to_addr(None, top + row_offset, left + col_offset,
                              row_fixed=self.__row_fixed,
                              col_fixed=self.__col_fixed),
-                    _to_addr(None, top + table.height - 1, left + col_offset,
+                    _to_addr(None, top + _get_height(table) - 1, left + col_offset,
                              row_fixed=self.__row_fixed,
                              col_fixed=self.__col_fixed))
 
+    def _evaluate(self, evaluator, rows, col):
+        table, worksheet = evaluator.workbook.get_table(self.__table)
+        col_offset = table.get_index_offset()
+        row_offset = 0 if self.__include_header else table.header_height
+        values = evaluator.get_column(table, worksheet, col_offset).slice(row_offset, table.height)
+        return _RangeValue(values.reshape(-1, 1))
+
 
 class Range(Expression):
     """
@@ -234,24 +416,33 @@ class Range(Expression):
         self.__col_fixed = col_fixed
         self.__row_fixed = row_fixed
 
+    def _get_key_info(self):
+        key = (type(self), self.__left_col, self.__right_col, self.__top, self.__bottom,
+               self.__include_header, self.__table, self.__col_fixed, self.__row_fixed)
+        return _key_info(key, False, _uses_context(self.__table))
+
+    def _get_references(self):
+        rows = [x for x in (self.__top, self.__bottom) if x is not None]
+        return [(self.__table, [self.__left_col, self.__right_col], rows, False, self.__bottom is None)]
+
     def resolve(self, workbook, row, col):
         table, worksheet = workbook.get_table(self.__table)
         top, left = worksheet.get_table_pos(table.name)
-        left_col_offset = table.get_column_offset(self.__left_col)
-        right_col_offset = table.get_column_offset(self.__right_col)
-        
+        left_col_offset = _first_offset(table.get_column_offset(self.__left_col))
+        right_col_offset = _last_offset(table.get_column_offset(self.__right_col))
+
         if self.__top is None:
             top_row_offset = 0 if self.__include_header else table.header_height
         else:
-            top_row_offset = table.get_row_offset(self.__top)
+            top_row_offset = _first_offset(table.get_row_offset(self.__top))
 
         if self.__bottom is None:
-            bottom_row_offset = table.height - 1
+            bottom_row_offset = _get_height(table) - 1
         else:
-            bottom_row_offset = table.get_row_offset(self.__bottom)
+            bottom_row_offset = _last_offset(table.get_row_offset(self.__bottom))
 
-        return "'%s'!%s:%s" % (
-                    worksheet.name,
+        return "%s%s:%s" % (
+                    _sheet_prefix(worksheet.name),
                     _to_addr(None, top + top_row_offset, left + left_col_offset,
                              row_fixed=self.__row_fixed,
                              col_fixed=self.__col_fixed),
@@ -260,6 +451,26 @@ class Range(Expression):
                              col_fixed=self.__col_fixed))
 
 
+    def _evaluate(self, evaluator, rows, col):
+        table, worksheet = evaluator.workbook.get_table(self.__table)
+        left_col_offset = _first_offset(table.get_column_offset(self.__left_col))
+        right_col_offset = _last_offset(table.get_column_offset(self.__right_col))
+
+        if self.__top is None:
+            top_row_offset = 0 if self.__include_header else table.header_height
+        else:
+            top_row_offset = _first_offset(table.get_row_offset(self.__top))
+
+        if self.__bottom is None:
+            bottom_row_offset = table.height - 1
+        else:
+            bottom_row_offset = _last_offset(table.get_row_offset(self.__bottom))
+
+        columns = [evaluator.get_column(table, worksheet, c).slice(top_row_offset, bottom_row_offset + 1)
+                   for c in range(left_col_offset, right_col_offset + 1)]
+        return _RangeValue(np.column_stack([x.astype(object) for x in columns]))
+
+
 class Formula(Expression):
     """
     Formula expression.
@@ -278,12 +489,40 @@ class Formula(Expression):
         self.__args = args
 
     def resolve(self, workbook, row, col):
-        def to_arg(x):
-            if x is None:
-                return ""
-            return self._strip(_make_expr(x).resolve(workbook, row, col))
-        args = [to_arg(x) for x in self.__args]
-        return "%s(%s)" % (self.__name, ",".join(args))
+        out = []
+        self._write(workbook, row, col, out)
+        return "".join(out)
+
+    def _get_key_info(self):
+        args = [x._key_info if isinstance(x, Expression)
+                else None if x is None
+                else _key_info((ConstExpr, type(x).__name__, x), False, False)
+                for x in self.__args]
+        return _combine_key_info((type(self), self.__name), args)
+
+    def _get_references(self):
+        return _combine_references(x for x in self.__args if isinstance(x, Expression))
+
+    def _write(self, workbook, row, col, out, precedence=0, right=False):
+        out.append(self.__name)
+        out.append("(")
+        for i, arg in enumerate(self.__args):
+            if i:
+                out.append(",")
+            if arg is not None:
+                _write_operand(_make_expr(arg), workbook, row, col, out)
+        out.append(")")
+
+    def _evaluate(self, evaluator, rows, col):
+        func = _formula_functions.get(self.__name.upper())
+        if func is None:
+            raise _EvaluationError("Function %s can't be evaluated" % self.__name)
+        args = [None if x is None else evaluator._evaluate(_make_expr(x), rows, col) for x in self.__args]
+        result = func(args, len(rows))
+        if func is _if:
+            # only the branch chosen by IF's condition is used
+            return result
+        return _propagate_errors(args, result)
     
     
 class ArrayExpression(Expression):
@@ -300,9 +539,21 @@ class ArrayExpression(Expression):
     def resolve(self, workbook, row, col):
         return self.__expr.resolve(workbook, row, col)
 
+    def _get_key_info(self):
+        return _combine_key_info((type(self),), [self.__expr._key_info])
+
+    def _get_references(self):
+        return self.__expr._get_references()
+
+    def _write(self, workbook, row, col, out, precedence=0, right=False):
+        self.__expr._write(workbook, row, col, out, precedence, right)
+
     def get_formula(self, workbook, row, col):
         return "{%s}" % self.__expr.get_formula(workbook, row, col).strip("{}")
 
+    def _evaluate(self, evaluator, rows, col):
+        return evaluator._evaluate(self.__expr, rows, col)
+
 
 class BinOp(Expression):
     """
@@ -318,6 +569,7 @@ class BinOp(Expression):
         "<=": operator.le,
         ">=": operator.ge,
         "!=": operator.ne,
+        "<>": operator.ne,
         "=": operator.eq,
         "&": operator.and_,
         "|": operator.or_,
@@ -331,11 +583,53 @@ class BinOp(Expression):
         if lhs.has_value and rhs.has_value:
             self.value = self.__operators[op](lhs.value, rhs.value)
 
+    def _get_key_info(self):
+        lhs_key, lhs_row_relative, lhs_uses_context = self.__lhs._key_info
+        rhs_key, rhs_row_relative, rhs_uses_context = self.__rhs._key_info
+        if lhs_key is None or rhs_key is None:
+            return None, True, True
+        return ((type(self), self.__op, lhs_key, rhs_key),
+                lhs_row_relative or rhs_row_relative,
+                lhs_uses_context or rhs_uses_context)
+
+    def _get_references(self):
+        return _combine_references((self.__lhs, self.__rhs))
+
     def resolve(self, workbook, row, col):
-        return "(%s%s%s)" % (
-            self.__lhs.resolve(workbook, row, col),
-            self.__op,
-            self.__rhs.resolve(workbook, row, col))
+        out = ["("]
+        self._write(workbook, row, col, out)
+        out.append(")")
+        return "".join(out)
+
+    def _write(self, workbook, row, col, out, precedence=0, right=False):
+        # operands are only put in parentheses if the operator's precedence requires it,
+        # and operators are left associative so a right operand with the same precedence
+        # as this operator needs them too (e.g. a-(b-c)).
+        op_precedence = _precedence.get(self.__op, 0)
+        parens = op_precedence < precedence or (right and op_precedence == precedence)
+        if parens:
+            out.append("(")
+        _write_operand(self.__lhs, workbook, row, col, out, op_precedence, False)
+        out.append(self.__op)
+        _write_operand(self.__rhs, workbook, row, col, out, op_precedence, True)
+        if parens:
+            out.append(")")
+
+    def _evaluate(self, evaluator, rows, col):
+        lhs = evaluator._evaluate(self.__lhs, rows, col)
+        rhs = evaluator._evaluate(self.__rhs, rows, col)
+        if not isinstance(lhs, _RangeValue) and not isinstance(rhs, _RangeValue):
+            return _binary_op(self.__op, lhs, rhs)
+
+        # combining a range with a value that's the same on each row gives a range
+        lhs = lhs.values if isinstance(lhs, _RangeValue) else _to_scalar(lhs)
+        rhs = rhs.values if isinstance(rhs, _RangeValue) else _to_scalar(rhs)
+        if np.shape(lhs) and np.shape(rhs) and np.shape(lhs) != np.shape(rhs):
+            raise _EvaluationError("Ranges of different sizes can't be combined")
+        shape = np.broadcast(lhs, rhs).shape
+        lhs = np.broadcast_to(np.asarray(lhs, dtype=object), shape).ravel()
+        rhs = np.broadcast_to(np.asarray(rhs, dtype=object), shape).ravel()
+        return _RangeValue(_binary_op(self.__op, lhs, rhs).reshape(shape))
 
 
 class ConstExpr(Expression):
@@ -346,28 +640,812 @@ class ConstExpr(Expression):
         super(ConstExpr, self).__init__(**kwargs)
         self.value = value
         self.__value = value
-        
+
+    def _get_key_info(self):
+        # the type is included as e.g. True and 1 are equal but written differently
+        return _key_info((type(self), type(self.__value).__name__, self.__value), False, False)
+
+    def _get_references(self):
+        return []
+
     def resolve(self, workbook, row, col):
         if isinstance(self.__value, str):
-            return '"%s"' % self.__value
+            return '"%s"' % self.__value.replace('"', '""')
         if isinstance(self.__value, bool):
             return "TRUE" if self.__value else "FALSE"
         return str(self.__value)
 
 
+class FormulaEvaluator(object):
+    """
+    Internal use - calculates the values of expressions from the tables' dataframes,
+    so that they can be written as the formulas' cached values.
+
+    Expressions are evaluated for many rows at once using numpy, and the values of
+    any table columns referenced are worked out once and kept by the evaluator.
+    Cells that are NaN, inf or NaT in the dataframes are treated according to
+    the workbook's nan policy.
+
+    Values that would be errors in Excel are evaluated as the error (e.g. #DIV/0!),
+    and values that aren't known (e.g. those of formulas that can't be evaluated)
+    are NaN.
+
+    :param xltable.Workbook workbook: Workbook the expressions are in.
+    """
+    def __init__(self, workbook):
+        self.workbook = workbook
+        self.__nan_policy = getattr(workbook, "nan_policy", "blank")
+
+        # {(id(table), col offset) -> _ColumnValues}
+        self.__columns = {}
+        self.__evaluating = set()
+
+    def evaluate(self, expr, rows, col):
+        """
+        Return an object array of the values of `expr` at each of `rows` in column `col`,
+        with Excel error values as strings (e.g. "#DIV/0!"), "" for any values that can't
+        be calculated and None for empty cells, or None if the expression can't be evaluated.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        try:
+            values = self._evaluate(expr, rows, col)
+            if isinstance(values, _RangeValue):
+                values = _full(len(rows), values.to_scalar())
+        except _EvaluationError as e:
+            _log.debug("Can't evaluate expression %r: %s", expr, e)
+            return None
+
+        result = np.empty(len(rows), dtype=object)
+        result[:] = [_to_cell_value(x) for x in values.tolist()]
+        return result
+
+    def _evaluate(self, expr, rows, col):
+        if expr.has_value:
+            return _full(len(rows), expr.value)
+        return expr._evaluate(self, rows, col)
+
+    def get_column(self, table, worksheet, col_offset):
+        """return the _ColumnValues for a column of a table (including the header)"""
+        key = (id(table), col_offset)
+        column = self.__columns.get(key)
+        if column is None:
+            if key in self.__evaluating:
+                raise _EvaluationError("Circular reference to column %d of table %s" % (col_offset, table.name))
+            self.__evaluating.add(key)
+            try:
+                column = self.__get_column(table, worksheet, col_offset)
+            finally:
+                self.__evaluating.discard(key)
+            self.__columns[key] = column
+        return column
+
+    def __get_column(self, table, worksheet, col_offset):
+        from .table import LazyTable
+        if isinstance(table, LazyTable):
+            raise _EvaluationError("The data for table %s is only read as it's written" % table.name)
+        df = table.dataframe
+        header_height = table.header_height
+        row_labels_width = table.row_labels_width
+        c = col_offset - row_labels_width
+        rows = np.arange(len(df.index), dtype=np.int64) + header_height
+
+        header = np.full(header_height, None, dtype=object)
+        if c < 0:
+            index = df.index
+            body = np.asarray(index.get_level_values(col_offset))
+            if header_height:
+                names = index.names if len(index.names) > 1 else [index.name]
+                header[-1] = names[col_offset] or ""
+        else:
+            columns = table.columns
+            if header_height:
+                if header_height > 1:
+                    header[:] = [columns.get_level_values(i)[c] for i in range(header_height)]
+                else:
+                    header[0] = columns[c]
+
+            if c < len(df.columns):
+                body = df.iloc[:, c].values
+                if body.dtype == object:
+                    body = self.__get_object_values(table, worksheet, body, rows, col_offset)
+            else:
+                expr = list(table.formula_columns.values())[c - len(df.columns)]
+                body = self.__evaluate_in_table(table, worksheet, expr, rows, col_offset)
+
+        return _ColumnValues(header, self.__apply_nan_policy(np.asarray(body)))
+
+    def __get_object_values(self, table, worksheet, values, rows, col_offset):
+        """return an object column with any Values and Expressions replaced by their values"""
+        from .table import Value
+        values = values.copy()
+        exprs = {}
+        for i, x in enumerate(values):
+            if isinstance(x, Value):
+                values[i] = x = x.value
+            if isinstance(x, Expression):
+                exprs.setdefault(id(x), (x, []))[1].append(i)
+            elif isinstance(x, str) and x.startswith("="):
+                values[i] = np.nan
+
+        for expr, offsets in exprs.values():
+            try:
+                values[offsets] = self.__evaluate_in_table(table, worksheet, expr, rows[offsets], col_offset)
+            except _EvaluationError as e:
+                _log.debug("Can't evaluate expression %r: %s", expr, e)
+                values[offsets] = np.nan
+        return values
+
+    def __evaluate_in_table(self, table, worksheet, expr, rows, col):
+        """evaluate an expression in a table, with the table as the active one"""
+        workbook = self.workbook
+        prev_table, prev_worksheet = workbook.active_table, workbook.active_worksheet
+        workbook.active_table, workbook.active_worksheet = table, worksheet
+        try:
+            values = self._evaluate(expr, rows, col)
+        finally:
+            workbook.active_table, workbook.active_worksheet = prev_table, prev_worksheet
+        if isinstance(values, _RangeValue):
+            values = _full(len(rows), values.to_scalar())
+        return values
+
+    def __apply_nan_policy(self, values):
+        """
+        Replace NaN and inf values with None (empty) if they're written as blanks, 0 if
+        they're written as zero or #N/A if they're written as errors.
+        """
+        if values.dtype.kind == "f":
+            is_nan = ~np.isfinite(values)
+        elif values.dtype.kind == "O":
+            is_nan = np.fromiter((isinstance(x, float) and not np.isfinite(x) for x in values),
+                                 dtype=bool,
+                                 count=len(values))
+        else:
+            return values
+
+        if not is_nan.any():
+            return values
+        values = values.astype(object)
+        values[is_nan] = {"blank": None, "zero": 0.0}.get(self.__nan_policy, _NA)
+        return values
+
+
+class _EvaluationError(Exception):
+    """raised when an expression can't be evaluated"""
+    pass
+
+
+class _ErrorValue(object):
+    """
+    Internal use - an Excel error value (e.g. #DIV/0!), as the result of evaluating an expression.
+    """
+    def __init__(self, code):
+        self.code = code
+
+    def __repr__(self):
+        return self.code
+
+
+_DIV0 = _ErrorValue("#DIV/0!")
+_NA = _ErrorValue("#N/A")
+_NUM = _ErrorValue("#NUM!")
+_VALUE = _ErrorValue("#VALUE!")
+
+
+class _ColumnValues(object):
+    """
+    Internal use - values of a table column, with the header values kept separately
+    so that the body can keep its dtype.
+    """
+    def __init__(self, header, body):
+        self.header = header
+        self.body = body
+
+    def take(self, rows):
+        """return the values at offsets from the top of the table, with NaN for rows outside the table"""
+        header_height = len(self.header)
+        if len(rows) and rows.min() >= header_height and rows.max() < header_height + len(self.body):
+            return self.body[rows - header_height]
+        values = np.full(len(rows), np.nan, dtype=object)
+        for i, r in enumerate(rows):
+            if 0 <= r < header_height:
+                values[i] = self.header[r]
+            elif header_height <= r < header_height + len(self.body):
+                values[i] = self.body[r - header_height]
+        return values
+
+    def slice(self, start, stop):
+        """return the values from offset start to stop"""
+        header_height = len(self.header)
+        if start >= header_height:
+            return self.body[start - header_height:stop - header_height]
+        return np.concatenate([self.header[start:stop],
+                               self.body[:max(stop - header_height, 0)].astype(object)])
+
+
+class _RangeValue(object):
+    """
+    Internal use - the values of a range of cells, as a 2d array.
+    """
+    def __init__(self, values):
+        self.values = values
+
+    def to_scalar(self):
+        """return the value of a single cell range"""
+        if self.values.size != 1:
+            raise _EvaluationError("Range of %d cells used as a single value" % self.values.size)
+        return self.values.flat[0]
+
+
+def _full(n, value):
+    """return an array of n copies of a value"""
+    if isinstance(value, (bool, int, float, np.number, np.bool_)):
+        return np.full(n, value)
+    result = np.empty(n, dtype=object)
+    result[:] = [value] * n
+    return result
+
+
+def _to_scalar(values):
+    """return the value of an array with the same value on every row"""
+    if len(values) and (values == values[0]).all():
+        return values[0]
+    raise _EvaluationError("Range combined with a value that's different on each row")
+
+
+def _to_cell_value(x):
+    """
+    return an evaluated value as a value that can be written to a cell, with errors as their
+    codes, None for empty cells and "" for values that aren't known (so no value is written)
+    """
+    if x is None:
+        return None
+    if isinstance(x, _ErrorValue):
+        return x.code
+    if isinstance(x, np.generic):
+        x = x.item()
+    if isinstance(x, (bool, str)):
+        return x
+    if isinstance(x, (int, float)):
+        return x if np.isfinite(x) else ""
+    return ""
+
+
+def _to_number(x):
+    if x is None:
+        return 0.0
+    if isinstance(x, (bool, int, float, np.number, np.bool_)):
+        return float(x)
+    return np.nan
+
+
+def _to_numbers(values):
+    """
+    Convert evaluated values to floats, as used in arithmetic. Empty cells are 0,
+    booleans 1 or 0 and anything else that isn't a number is NaN (an error).
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in "biuf":
+        return values.astype(float)
+    numbers = np.fromiter((_to_number(x) for x in values.flat), dtype=float, count=values.size)
+    return numbers.reshape(values.shape)
+
+
+def _range_numbers(values):
+    """
+    Return the numbers in a range as a 1d array of floats. Like Excel's aggregate
+    functions empty cells, strings and booleans in ranges are ignored.
+    """
+    if values.dtype.kind in "iuf":
+        return values.ravel().astype(float)
+    return np.array([float(x) for x in values.flat
+                     if isinstance(x, (int, float, np.number)) and not isinstance(x, (bool, np.bool_))],
+                    dtype=float)
+
+
+def _to_text(x):
+    """convert an evaluated value to text, as used by the & operator"""
+    if x is None:
+        return ""
+    if isinstance(x, (bool, np.bool_)):
+        return "TRUE" if x else "FALSE"
+    if isinstance(x, (int, float, np.number)):
+        if not np.isfinite(x):
+            raise _EvaluationError("Error value used as text")
+        return "%.15G" % x
+    if isinstance(x, str):
+        return x
+    raise _EvaluationError("%s can't be used as text" % type(x).__name__)
+
+
+# Excel sorts numbers before text before booleans when comparing values of different types
+def _compare_key(x):
+    if x is None:
+        return (0, 0.0)
+    if isinstance(x, (bool, np.bool_)):
+        return (2, bool(x))
+    if isinstance(x, (int, float, np.number)):
+        return (0, float(x))
+    if isinstance(x, str):
+        return (1, x.lower())
+    raise _EvaluationError("%s can't be compared" % type(x).__name__)
+
+
+_arithmetic_ops = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.divide,
+}
+
+_comparison_ops = {
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+    "=": operator.eq,
+    "<>": operator.ne,
+    "!=": operator.ne,
+}
+
+
+def _binary_op(op, lhs, rhs):
+    """apply a binary operator to two 1d arrays of evaluated values"""
+    if op in _arithmetic_ops:
+        with np.errstate(all="ignore"):
+            result = _arithmetic_ops[op](_to_numbers(lhs), _to_numbers(rhs))
+        is_error = ~np.isfinite(result)
+        if is_error.any():
+            result = result.astype(object)
+            for i in np.flatnonzero(is_error):
+                result[i] = _arithmetic_error(op, lhs[i], rhs[i])
+        return result
+
+    if op in _comparison_ops:
+        func = _comparison_ops[op]
+        if lhs.dtype.kind in "iuf" and rhs.dtype.kind in "iuf":
+            with np.errstate(invalid="ignore"):
+                result = func(lhs, rhs)
+            if np.isnan(lhs).any() or np.isnan(rhs).any():
+                result = result.astype(object)
+                result[np.isnan(lhs) | np.isnan(rhs)] = np.nan
+            return result
+        result = np.empty(len(lhs), dtype=object)
+        for i, (x, y) in enumerate(zip(lhs.tolist(), rhs.tolist())):
+            error = _error_value(x, y, numbers=False)
+            result[i] = func(_compare_key(x), _compare_key(y)) if error is None else error
+        return result
+
+    if op == "&":
+        result = np.empty(len(lhs), dtype=object)
+        for i, (x, y) in enumerate(zip(lhs.tolist(), rhs.tolist())):
+            error = _error_value(x, y, numbers=False)
+            result[i] = _to_text(x) + _to_text(y) if error is None else error
+        return result
+
+    raise _EvaluationError("Operator %s can't be evaluated" % op)
+
+
+def _error_value(*operands, numbers=True):
+    """
+    return the result of an operation on operands that aren't all valid: the first error
+    value, or if numbers are required #VALUE! for any text, or NaN if any value isn't known.
+    Return None if the operands are all valid.
+    """
+    for x in operands:
+        if isinstance(x, _ErrorValue):
+            return x
+    if numbers:
+        for x in operands:
+            if isinstance(x, str):
+                return _VALUE
+        for x in operands:
+            if np.isnan(_to_number(x)):
+                return np.nan
+    else:
+        for x in operands:
+            if isinstance(x, (float, np.floating)) and np.isnan(x):
+                return np.nan
+    return None
+
+
+def _arithmetic_error(op, x, y):
+    """return the result of an arithmetic operation on x and y that isn't a finite number"""
+    error = _error_value(x, y)
+    if error is not None:
+        return error
+    if op == "/" and _to_number(y) == 0:
+        return _DIV0
+    return _NUM
+
+
+def _propagate_errors(args, result):
+    """
+    return the result of a function with the first error value in any of its arguments
+    on each row, as errors in any of a function's arguments are errors in its result
+    """
+    errors = None
+    for arg in args:
+        if isinstance(arg, _RangeValue):
+            values = arg.values
+            if values.dtype != object:
+                continue
+            error = next((x for x in values.flat if isinstance(x, _ErrorValue)), None)
+            if error is None:
+                continue
+            arg_errors = _full(len(result), error)
+        elif arg is not None and arg.dtype == object:
+            arg_errors = np.array([x if isinstance(x, _ErrorValue) else None for x in arg.tolist()], dtype=object)
+        else:
+            continue
+        if errors is None:
+            errors = arg_errors
+        else:
+            errors = np.where(errors == None, arg_errors, errors)
+
+    if errors is not None:
+        has_error = errors != None
+        if has_error.any():
+            result = result.astype(object)
+            result[has_error] = errors[has_error]
+    return result
+
+
+def _sum(args, n):
+    total = np.zeros(n)
+    for arg in args:
+        if isinstance(arg, _RangeValue):
+            total += _range_numbers(arg.values).sum()
+        elif arg is not None:
+            total += _to_numbers(arg)
+    return total
+
+
+def _average(args, n):
+    total = np.zeros(n)
+    count = 0
+    for arg in args:
+        if isinstance(arg, _RangeValue):
+            numbers = _range_numbers(arg.values)
+            total += numbers.sum()
+            count += len(numbers)
+        elif arg is not None:
+            total += _to_numbers(arg)
+            count += 1
+    if not count:
+        return _full(n, _DIV0)
+    return total / count
+
+
+def _min_max(func):
+    def aggregate(args, n):
+        result = None
+        for arg in args:
+            if isinstance(arg, _RangeValue):
+                numbers = _range_numbers(arg.values)
+                if not len(numbers):
+                    continue
+                values = np.full(n, func.reduce(numbers))
+            elif arg is not None:
+                values = _to_numbers(arg)
+            else:
+                continue
+            result = values if result is None else func(result, values)
+        return np.zeros(n) if result is None else result
+    return aggregate
+
+
+def _sumproduct(args, n):
+    if not any(isinstance(arg, _RangeValue) for arg in args):
+        result = np.ones(n)
+        for arg in args:
+            result *= _to_numbers(arg)
+        return result
+
+    if not all(isinstance(arg, _RangeValue) for arg in args) \
+            or len(set(arg.values.shape for arg in args)) > 1:
+        raise _EvaluationError("SUMPRODUCT arguments must be ranges of the same size")
+
+    # non-numeric values in the ranges are treated as zero
+    product = np.ones(args[0].values.shape)
+    for arg in args:
+        values = arg.values
+        if values.dtype.kind not in "iuf":
+            values = np.array([x if isinstance(x, (int, float, np.number)) and not isinstance(x, (bool, np.bool_))
+                               else 0.0 for x in values.flat], dtype=float).reshape(values.shape)
+        product *= values
+    return np.full(n, product.sum())
+
+
+def _if(args, n):
+    if not 2 <= len(args) <= 3 or any(isinstance(arg, _RangeValue) for arg in args):
+        raise _EvaluationError("Invalid arguments to IF")
+    cond = _to_numbers(args[0])
+    if_true = _full(n, 0) if args[1] is None else args[1]
+    if_false = _full(n, False) if len(args) < 3 else (_full(n, 0) if args[2] is None else args[2])
+    if if_true.dtype != if_false.dtype:
+        if_true, if_false = if_true.astype(object), if_false.astype(object)
+    result = np.where(cond != 0, if_true, if_false)
+    is_error = np.isnan(cond)
+    if is_error.any():
+        result = result.astype(object)
+        for i in np.flatnonzero(is_error):
+            result[i] = _error_value(args[0][i])
+    return result
+
+
+def _round(args, n):
+    if len(args) != 2 or any(isinstance(arg, _RangeValue) for arg in args):
+        raise _EvaluationError("Invalid arguments to ROUND")
+    values, digits = _to_numbers(args[0]), _to_numbers(args[1])
+    scale = 10.0 ** np.trunc(digits)
+    with np.errstate(all="ignore"):
+        # Excel rounds halves away from zero, and the scaled value is rounded
+        # first so that e.g. 2.675 rounds to 2.68 as it does in Excel
+        return np.sign(values) * np.floor(np.round(np.abs(values) * scale, 9) + 0.5) / scale
+
+
+# functions that can be evaluated, as {name -> func(args, number of rows)}, where args are the
+# evaluated arguments (arrays with a value for each row, or _RangeValues) or None if omitted
+_formula_functions = {
+    "SUM": _sum,
+    "SUMPRODUCT": _sumproduct,
+    "AVERAGE": _average,
+    "MIN": _min_max(np.minimum),
+    "MAX": _min_max(np.maximum),
+    "IF": _if,
+    "ROUND": _round,
+}
+
+
+class FormulaTemplate(object):
+    """
+    Internal use - a resolved formula with placeholders for the row numbers
+    of any references relative to the current row.
+
+    :param str formula: Formula resolved with a row placeholder (see :py:class:`_RowVar`).
+    """
+    def __init__(self, formula):
+        parts = formula.split(_ROW_MARKER)
+        self.__literals = parts[0::2]
+        self.__offsets = [int(x) for x in parts[1::2]]
+
+    @property
+    def is_row_relative(self):
+        """True if the formula depends on the row it's resolved at"""
+        return len(self.__offsets) > 0
+
+    @property
+    def is_shareable(self):
+        """
+        True if the formula can be written as an Excel shared formula filled down
+        a column, where Excel works out each row's formula by moving any relative
+        references. That's the case if the formula depends on the row, all its
+        references to the row are relative, and it has no other relative references.
+        """
+        if not self.__offsets:
+            return False
+        # a '$' before the row placeholder means the reference's row is fixed
+        if any(literal.endswith("$") for literal in self.__literals[:-1]):
+            return False
+        text = _quoted_re.sub("", _ROW_MARKER.join(self.__literals))
+        return all(match.group(1) for match in _cell_ref_re.finditer(text))
+
+    def render_row(self, row):
+        """return the formula for a single row"""
+        formula = self.__literals[0]
+        for offset, literal in zip(self.__offsets, self.__literals[1:]):
+            formula += "%d%s" % (row + offset, literal)
+        return formula
+
+    def render(self, rows):
+        """return an object array of formulas, one per row in `rows`"""
+        rows = np.asarray(rows, dtype=np.int64)
+        result = np.empty(len(rows), dtype=object)
+        result[:] = self.__literals[0]
+        for offset, literal in zip(self.__offsets, self.__literals[1:]):
+            result += (rows + offset).astype(str).astype(object)
+            if literal:
+                result += literal
+        return result
+
+
+# separates row placeholders from the rest of a formula when building templates
+_ROW_MARKER = "\0"
+
+# strings and quoted sheet names in formulas
+_quoted_re = re.compile(r'"(?:[^"]|"")*"|\'(?:[^\']|\'\')*\'')
+
+# cell references with a constant row, with the '$' if the row is fixed
+_cell_ref_re = re.compile(r"(?<![A-Za-z0-9_.])\$?[A-Z]{1,3}(\$?)[0-9]+(?![0-9A-Za-z_(!])")
+
+
+class _RowVar(object):
+    """
+    Internal use - stands in for the row when resolving expressions to a
+    :py:class:`FormulaTemplate`. Adding integers to it accumulates an offset
+    that is written into the formula as a placeholder by :py:func:`_to_addr`.
+    """
+    def __init__(self, offset=0):
+        self.offset = offset
+
+    def __add__(self, other):
+        if isinstance(other, _RowVar):
+            raise TypeError("Can't add two row placeholders")
+        return _RowVar(self.offset + other)
+
+    __radd__ = __add__
+
+
+# expressions returned by Expression.intern, by key
+_interned = weakref.WeakValueDictionary()
+
+# marks a missing entry in the formula cache (as None may be cached)
+_MISSING = object()
+
+
+def _key_info(key, row_relative, uses_context):
+    """return the key info for an expression, with no key if the key isn't hashable (e.g. a list label)"""
+    try:
+        hash(key)
+    except TypeError:
+        return None, True, True
+    return key, row_relative, uses_context
+
+
+def _uses_context(table):
+    """
+    return True if a reference to a table depends on the active table or sheet,
+    i.e. the table isn't given or it isn't qualified with the sheet name
+    """
+    return table is None or "!" not in table
+
+
+def _combine_key_info(key, args):
+    """return the key info for an expression made of args (key infos, or None for omitted args)"""
+    arg_keys = []
+    row_relative = False
+    uses_context = False
+    for arg in args:
+        if arg is None:
+            arg_keys.append(None)
+            continue
+        arg_key, arg_row_relative, arg_uses_context = arg
+        if arg_key is None:
+            return None, True, True
+        arg_keys.append(arg_key)
+        row_relative = row_relative or arg_row_relative
+        uses_context = uses_context or arg_uses_context
+    return key + tuple(arg_keys), row_relative, uses_context
+
+
+def _combine_references(exprs):
+    """return the combined references of exprs (see Expression._get_references), or None"""
+    references = []
+    for expr in exprs:
+        expr_references = expr._get_references()
+        if expr_references is None:
+            return None
+        references.extend(expr_references)
+    return references
+
+
+def _get_height(table):
+    """return the height of a table, which must be known (see LazyTable)"""
+    if not table.height_known:
+        raise RuntimeError("The height of table '%s' isn't known until it's been written" % table.name)
+    return table.height
+
+
+def _get_formula_cache(workbook):
+    """return the workbook's formula cache if it's being written, or None"""
+    return getattr(workbook, "formula_cache", None)
+
+
+def _get_context(workbook, expr):
+    """return the part of the cache key for an expression that depends on the active table and sheet"""
+    if expr._key_info[2]:
+        return id(workbook.active_table), id(workbook.active_worksheet)
+    return None
+
+
+def _write_operand(expr, workbook, row, col, out, precedence=0, right=False):
+    """
+    Write an operand or argument of an expression. Operands that don't depend on the
+    row are only resolved once while the workbook is being written, and reused.
+    """
+    cache = _get_formula_cache(workbook)
+    key, row_relative, _uses_context = expr._key_info
+    if cache is None or key is None or row_relative:
+        expr._write(workbook, row, col, out, precedence, right)
+        return
+
+    cache_key = (key, _get_context(workbook, expr), precedence, right)
+    resolved = cache.get(cache_key)
+    if resolved is None:
+        parts = []
+        expr._write(workbook, row, col, parts, precedence, right)
+        resolved = cache[cache_key] = "".join(parts)
+    out.append(resolved)
+
+
 def _to_addr(worksheet, row, col, row_fixed=False, col_fixed=False):
     """converts a (0,0) based coordinate to an excel address"""
-    addr = ""
-    A = ord('A')
+    if isinstance(row, _RowVar):
+        row = _ROW_MARKER + str(row.offset + 1) + _ROW_MARKER
+    else:
+        row = str(row + 1)
+
+    addr = _col_letters[col] if 0 <= col < _MAX_COLS else _get_col_letters(col)
+    if row_fixed:
+        addr = ("$" if col_fixed else "") + addr + "$" + row
+    else:
+        addr = ("$" if col_fixed else "") + addr + row
+    if worksheet:
+        return _sheet_prefix(worksheet) + addr
+    return addr
+
+
+def _get_col_letters(col):
+    """return the letters for a (0 based) column number, e.g. 0 is A and 26 is AA"""
+    letters = ""
     col += 1
     while col > 0:
-        addr = chr(A + ((col - 1) % 26)) + addr
-        col = (col - 1) // 26
+        col, remainder = divmod(col - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+
+# number of columns in an Excel worksheet
+_MAX_COLS = 16384
+
+# letters for each column in a worksheet
+_col_letters = [_get_col_letters(c) for c in range(_MAX_COLS)]
+
+# "'sheet name'!" prefixes for references to cells on other sheets, by sheet name
+_sheet_prefixes = {}
+
+
+def _sheet_prefix(sheet_name):
+    """return the quoted sheet name prefix used to reference cells on a sheet"""
+    prefix = _sheet_prefixes.get(sheet_name)
+    if prefix is None:
+        prefix = "'%s'!" % sheet_name.replace("'", "''")
+        _sheet_prefixes[sheet_name] = prefix
+    return prefix
+
+
+# precedence of Excel's binary operators, highest first
+_precedence = {
+    "*": 4,
+    "/": 4,
+    "+": 3,
+    "-": 3,
+    "&": 2,
+    "=": 1,
+    "<>": 1,
+    "!=": 1,
+    "<": 1,
+    ">": 1,
+    "<=": 1,
+    ">=": 1,
+}
+
+
+def _single_offset(offset, kind, label, table):
+    """return offset if it's a single offset, or raise a KeyError if the label matched several"""
+    if not isinstance(offset, int):
+        raise KeyError("%s '%s' is not unique in table %s" % (kind, label, table.name))
+    return offset
+
+
+def _first_offset(offset):
+    """return the first offset if a label matched several, or the offset itself"""
+    return offset if isinstance(offset, int) else offset[0]
+
 
-    prefix = ("'%s'!" % worksheet) if worksheet else ""
-    col_modifier = "$" if col_fixed else ""
-    row_modifier = "$" if row_fixed else ""
-    return prefix + "%s%s%s%d" % (col_modifier, addr, row_modifier, row+1)
+def _last_offset(offset):
+    """return the last offset if a label matched several, or the offset itself"""
+    return offset if isinstance(offset, int) else offset[-1]
 
 
 def _make_expr(x):
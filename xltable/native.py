@@ -0,0 +1,978 @@
+"""
+Native writer for .xlsx files.
+
+Writes the resolved tables of a workbook straight to SpreadsheetML, streaming
+each worksheet's XML into the zip file a row at a time, without going through
+xlsxwriter's per-cell API. Cells are formatted a column at a time in chunks of
+rows and each row is written as a single run of cells.
+
+This is used by :py:meth:`xltable.Workbook.to_xlsx` when engine="native".
+"""
+from .style import CellStyle
+from .expression import _col_letters
+from .worksheet import (_get_column_kinds,
+                        _NUMBER,
+                        _BOOL,
+                        _DATETIME,
+                        _STRING,
+                        _FORMULA,
+                        _nan_policies)
+from xml.sax.saxutils import quoteattr
+import datetime as dt
+import numbers
+import zipfile
+import re
+import pandas as pa
+import numpy as np
+
+# number of rows of each table formatted at once
+_CHUNK_SIZE = 1024
+
+# number of rows written to the zip file at once
+_FLUSH_ROWS = 1024
+
+_xml_header = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+_main_ns = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_rel_ns = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_package_rel_ns = "http://schemas.openxmlformats.org/package/2006/relationships"
+_content_types_ns = "http://schemas.openxmlformats.org/package/2006/content-types"
+_office_doc_type = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+_worksheet_type = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"
+_styles_type = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles"
+_shared_strings_type = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings"
+_table_type = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/table"
+_content_type_prefix = "application/vnd.openxmlformats-officedocument.spreadsheetml."
+
+# Excel's error values, written as errors when used as formula values
+_error_codes = frozenset(["#DIV/0!", "#N/A", "#NAME?", "#NULL!", "#NUM!", "#REF!", "#VALUE!"])
+
+# xlsxwriter border style numbers -> SpreadsheetML border styles
+_border_styles = {
+    1: "thin",
+    2: "medium",
+    3: "dashed",
+    4: "dotted",
+    5: "thick",
+    6: "double",
+    7: "hair",
+    8: "mediumDashed",
+    9: "dashDot",
+    10: "mediumDashDot",
+    11: "dashDotDot",
+    12: "mediumDashDotDot",
+    13: "slantDashDot",
+}
+
+# xlsxwriter alignments -> SpreadsheetML alignments
+_horizontal_alignments = {
+    "center_across": "centerContinuous",
+    "centre": "center",
+}
+_vertical_alignments = {
+    "vcenter": "center",
+    "vcentre": "center",
+    "vjustify": "justify",
+    "vdistributed": "distributed",
+}
+
+_xml_escapes_re = re.compile("[&<>]")
+_control_chars_re = re.compile("[\x00-\x08\x0b-\x1f]")
+_control_escapes_re = re.compile("(_x[0-9a-fA-F]{4}_)")
+_whitespace_re = re.compile(r"^\s|\s$")
+
+# Excel's epoch, with 1900 treated as a leap year for dates after February 1900
+_epoch = dt.datetime(1899, 12, 31)
+_np_epoch = np.datetime64(_epoch, "ns")
+_ns_per_day = 24 * 60 * 60 * 1000000000
+
+
+def _escape(text):
+    """escape text for use in an XML element"""
+    if _xml_escapes_re.search(text):
+        text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return text
+
+
+def _escape_string(text):
+    """escape a cell string, including any control characters Excel can't store"""
+    if _control_chars_re.search(text):
+        text = _control_escapes_re.sub(r"_x005F\1", text)
+        text = _control_chars_re.sub(lambda m: "_x%04X_" % ord(m.group(0)), text)
+    return _escape(text)
+
+
+# format numbers are stored in, as used by Excel and xlsxwriter
+_number_format = "%.16G"
+
+
+def _format_number(value):
+    """format a number as it's stored in an xlsx file"""
+    return _number_format % value
+
+
+def _excel_datetime(value):
+    """convert a datetime, date, time or timedelta to an Excel serial date"""
+    if isinstance(value, dt.timedelta):
+        delta = value
+    else:
+        if isinstance(value, dt.datetime):
+            date_time = value
+        elif isinstance(value, dt.date):
+            date_time = dt.datetime.fromordinal(value.toordinal())
+        else:
+            date_time = dt.datetime.combine(_epoch, value)
+        delta = date_time - _epoch
+
+    serial = delta.days + (float(delta.seconds) + float(delta.microseconds) / 1e6) / (60 * 60 * 24)
+    if isinstance(value, dt.datetime) and value.isocalendar()[:3] == (1900, 1, 1):
+        serial -= 1
+    if not isinstance(value, dt.timedelta) and serial > 59:
+        serial += 1
+    return serial
+
+
+def _excel_datetimes(values):
+    """
+    convert an object array of datetimes or timedeltas without any NaT values
+    to Excel serial dates, returned as an array of floats.
+    """
+    if isinstance(values[0], dt.timedelta):
+        nanoseconds = pa.TimedeltaIndex(values).asi8
+        is_timedelta = True
+    else:
+        nanoseconds = (pa.DatetimeIndex(values).values - _np_epoch).astype(np.int64)
+        is_timedelta = False
+
+    # match the floating point operations of _excel_datetime
+    days, remainder = np.divmod(nanoseconds, _ns_per_day)
+    seconds, microseconds = np.divmod(remainder // 1000, 1000000)
+    serials = days + (seconds.astype(float) + microseconds.astype(float) / 1e6) / (60 * 60 * 24)
+    if not is_timedelta:
+        serials[days == 1] -= 1
+        serials[serials > 59] += 1
+    return serials
+
+
+class NativeXlsxWriter(object):
+    """
+    Writes an .xlsx file directly, streaming the worksheets into the zip file.
+
+    Worksheets are written one at a time using :py:meth:`add_worksheet`,
+    and the shared strings, styles and workbook parts are written when
+    the writer is closed.
+
+    :param filename: Filename or file object to write to.
+    :param str calc_mode: Calculation mode for the workbook ("auto", "manual" or
+                          "auto_except_tables").
+    :param bool calc_on_load: If True Excel recalculates all the formulas when the file is opened.
+    :param int compresslevel: zlib compression level for the zip file. The lowest level is
+                              used by default as compression is most of the time taken
+                              writing large sheets.
+    """
+    def __init__(self, filename, calc_mode="auto", calc_on_load=True, compresslevel=1):
+        self.__zip = zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+        self.__calc_mode = calc_mode
+        self.__calc_on_load = calc_on_load
+        self.__sheet_names = []
+
+        # shared strings as {string -> index}, in the order they were added
+        self.__strings = {}
+
+        # styles as {CellStyle -> xf index} and the components each xf is made of
+        self.__xf_indexes = {None: 0}
+        self.__xf_keys = {CellStyle().format_key: 0}
+        self.__xfs = [(0, 0, 0, 0, None)]
+        self.__num_formats = {}
+        self.__fonts = {(False, 11, None): 0}
+        self.__fills = {None: 0, "gray125": 1}
+        self.__borders = {None: 0}
+
+        # Excel tables as (sheet number, table XML), and the differential formats (dxfs)
+        # and custom table styles they use, with the styles as {key -> (name, XML)}
+        self.__tables = []
+        self.__dxfs = []
+        self.__table_styles = {}
+
+    def add_worksheet(self, name):
+        """
+        Add a worksheet to the file. The returned worksheet must be written
+        and closed before another is added.
+
+        :param str name: Worksheet name.
+        :return: :py:class:`NativeXlsxSheetWriter` to write the sheet with.
+        """
+        self.__sheet_names.append(name)
+        stream = self.__zip.open("xl/worksheets/sheet%d.xml" % len(self.__sheet_names), "w")
+        return NativeXlsxSheetWriter(self, stream, len(self.__sheet_names) == 1)
+
+    def add_table(self, ref, name, columns, table_style, show_first_column=False):
+        """
+        Add an Excel table to the worksheet being written.
+
+        :param str ref: Range of the table, including the header row.
+        :param str name: Name of the table, unique within the workbook.
+        :param list columns: Names of the table's columns, matching the header row.
+        :param xltable.TableStyle table_style: Style of the table. If it doesn't name a built-in
+            table style a custom table style is made from its stripe colors and border.
+        :param bool show_first_column: Use the table style's formatting for the first column.
+        :return: Relationship id of the table in the worksheet.
+        """
+        sheet_number = len(self.__sheet_names)
+        rel_id = 1 + sum(1 for number, _xml in self.__tables if number == sheet_number)
+        parts = ['<table xmlns="%s" id="%d" name=%s displayName=%s ref="%s" totalsRowShown="0">' % (
+                    _main_ns, len(self.__tables) + 1, quoteattr(name), quoteattr(name), ref),
+                 '<autoFilter ref="%s"/>' % ref,
+                 '<tableColumns count="%d">' % len(columns)]
+        for i, column in enumerate(columns, 1):
+            parts.append('<tableColumn id="%d" name=%s/>' % (i, quoteattr(column)))
+        parts.append("</tableColumns>")
+        parts.append('<tableStyleInfo name=%s showFirstColumn="%d" showLastColumn="0" '
+                     'showRowStripes="1" showColumnStripes="0"/></table>' % (
+                        quoteattr(self.__get_table_style_name(table_style)), 1 if show_first_column else 0))
+        self.__tables.append((sheet_number, "".join(parts)))
+        return "rId%d" % rel_id
+
+    def __get_table_style_name(self, table_style):
+        """return the name of the built-in or custom table style for a TableStyle"""
+        if table_style.excel_table_style is not None:
+            return table_style.excel_table_style.replace(" ", "")
+
+        border = table_style.border
+        if isinstance(border, dict):
+            border = frozenset(border.items())
+        elif border and not isinstance(border, frozenset):
+            border = frozenset((position, border) for position in ("left", "right", "top", "bottom"))
+        stripe_colors = tuple(table_style.stripe_colors or ())[:2]
+
+        key = (stripe_colors, border)
+        if key not in self.__table_styles:
+            elements = []
+            if border:
+                border_xml = "<border>%s</border>" % _get_table_border_xml(dict(border))
+                elements.append(("wholeTable", self.__add_dxf(border_xml)))
+            bold = self.__add_dxf("<font><b/></font>")
+            elements.append(("headerRow", bold))
+            elements.append(("firstColumn", bold))
+            for element, color in zip(("firstRowStripe", "secondRowStripe"), stripe_colors):
+                if color is not None:
+                    elements.append((element, self.get_fill_dxf_index(color)))
+
+            name = "xltable%d" % (len(self.__table_styles) + 1)
+            xml = ('<tableStyle name="%s" pivot="0" count="%d">' % (name, len(elements))
+                   + "".join('<tableStyleElement type="%s" dxfId="%d"/>' % x for x in elements)
+                   + "</tableStyle>")
+            self.__table_styles[key] = (name, xml)
+        return self.__table_styles[key][0]
+
+    def get_fill_dxf_index(self, bg_color):
+        """return the index of the differential format (dxf) for a background color"""
+        return self.__add_dxf('<fill><patternFill patternType="solid"><fgColor rgb="FF%06X"/>'
+                              '<bgColor rgb="FF%06X"/></patternFill></fill>' % (bg_color, bg_color))
+
+    def __add_dxf(self, xml):
+        """return the index of a differential format, adding it if it's new"""
+        xml = "<dxf>%s</dxf>" % xml
+        try:
+            return self.__dxfs.index(xml)
+        except ValueError:
+            self.__dxfs.append(xml)
+            return len(self.__dxfs) - 1
+
+    def get_string_index(self, string):
+        """return the shared string index for a string"""
+        try:
+            return self.__strings[string]
+        except KeyError:
+            index = self.__strings[string] = len(self.__strings)
+            return index
+
+    def get_xf_index(self, cell_style):
+        """return the index of the cell format (xf) for a CellStyle"""
+        try:
+            return self.__xf_indexes[cell_style]
+        except KeyError:
+            pass
+
+        # styles that only differ in ways that aren't written share a format
+        key = cell_style.format_key
+        if key not in self.__xf_keys:
+            num_format_id = 0
+            number_format = cell_style.excel_number_format
+            if number_format is not None and number_format != "General":
+                num_format_id = self.__num_formats.setdefault(number_format, 164 + len(self.__num_formats))
+
+            font = (bool(cell_style.bold), cell_style.size or 11, cell_style.text_color)
+            font_id = self.__fonts.setdefault(font, len(self.__fonts))
+
+            fill_id = 0
+            if cell_style.bg_color is not None:
+                fill_id = self.__fills.setdefault(cell_style.bg_color, len(self.__fills))
+
+            border_id = 0
+            if cell_style.border:
+                border = cell_style.border
+                if not isinstance(border, frozenset):
+                    border = frozenset((position, border) for position in ("left", "right", "top", "bottom"))
+                border_id = self.__borders.setdefault(border, len(self.__borders))
+
+            alignment = None
+            if cell_style.align or cell_style.valign or cell_style.text_wrap:
+                alignment = (cell_style.align, cell_style.valign, bool(cell_style.text_wrap))
+
+            self.__xf_keys[key] = len(self.__xfs)
+            self.__xfs.append((num_format_id, font_id, fill_id, border_id, alignment))
+
+        self.__xf_indexes[cell_style] = self.__xf_keys[key]
+        return self.__xf_indexes[cell_style]
+
+    def close(self):
+        """write the remaining parts of the workbook and close the zip file"""
+        try:
+            for i, (_sheet_number, xml) in enumerate(self.__tables, 1):
+                self.__write_part("xl/tables/table%d.xml" % i, xml)
+            for sheet_number in sorted(set(number for number, _xml in self.__tables)):
+                self.__write_part("xl/worksheets/_rels/sheet%d.xml.rels" % sheet_number,
+                                  self.__get_sheet_rels_xml(sheet_number))
+            self.__write_part("xl/sharedStrings.xml", self.__get_shared_strings_xml())
+            self.__write_part("xl/styles.xml", self.__get_styles_xml())
+            self.__write_part("xl/workbook.xml", self.__get_workbook_xml())
+            self.__write_part("xl/_rels/workbook.xml.rels", self.__get_workbook_rels_xml())
+            self.__write_part("_rels/.rels", self.__get_rels_xml())
+            self.__write_part("[Content_Types].xml", self.__get_content_types_xml())
+        finally:
+            self.__zip.close()
+
+    def __write_part(self, name, xml):
+        self.__zip.writestr(name, (_xml_header + xml).encode("utf-8"))
+
+    def __get_shared_strings_xml(self):
+        parts = ['<sst xmlns="%s" count="%d" uniqueCount="%d">' % (_main_ns, len(self.__strings), len(self.__strings))]
+        for string in self.__strings:
+            if _whitespace_re.search(string):
+                parts.append('<si><t xml:space="preserve">%s</t></si>' % _escape_string(string))
+            else:
+                parts.append("<si><t>%s</t></si>" % _escape_string(string))
+        parts.append("</sst>")
+        return "".join(parts)
+
+    def __get_styles_xml(self):
+        parts = ['<styleSheet xmlns="%s">' % _main_ns]
+
+        if self.__num_formats:
+            parts.append('<numFmts count="%d">' % len(self.__num_formats))
+            for number_format, num_format_id in self.__num_formats.items():
+                parts.append('<numFmt numFmtId="%d" formatCode=%s/>' % (num_format_id, quoteattr(number_format)))
+            parts.append("</numFmts>")
+
+        parts.append('<fonts count="%d">' % len(self.__fonts))
+        for bold, size, text_color in self.__fonts:
+            parts.append("<font>")
+            if bold:
+                parts.append("<b/>")
+            parts.append('<sz val="%s"/>' % _format_number(size))
+            if text_color is not None:
+                parts.append('<color rgb="FF%06X"/>' % text_color)
+            else:
+                parts.append('<color theme="1"/>')
+            parts.append('<name val="Calibri"/><family val="2"/><scheme val="minor"/></font>')
+        parts.append("</fonts>")
+
+        parts.append('<fills count="%d">' % len(self.__fills))
+        for bg_color in self.__fills:
+            if bg_color is None:
+                parts.append('<fill><patternFill patternType="none"/></fill>')
+            elif bg_color == "gray125":
+                parts.append('<fill><patternFill patternType="gray125"/></fill>')
+            else:
+                parts.append('<fill><patternFill patternType="solid">'
+                             '<fgColor rgb="FF%06X"/><bgColor indexed="64"/>'
+                             '</patternFill></fill>' % bg_color)
+        parts.append("</fills>")
+
+        parts.append('<borders count="%d">' % len(self.__borders))
+        for border in self.__borders:
+            border = dict(border or ())
+            parts.append("<border>")
+            for position in ("left", "right", "top", "bottom"):
+                style = _border_styles.get(border.get(position))
+                if style is None:
+                    parts.append("<%s/>" % position)
+                else:
+                    parts.append('<%s style="%s"><color auto="1"/></%s>' % (position, style, position))
+            parts.append("<diagonal/></border>")
+        parts.append("</borders>")
+
+        parts.append('<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>')
+
+        parts.append('<cellXfs count="%d">' % len(self.__xfs))
+        for num_format_id, font_id, fill_id, border_id, alignment in self.__xfs:
+            attrs = 'numFmtId="%d" fontId="%d" fillId="%d" borderId="%d" xfId="0"' % (
+                        num_format_id, font_id, fill_id, border_id)
+            if num_format_id:
+                attrs += ' applyNumberFormat="1"'
+            if font_id:
+                attrs += ' applyFont="1"'
+            if fill_id:
+                attrs += ' applyFill="1"'
+            if border_id:
+                attrs += ' applyBorder="1"'
+            if alignment is None:
+                parts.append("<xf %s/>" % attrs)
+                continue
+
+            align, valign, text_wrap = alignment
+            alignment_attrs = ""
+            if align:
+                alignment_attrs += ' horizontal="%s"' % _horizontal_alignments.get(align, align)
+            if valign:
+                alignment_attrs += ' vertical="%s"' % _vertical_alignments.get(valign, valign)
+            if text_wrap:
+                alignment_attrs += ' wrapText="1"'
+            parts.append('<xf %s applyAlignment="1"><alignment%s/></xf>' % (attrs, alignment_attrs))
+        parts.append("</cellXfs>")
+
+        parts.append('<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>')
+        parts.append('<dxfs count="%d">%s</dxfs>' % (len(self.__dxfs), "".join(self.__dxfs)))
+        parts.append('<tableStyles count="%d" defaultTableStyle="TableStyleMedium9" defaultPivotStyle="PivotStyleLight16">'
+                     % len(self.__table_styles))
+        parts.extend(xml for _name, xml in self.__table_styles.values())
+        parts.append('</tableStyles></styleSheet>')
+        return "".join(parts)
+
+    def __get_workbook_xml(self):
+        parts = ['<workbook xmlns="%s" xmlns:r="%s">' % (_main_ns, _rel_ns),
+                 '<bookViews><workbookView/></bookViews><sheets>']
+        for i, name in enumerate(self.__sheet_names, 1):
+            parts.append('<sheet name=%s sheetId="%d" r:id="rId%d"/>' % (quoteattr(name), i, i))
+        parts.append("</sheets>")
+
+        calc_pr = '<calcPr calcId="124519"'
+        if self.__calc_mode == "manual":
+            calc_pr += ' calcMode="manual" calcOnSave="0"'
+        elif self.__calc_mode == "auto_except_tables":
+            calc_pr += ' calcMode="autoNoTable"'
+        if self.__calc_on_load:
+            calc_pr += ' fullCalcOnLoad="1"'
+        parts.append(calc_pr + "/>")
+        parts.append("</workbook>")
+        return "".join(parts)
+
+    def __get_workbook_rels_xml(self):
+        num_sheets = len(self.__sheet_names)
+        parts = ['<Relationships xmlns="%s">' % _package_rel_ns]
+        for i in range(1, num_sheets + 1):
+            parts.append('<Relationship Id="rId%d" Type="%s" Target="worksheets/sheet%d.xml"/>' % (
+                            i, _worksheet_type, i))
+        parts.append('<Relationship Id="rId%d" Type="%s" Target="styles.xml"/>' % (num_sheets + 1, _styles_type))
+        parts.append('<Relationship Id="rId%d" Type="%s" Target="sharedStrings.xml"/>' % (
+                        num_sheets + 2, _shared_strings_type))
+        parts.append("</Relationships>")
+        return "".join(parts)
+
+    def __get_sheet_rels_xml(self, sheet_number):
+        parts = ['<Relationships xmlns="%s">' % _package_rel_ns]
+        table_numbers = [i for i, (number, _xml) in enumerate(self.__tables, 1) if number == sheet_number]
+        for rel_id, i in enumerate(table_numbers, 1):
+            parts.append('<Relationship Id="rId%d" Type="%s" Target="../tables/table%d.xml"/>' % (
+                            rel_id, _table_type, i))
+        parts.append("</Relationships>")
+        return "".join(parts)
+
+    def __get_rels_xml(self):
+        return ('<Relationships xmlns="%s">'
+                '<Relationship Id="rId1" Type="%s" Target="xl/workbook.xml"/>'
+                '</Relationships>') % (_package_rel_ns, _office_doc_type)
+
+    def __get_content_types_xml(self):
+        parts = ['<Types xmlns="%s">' % _content_types_ns,
+                 '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>',
+                 '<Default Extension="xml" ContentType="application/xml"/>',
+                 '<Override PartName="/xl/workbook.xml" ContentType="%ssheet.main+xml"/>' % _content_type_prefix]
+        for i in range(1, len(self.__sheet_names) + 1):
+            parts.append('<Override PartName="/xl/worksheets/sheet%d.xml" ContentType="%sworksheet+xml"/>' % (
+                            i, _content_type_prefix))
+        for i in range(1, len(self.__tables) + 1):
+            parts.append('<Override PartName="/xl/tables/table%d.xml" ContentType="%stable+xml"/>' % (
+                            i, _content_type_prefix))
+        parts.append('<Override PartName="/xl/styles.xml" ContentType="%sstyles+xml"/>' % _content_type_prefix)
+        parts.append('<Override PartName="/xl/sharedStrings.xml" ContentType="%ssharedStrings+xml"/>' % (
+                        _content_type_prefix))
+        parts.append("</Types>")
+        return "".join(parts)
+
+
+class NativeXlsxSheetWriter(object):
+    """
+    Writes a worksheet's XML to a stream a row at a time.
+
+    Call :py:meth:`open` before writing any rows, then :py:meth:`write_row`
+    for each row in order and finally :py:meth:`close`.
+
+    :param NativeXlsxWriter writer: Writer for the file the sheet is part of.
+    :param stream: Writable binary stream for the sheet's XML.
+    :param bool selected: True if this is the selected sheet.
+    """
+    def __init__(self, writer, stream, selected=False):
+        self.__writer = writer
+        self.__stream = stream
+        self.__selected = selected
+        self.__buffer = []
+        self.__letters = []
+        self.__style_layers = None
+        self.__nan_policy = "blank"
+        self.__formula_values = {}
+        self.__shared_formulas = None
+        self.__shared_by_col = {}       # {col -> (first row, last row, index)} of the last shared formula
+        self.__num_shared = 0
+        self.__row_attrs = {}
+        self.__plain_attrs = []
+        self.__table_rel_ids = []
+        self.__conditional_formats = []
+
+    @property
+    def writer(self):
+        """NativeXlsxWriter the sheet is being written to"""
+        return self.__writer
+
+    @property
+    def shared_formulas(self):
+        """Dictionary of the ranges of shared formulas passed to open, or None"""
+        return self.__shared_formulas
+
+    def open(self, height, width, style_layers, column_widths={}, outline_level=0,
+             nan_policy="blank", formula_values={}, shared_formulas=None):
+        """
+        Start writing the worksheet.
+
+        :param int height: Number of rows on the sheet.
+        :param int width: Number of columns on the sheet.
+        :param style_layers: Styles for the sheet (see Worksheet._get_style_layers).
+        :param dict column_widths: Dictionary of {col -> width}.
+        :param int outline_level: Maximum outline level of any row.
+        :param str nan_policy: How to write NaN values ("blank", "#N/A" or "zero").
+        :param dict formula_values: Dictionary of {(row, col) -> value} for formulas.
+        :param dict shared_formulas: Dictionary of {(first row, col) -> last row} for the
+            ranges of formulas to write as shared formulas, or None. Formulas in each range
+            must be the same apart from their relative row references. The dictionary may
+            be added to while the rows are written, up until the first row of a range.
+        """
+        assert nan_policy in _nan_policies, "Unknown nan policy '%s'." % nan_policy
+        self.__letters = _col_letters[:width]
+        self.__style_layers = style_layers
+        self.__nan_policy = nan_policy
+        self.__formula_values = formula_values
+        self.__shared_formulas = shared_formulas
+        self.__shared_by_col = {}
+        self.__num_shared = 0
+        self.__plain_attrs = [""] * width
+
+        parts = ['<worksheet xmlns="%s" xmlns:r="%s">' % (_main_ns, _rel_ns)]
+        if height and width:
+            parts.append('<dimension ref="A1:%s%d"/>' % (self.__letters[-1], height))
+        else:
+            parts.append('<dimension ref="A1"/>')
+        if self.__selected:
+            parts.append('<sheetViews><sheetView tabSelected="1" workbookViewId="0"/></sheetViews>')
+        else:
+            parts.append('<sheetViews><sheetView workbookViewId="0"/></sheetViews>')
+        if outline_level:
+            parts.append('<sheetFormatPr defaultRowHeight="15" outlineLevelRow="%d"/>' % outline_level)
+        else:
+            parts.append('<sheetFormatPr defaultRowHeight="15"/>')
+
+        if column_widths:
+            parts.append("<cols>")
+            for col in sorted(column_widths):
+                parts.append('<col min="%d" max="%d" width="%s" customWidth="1"/>' % (
+                                col + 1, col + 1, _format_number(_column_width(column_widths[col]))))
+            parts.append("</cols>")
+
+        parts.append("<sheetData>")
+        self.__buffer.append("".join(parts))
+
+    def add_table(self, first_row, first_col, last_row, last_col, name, columns, table_style,
+                  show_first_column=False):
+        """
+        Add an Excel table covering a range of the sheet (see NativeXlsxWriter.add_table).
+        The cells in the header row must be written with the names of the columns.
+        """
+        ref = "%s%d:%s%d" % (self.__letters[first_col], first_row + 1, self.__letters[last_col], last_row + 1)
+        self.__table_rel_ids.append(self.__writer.add_table(ref, name, columns, table_style, show_first_column))
+
+    def add_conditional_format(self, ranges, formula, bg_color):
+        """
+        Add a conditional format setting the background color of a set of ranges
+        of the sheet to where a formula is true.
+
+        :param list ranges: List of (top, left, bottom, right) for the ranges.
+        :param str formula: Formula, without a leading "=".
+        :param int bg_color: Background color as an RGB value.
+        """
+        sqref = " ".join("%s%d:%s%d" % (self.__letters[left], top + 1, self.__letters[right], bottom + 1)
+                         for top, left, bottom, right in ranges)
+        self.__conditional_formats.append(
+            '<conditionalFormatting sqref="%s"><cfRule type="expression" dxfId="%d" priority="%d">'
+            '<formula>%s</formula></cfRule></conditionalFormatting>' % (
+                sqref, self.__writer.get_fill_dxf_index(bg_color), len(self.__conditional_formats) + 1,
+                _escape(formula)))
+
+    def close(self):
+        """finish writing the worksheet and close its stream"""
+        try:
+            table_parts = ""
+            if self.__table_rel_ids:
+                table_parts = '<tableParts count="%d">%s</tableParts>' % (
+                    len(self.__table_rel_ids),
+                    "".join('<tablePart r:id="%s"/>' % rel_id for rel_id in self.__table_rel_ids))
+            self.__buffer.append('</sheetData>'
+                                 + "".join(self.__conditional_formats) +
+                                 '<pageMargins left="0.7" right="0.7" top="0.75" bottom="0.75" header="0.3" footer="0.3"/>'
+                                 + table_parts +
+                                 '</worksheet>')
+            self.__flush()
+        finally:
+            self.__stream.close()
+
+    def write_row(self, row, cells, level=0, hidden=False):
+        """
+        Write a row to the sheet. Rows must be written in order.
+
+        :param int row: Row number.
+        :param str cells: XML for the cells on the row, in column order.
+        :param int level: Outline level of the row.
+        :param bool hidden: True if the row is hidden.
+        """
+        if not cells and not level and not hidden:
+            return
+        attrs = ' r="%d"' % (row + 1)
+        if level:
+            attrs += ' outlineLevel="%d"' % level
+        if hidden:
+            attrs += ' hidden="1"'
+        self.__buffer.append("<row%s>%s</row>" % (attrs, cells))
+        if len(self.__buffer) >= _FLUSH_ROWS:
+            self.__flush()
+
+    def __flush(self):
+        self.__stream.write("".join(self.__buffer).encode("utf-8"))
+        self.__buffer = []
+
+    def get_letter(self, col):
+        """return the column letters for a column"""
+        return self.__letters[col]
+
+    def get_row_attrs(self, row):
+        """return a list of the style attribute for each column on a row"""
+        if row >= self.__style_layers.height:
+            return self.__plain_attrs
+        cell_styles = self.__style_layers.get_row(row)
+        try:
+            return self.__row_attrs[id(cell_styles)][1]
+        except KeyError:
+            pass
+        get_xf_index = self.__writer.get_xf_index
+        attrs = list(self.__plain_attrs)
+        for c, cell_style in enumerate(cell_styles):
+            xf_index = get_xf_index(cell_style)
+            if xf_index:
+                attrs[c] = ' s="%d"' % xf_index
+
+        # the styles are kept with the attributes so their id isn't reused
+        self.__row_attrs[id(cell_styles)] = (cell_styles, attrs)
+        return attrs
+
+    def get_cell(self, row, col, value, attrs):
+        """
+        return the XML for a single cell of any type.
+
+        :param int row: Row of the cell.
+        :param int col: Column of the cell.
+        :param value: Value to write.
+        :param str attrs: Style attribute for the cell.
+        """
+        ref = self.__letters[col] + str(row + 1)
+        if value is None:
+            return '<c r="%s"%s/>' % (ref, attrs) if attrs else ""
+        if isinstance(value, str):
+            if value.startswith("="):
+                if self.__shared_formulas is not None:
+                    return self.get_shared_formula_cell(row, col, attrs, value)
+                return self.get_formula_cell(ref, attrs, value, self.__formula_values.get((row, col), 0))
+            if value.startswith("{="):
+                return self.get_array_formula_cell(ref, ref, attrs, value, self.__formula_values.get((row, col), 0))
+            if not value:
+                return '<c r="%s"%s/>' % (ref, attrs) if attrs else ""
+            return '<c r="%s"%s t="s"><v>%d</v></c>' % (ref, attrs, self.__writer.get_string_index(value))
+        if isinstance(value, (bool, np.bool_)):
+            return '<c r="%s"%s t="b"><v>%d</v></c>' % (ref, attrs, 1 if value else 0)
+        if value is pa.NaT:
+            return self.get_nan_cell(ref, attrs)
+        if isinstance(value, numbers.Real):
+            if not np.isfinite(value):
+                return self.get_nan_cell(ref, attrs)
+            return '<c r="%s"%s><v>%s</v></c>' % (ref, attrs, _format_number(value))
+        if isinstance(value, (dt.datetime, dt.time)) and value.tzinfo is not None:
+            return self.get_cell(row, col, str(value), attrs)
+        if isinstance(value, (dt.date, dt.time, dt.timedelta)):
+            return '<c r="%s"%s><v>%s</v></c>' % (ref, attrs, _format_number(_excel_datetime(value)))
+        return self.get_cell(row, col, str(value), attrs)
+
+    def get_nan_cell(self, ref, attrs):
+        """return the XML for a NaN value in a cell according to the nan policy"""
+        if self.__nan_policy == "#N/A":
+            return '<c r="%s"%s t="e"><f>NA()</f><v>#N/A</v></c>' % (ref, attrs)
+        if self.__nan_policy == "zero":
+            return '<c r="%s"%s><v>0</v></c>' % (ref, attrs)
+        return '<c r="%s"%s/>' % (ref, attrs) if attrs else ""
+
+    def get_formula_cell(self, ref, attrs, formula, value=0):
+        """return the XML for a cell containing a formula, with its cached value"""
+        value_type, value = _get_formula_value(value)
+        return '<c r="%s"%s%s><f>%s</f><v>%s</v></c>' % (ref, attrs, value_type, _escape(formula[1:]), value)
+
+    def get_shared_formula_cell(self, row, col, attrs, formula):
+        """
+        return the XML for a cell containing a formula, with its cached value, as part
+        of a shared formula if the cell is in one of the shared formula ranges.
+        The first cell of a range holds the formula and the others refer to it.
+        """
+        ref = self.__letters[col] + str(row + 1)
+        value_type, value = _get_formula_value(self.__formula_values.get((row, col), 0))
+        shared = self.__shared_by_col.get(col)
+        if shared is not None and shared[0] < row <= shared[1]:
+            return '<c r="%s"%s%s><f t="shared" si="%d"/><v>%s</v></c>' % (ref, attrs, value_type, shared[2], value)
+
+        last_row = self.__shared_formulas.get((row, col))
+        if last_row is None:
+            return '<c r="%s"%s%s><f>%s</f><v>%s</v></c>' % (ref, attrs, value_type, _escape(formula[1:]), value)
+
+        index = self.__num_shared
+        self.__num_shared += 1
+        self.__shared_by_col[col] = (row, last_row, index)
+        return '<c r="%s"%s%s><f t="shared" ref="%s:%s%d" si="%d">%s</f><v>%s</v></c>' % (
+                    ref, attrs, value_type, ref, self.__letters[col], last_row + 1, index,
+                    _escape(formula[1:]), value)
+
+    def get_array_formula_cell(self, ref, range_ref, attrs, formula, value=0):
+        """return the XML for the top left cell of an array formula, with its cached value"""
+        formula = formula.lstrip("{").rstrip("}").lstrip("=")
+        value_type, value = _get_formula_value(value)
+        return '<c r="%s"%s%s><f t="array" ref="%s">%s</f><v>%s</v></c>' % (
+                    ref, attrs, value_type, range_ref, _escape(formula), value)
+
+
+def _get_formula_value(value):
+    """return (type attribute, value) for the cached value of a formula"""
+    if value is None:
+        return "", "0"
+    if isinstance(value, (bool, np.bool_)):
+        return ' t="b"', "1" if value else "0"
+    if isinstance(value, numbers.Real):
+        return "", _format_number(value)
+    value = str(value)
+    if value in _error_codes:
+        return ' t="e"', value
+    if not value:
+        return "", ""
+    return ' t="str"', _escape_string(value)
+
+
+def _get_table_border_xml(border):
+    """
+    return the XML for a table style's border, from a dictionary of {position -> xlsxwriter
+    border style}, with the lines between the cells the same as the edges of the cells.
+    """
+    styles = {position: _border_styles.get(style) for position, style in border.items()}
+    styles["vertical"] = styles.get("left") or styles.get("right")
+    styles["horizontal"] = styles.get("top") or styles.get("bottom")
+    parts = []
+    for position in ("left", "right", "top", "bottom", "vertical", "horizontal"):
+        style = styles.get(position)
+        if style is None:
+            parts.append("<%s/>" % position)
+        else:
+            parts.append('<%s style="%s"><color auto="1"/></%s>' % (position, style, position))
+    return "".join(parts)
+
+
+def _column_width(width):
+    """convert a column width in characters to the width stored in the file, as Excel does"""
+    max_digit_width = 7
+    padding = 5
+    if width < 1:
+        return int(int(width * (max_digit_width + padding) + 0.5) / float(max_digit_width) * 256.0) / 256.0
+    return int((int(width * max_digit_width + 0.5) + padding) / float(max_digit_width) * 256.0) / 256.0
+
+
+class NativeTableWriter(object):
+    """
+    Formats the rows of a table's resolved data as SpreadsheetML cells.
+
+    The body of the table is formatted a column at a time, in chunks of rows,
+    using the kind of each column (see xltable.worksheet._get_column_kinds).
+    Headers, the index and any columns with mixed types are formatted cell
+    by cell. Rows of tables where every column is numeric are formatted
+    using a template for the whole row.
+
+    :param NativeXlsxSheetWriter sheet: Sheet the table is being written to.
+    :param xltable.Table table: Table being written.
+    :param int top: Row the table starts on.
+    :param int left: Column the table starts on.
+    :param data: 2d object array from Table.get_data.
+    :param dict formula_values: Dictionary of {(row, col) -> value} for formulas.
+    """
+    def __init__(self, sheet, table, top, left, data, formula_values):
+        self.__sheet = sheet
+        self.__top = top
+        self.__left = left
+        self.__data = data
+        self.__formula_values = formula_values
+        self.__header_height = table.header_height
+        self.__row_labels_width = table.row_labels_width
+        self.__kinds, self.__nan_mask = _get_column_kinds(table, data)
+        self.__nan_rows = self.__nan_mask.any(axis=1)
+        self.__is_numeric = all(kind == _NUMBER for kind in self.__kinds)
+        self.__templates = {}
+        self.__chunk_start = None
+        self.__chunk = []
+
+    def get_row(self, row):
+        """return the XML for the cells of the table on a row"""
+        i = row - self.__top
+        if i < self.__header_height:
+            return "".join(self.__get_generic_cells(row, 0, self.__data.shape[1]))
+
+        b = i - self.__header_height
+        if self.__chunk_start is None or not (self.__chunk_start <= b < self.__chunk_start + len(self.__chunk)):
+            self.__chunk_start = b
+            end = min(b + _CHUNK_SIZE, self.__nan_mask.shape[0])
+            if self.__is_numeric:
+                self.__chunk = self.__get_numeric_chunk(b, end)
+            else:
+                self.__chunk = ["".join(cells) for cells in self.__get_chunk(b, end)]
+        return self.__chunk[b - self.__chunk_start]
+
+    def get_cells(self, row):
+        """
+        return a list of the XML for each cell of the table on a row,
+        with an empty string for any cells with nothing to write.
+        """
+        i = row - self.__top
+        if i < self.__header_height:
+            return self.__get_generic_cells(row, 0, self.__data.shape[1])
+        b = i - self.__header_height
+        return self.__get_chunk(b, b + 1)[0]
+
+    def __get_numeric_chunk(self, start, end):
+        """return the XML for each row of the body from start to end, where all columns are numeric"""
+        sheet = self.__sheet
+        header_height = self.__header_height
+        labels_width = self.__row_labels_width
+        num_cols = len(self.__kinds)
+        top = self.__top + header_height
+        body = self.__data[header_height + start:header_height + end, labels_width:].tolist()
+
+        labels = None
+        if labels_width:
+            labels = ["".join(sheet.get_cell(top + b, self.__left + j, value, sheet.get_row_attrs(top + b)[self.__left + j])
+                              for j, value in enumerate(self.__data[header_height + b, :labels_width].tolist()))
+                      for b in range(start, end)]
+
+        rows = []
+        for b, values in zip(range(start, end), body):
+            row = top + b
+            if self.__nan_rows[b]:
+                cells = self.__get_chunk(b, b + 1)[0]
+                rows.append("".join(cells))
+                continue
+
+            attrs = sheet.get_row_attrs(row)
+            template = self.__templates.get(id(attrs))
+            if template is None:
+                template = self.__templates[id(attrs)] = self.__get_template(attrs)
+            args = [str(row + 1)] * (2 * num_cols)
+            args[1::2] = values
+            cells = template % tuple(args)
+            rows.append(labels[b - start] + cells if labels else cells)
+        return rows
+
+    def __get_template(self, attrs):
+        """return a format string for the numeric body of a row, taking (row, value) for each cell"""
+        sheet = self.__sheet
+        left = self.__left + self.__row_labels_width
+        return "".join('<c r="' + sheet.get_letter(col) + '%s"' + attrs[col] + "><v>" + _number_format + "</v></c>"
+                       for col in range(left, left + len(self.__kinds)))
+
+    def __get_generic_cells(self, row, start, end):
+        """return the XML for a range of cells on a row, checking the type of each one"""
+        sheet = self.__sheet
+        values = self.__data[row - self.__top, start:end].tolist()
+        attrs = sheet.get_row_attrs(row)
+        left = self.__left + start
+        return [sheet.get_cell(row, col, value, attrs[col]) for col, value in enumerate(values, left)]
+
+    def __get_chunk(self, start, end):
+        """return a list of the cells for each row of the body from start to end"""
+        sheet = self.__sheet
+        header_height = self.__header_height
+        labels_width = self.__row_labels_width
+        rows = range(self.__top + header_height + start, self.__top + header_height + end)
+        row_refs = [str(row + 1) + '"' for row in rows]
+        row_attrs = [sheet.get_row_attrs(row) for row in rows]
+
+        columns = []
+        for j in range(labels_width):
+            col = self.__left + j
+            values = self.__data[header_height + start:header_height + end, j].tolist()
+            columns.append([sheet.get_cell(row, col, value, attrs[col])
+                            for row, value, attrs in zip(rows, values, row_attrs)])
+
+        for j, kind in enumerate(self.__kinds):
+            col = self.__left + labels_width + j
+            values = self.__data[header_height + start:header_height + end, labels_width + j]
+            nan_mask = self.__nan_mask[start:end, j]
+            col_attrs = [attrs[col] for attrs in row_attrs]
+            prefix = '<c r="' + sheet.get_letter(col)
+
+            if nan_mask.any():
+                values = values.copy()
+                values[nan_mask] = 0
+
+            if kind == _NUMBER:
+                cells = [prefix + ref + attrs + "><v>" + value + "</v></c>"
+                         for ref, attrs, value in zip(row_refs, col_attrs, map(_number_format.__mod__, values.tolist()))]
+            elif kind == _BOOL:
+                cells = [prefix + ref + attrs + (' t="b"><v>1</v></c>' if value else ' t="b"><v>0</v></c>')
+                         for ref, attrs, value in zip(row_refs, col_attrs, values.tolist())]
+            elif kind == _DATETIME:
+                if nan_mask.all():
+                    serials = ["0"] * len(values)
+                else:
+                    if nan_mask.any():
+                        values[nan_mask] = values[~nan_mask][0]
+                    serials = map(_number_format.__mod__, _excel_datetimes(values).tolist())
+                cells = [prefix + ref + attrs + "><v>" + value + "</v></c>"
+                         for ref, attrs, value in zip(row_refs, col_attrs, serials)]
+            elif kind == _STRING:
+                get_string_index = sheet.writer.get_string_index
+                cells = [prefix + ref + attrs + ' t="s"><v>' + str(get_string_index(value)) + "</v></c>"
+                         for ref, attrs, value in zip(row_refs, col_attrs, values.tolist())]
+            elif kind == _FORMULA and sheet.shared_formulas is not None:
+                cells = [sheet.get_shared_formula_cell(row, col, attrs, value)
+                         for row, attrs, value in zip(rows, col_attrs, values.tolist())]
+            elif kind == _FORMULA:
+                formula_values = self.__formula_values
+                letter = sheet.get_letter(col)
+                cells = [sheet.get_formula_cell(letter + str(row + 1), attrs, value,
+                                                formula_values.get((row, col), 0))
+                         for row, attrs, value in zip(rows, col_attrs, values.tolist())]
+            else:
+                cells = [sheet.get_cell(row, col, value, attrs)
+                         for row, attrs, value in zip(rows, col_attrs, values.tolist())]
+
+            for k in np.flatnonzero(nan_mask):
+                cells[k] = sheet.get_nan_cell(sheet.get_letter(col) + str(rows[k] + 1), col_attrs[k])
+
+            columns.append(cells)
+
+        return [list(cells) for cells in zip(*columns)]
@@ -3,7 +3,7 @@ Style objects are used when constructing Table instances
 to direct how the tables and cells in the tables will be
 written to Excel.
 """
-from weakref import WeakKeyDictionary
+from weakref import WeakValueDictionary
 
 
 class TableStyle(object):
@@ -11,16 +11,29 @@ class TableStyle(object):
     Style to be applied to a table.
 
     :param tuple stripe_colors: Background cell colors to use as RGB values, e.g. 0xFF0000 for red.
+    :param bool excel_table: Write the table as an Excel table (ListObject), styled by a table style
+        instead of formatting each cell. Column, row and cell styles are still applied on top.
+        Only tables with a single header row can be written as Excel tables.
+    :param str excel_table_style: Name of a built-in Excel table style to use, e.g. "Table Style Medium 2",
+        which implies excel_table. If not set a custom table style is made from the stripe colors (only
+        the first two are used) and border, which requires the native engine. Otherwise the cells are
+        formatted individually underneath an unstyled Excel table.
     """
-    def __init__(self, stripe_colors=(0xEAF1FA, 0xFFFFFF), border=None):
+    def __init__(self, stripe_colors=(0xEAF1FA, 0xFFFFFF), border=None, excel_table=False, excel_table_style=None):
         self.stripe_colors = stripe_colors
         self.border = border
+        self.excel_table = excel_table or excel_table_style is not None
+        self.excel_table_style = excel_table_style
 
 
 class CellStyle(object):
     """
     Style to be applied to a cell or range of cells.
 
+    CellStyle instances are immutable and are shared between all styles with the
+    same settings, so constructing a style that already exists returns the existing
+    instance.
+
     :param bool is_percentage: True if the cell value is a percentage.
     :param int decimal_places: Number of decimal places to display the cell value to.
     :param str date_format: Format to use for date values (use Python date format, e.g. '%Y-%m-%d').
@@ -43,41 +56,141 @@ class CellStyle(object):
         "xx-large": 24
     }
 
-    def __init__(self,
-                 is_percentage=None,
-                 decimal_places=None,
-                 date_format=None,
-                 thousands_sep=None,
-                 excel_number_format=None,
-                 bold=None,
-                 size=None,
-                 text_color=None,
-                 bg_color=None,
-                 text_wrap=None,
-                 border=None,
-                 align=None,
-                 valign=None):
-        self.__derived_styles = WeakKeyDictionary()
-        self.is_percentage = is_percentage
-        self.decimal_places = decimal_places
-        self.date_format = date_format
-        self.thousands_sep = thousands_sep
-        self.__excel_number_format = excel_number_format
-        self.bold = bold
+    __slots__ = (
+        "is_percentage",
+        "decimal_places",
+        "date_format",
+        "thousands_sep",
+        "bold",
+        "size",
+        "text_color",
+        "bg_color",
+        "text_wrap",
+        "border",
+        "align",
+        "valign",
+        "__excel_number_format",
+        "__number_format",
+        "__args",
+        "__format_key",
+        "__hash",
+        "__weakref__",
+    )
+
+    __arg_names = (
+        "is_percentage",
+        "decimal_places",
+        "date_format",
+        "thousands_sep",
+        "_CellStyle__excel_number_format",
+        "bold",
+        "size",
+        "text_color",
+        "bg_color",
+        "text_wrap",
+        "border",
+        "align",
+        "valign",
+    )
+
+    # all styles by their settings, so each distinct style is only created once
+    __instances = WeakValueDictionary()
+
+    def __new__(cls,
+                is_percentage=None,
+                decimal_places=None,
+                date_format=None,
+                thousands_sep=None,
+                excel_number_format=None,
+                bold=None,
+                size=None,
+                text_color=None,
+                bg_color=None,
+                text_wrap=None,
+                border=None,
+                align=None,
+                valign=None):
         if isinstance(size, str):
-            size = self._sizes[size]
-        self.size = size
-        self.text_color = text_color
-        self.bg_color = bg_color
-        self.text_wrap = text_wrap
+            size = cls._sizes[size]
         if isinstance(border, dict):
             border = frozenset(border.items())
-        self.border = border
-        self.align = align
-        self.valign = valign
+
+        args = (is_percentage,
+                decimal_places,
+                date_format,
+                thousands_sep,
+                excel_number_format,
+                bold,
+                size,
+                text_color,
+                bg_color,
+                text_wrap,
+                border,
+                align,
+                valign)
+
+        key = (cls, args)
+        try:
+            return cls.__instances[key]
+        except KeyError:
+            pass
+
+        self = object.__new__(cls)
+        for name, value in zip(cls.__arg_names, args):
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, "_CellStyle__args", args)
+        object.__setattr__(self, "_CellStyle__hash", hash(key))
+        object.__setattr__(self, "_CellStyle__number_format", self.__get_number_format())
+        object.__setattr__(self, "_CellStyle__format_key", (bold,
+                                                             self.__number_format,
+                                                             text_color,
+                                                             bg_color,
+                                                             size,
+                                                             text_wrap,
+                                                             border,
+                                                             align,
+                                                             valign))
+        return cls.__instances.setdefault(key, self)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CellStyle instances are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("CellStyle instances are immutable")
+
+    def __reduce__(self):
+        return (self.__class__, self.__args)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, CellStyle):
+            return NotImplemented
+        return self.__class__ is other.__class__ and self.__args == other.__args
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return self.__hash
+
+    def __repr__(self):
+        args = ("%s=%r" % (name.split("__")[-1], value)
+                for name, value in zip(self.__arg_names, self.__args)
+                if value is not None)
+        return "CellStyle(%s)" % ", ".join(args)
 
     @property
     def excel_number_format(self):
+        return self.__number_format
+
+    @property
+    def format_key(self):
+        """Tuple of the settings that affect how the style is written, for sharing formats between styles"""
+        return self.__format_key
+
+    def __get_number_format(self):
         number_format = "0"
         if self.__excel_number_format is not None:
             number_format = self.__excel_number_format
@@ -109,8 +222,9 @@ class CellStyle(object):
 
     def __add__(self, other):
         """Apply a style on top of this one and return the new style"""
+        key = (id(self), id(other))
         try:
-            return self.__derived_styles[other]
+            return _compositions[key][2]
         except KeyError:
             pass
 
@@ -133,5 +247,14 @@ class CellStyle(object):
             align=_if_none(other.align, self.align),
             valign=_if_none(other.valign, self.valign))
 
-        self.__derived_styles[other] = style
+        # The cached entry keeps both styles alive so their ids can't be reused
+        # while they're in the cache.
+        if len(_compositions) >= _max_compositions:
+            _compositions.clear()
+        _compositions[key] = (self, other, style)
         return style
+
+
+# results of CellStyle.__add__ keyed by the ids of the two styles
+_compositions = {}
+_max_compositions = 10000
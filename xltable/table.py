@@ -2,10 +2,14 @@
 Table class for building structured worksheets from multiple blocks of
 related data.
 """
-from .expression import Expression
+from .expression import Expression, FormulaEvaluator
 from .style import TableStyle, CellStyle
-from functools import partial
+import numpy as np
 import pandas as pa
+import hashlib
+import logging
+
+_log = logging.getLogger(__name__)
 
 
 class Value(object):
@@ -34,15 +38,19 @@ class Table(object):
     :param pandas.DataFrame dataframe: Dataframe containing the data for the table.
     :param bool include_columns: Include the column names when outputting.
     :param bool include_index: Include the index when outputting.
-    :param xltable.TableStyle style: Table style, or one of the named styles 'default' or 'plain'.
+    :param xltable.TableStyle style: Table style, or one of the named styles 'default', 'plain' or 'excel'.
     :param xltable.CellStyle column_styles: Dictionary of column names to styles or named styles.
     :param dict column_widths: Dictionary of column names to widths.
     :param xltable.CellStyle header_style: Style or named style to use for the cells in the header row.
     :param xltable.CellStyle index_style: Style or named style to use for the cells in the index column.
+    :param dict formula_columns: Dictionary of column names to :py:class:`xltable.Expression` instances.
+        Each expression is added as a column after the dataframe columns and is resolved for every row,
+        without needing a column of expressions in the dataframe.
 
     Named table styles:
         - default: blue stripes
         - plain: no style
+        - excel: blue stripes, written as an Excel table
 
     Named cell styles:
         - pct: pecentage with two decimal places.
@@ -52,7 +60,8 @@ class Table(object):
     """
     _styles = {
         "default": TableStyle(),
-        "plain": TableStyle(stripe_colors=None)
+        "plain": TableStyle(stripe_colors=None),
+        "excel": TableStyle(excel_table=True)
     }
 
     _named_styles = {
@@ -72,10 +81,20 @@ class Table(object):
                  column_widths={},
                  row_styles={},
                  header_style=None,
-                 index_style=None):
+                 index_style=None,
+                 formula_columns={}):
         self.__name = name
         self.__df = dataframe
+        self.__formula_columns = dict(formula_columns)
+        for colname in self.__formula_columns:
+            assert colname not in dataframe.columns, \
+                "Formula column '%s' is already in the dataframe for table %s" % (colname, name)
         self.__position = None
+        self.__version = 0
+        self.__fast_path_columns = 0
+        self.__cell_style_index = None
+        self.__column_offsets = None
+        self.__row_offsets = None
         self.__include_columns = include_columns
         self.__include_index = include_index
         self.__column_widths = column_widths
@@ -102,6 +121,10 @@ class Table(object):
         self.header_style = header_style
         self.index_style = index_style
 
+        if self.__style is not None and self.__style.excel_table and not self.is_excel_table:
+            _log.warning("Table '%s' will be written as a range instead of an Excel table "
+                         "as it doesn't have a single header row", name)
+
     def clone(self, **kwargs):
         """Create a clone of the Table, optionally with some properties changed"""
         init_kwargs = {
@@ -114,7 +137,8 @@ class Table(object):
             "column_widths": self.__column_widths,
             "row_styles": self.__row_styles,
             "header_style": self.header_style,
-            "index_style": self.index_style
+            "index_style": self.index_style,
+            "formula_columns": self.__formula_columns
         }
         init_kwargs.update(kwargs)
         return self.__class__(**init_kwargs)
@@ -127,10 +151,115 @@ class Table(object):
     def dataframe(self):
         return self.__df
 
+    @dataframe.setter
+    def dataframe(self, dataframe):
+        self.__df = dataframe
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Discard anything cached from the dataframe.
+        Must be called if the dataframe is modified in place.
+        """
+        self.__cell_style_index = None
+        self.__column_offsets = None
+        self.__row_offsets = None
+        self.__version += 1
+
+    def get_fingerprint(self, contents=True):
+        """
+        :return: hashable fingerprint of the table, which changes when the table is
+                 invalidated or given a new dataframe (see Workbook.set_incremental).
+        :param bool contents: Include a hash of the dataframe's contents (using
+            pandas.util.hash_pandas_object), so that changes made to the dataframe in place
+            change the fingerprint without the table being invalidated. Values and expressions
+            are hashed by identity, so changes to them aren't detected.
+        """
+        df = self.dataframe
+        fingerprint = (self.__version, id(df), df.shape)
+        if contents:
+            hashes = pa.util.hash_pandas_object(df, index=True, categorize=False).values
+            fingerprint += (hashlib.blake2b(hashes.tobytes(), digest_size=16).digest(),
+                            tuple(map(str, df.columns)),
+                            tuple(map(str, df.dtypes)))
+        return fingerprint
+
+    def get_referenced_tables(self):
+        """
+        :return: set of the names of the other tables referred to by the table's expressions,
+                 or None if any of the expressions can't tell which tables they refer to.
+        """
+        names = set()
+        for expr in self._iter_expressions():
+            expr_names = expr._get_table_names()
+            if expr_names is None:
+                return None
+            names |= expr_names
+        names.discard(None)
+        names.discard(self.name)
+        return names
+
+    def _iter_expressions(self):
+        """
+        Yield each distinct expression in the table's formula columns and dataframe.
+        Equal expressions (see _get_group_key) are only yielded once.
+        """
+        exprs = list(self.__formula_columns.values())
+        df = self.dataframe
+        for c, dtype in enumerate(df.dtypes):
+            if dtype == object:
+                exprs.extend(x.value if isinstance(x, Value) else x for x in df.iloc[:, c].values
+                             if isinstance(x, (Value, Expression)))
+        seen = set()
+        for expr in exprs:
+            if not isinstance(expr, Expression):
+                continue
+            key = _get_group_key(expr)
+            if key not in seen:
+                seen.add(key)
+                yield expr
+
+    @property
+    def columns(self):
+        """All column labels, including any formula columns"""
+        columns = self.dataframe.columns
+        if self.__formula_columns:
+            if isinstance(columns, pa.MultiIndex):
+                extra_columns = pa.MultiIndex.from_tuples(list(self.__formula_columns.keys()))
+            else:
+                extra_columns = pa.Index(list(self.__formula_columns.keys()), dtype=object)
+            columns = columns.append(extra_columns)
+        return columns
+
+    @property
+    def formula_columns(self):
+        return self.__formula_columns
+
     @property
     def style(self):
         return self.__style
 
+    @property
+    def is_excel_table(self):
+        """True if the table is written as an Excel table (see :py:class:`xltable.TableStyle`)"""
+        return self.__style is not None and self.__style.excel_table and self.header_height == 1
+
+    def get_excel_column_names(self):
+        """
+        :return: list of the names of the columns (including the index) when written as an
+                 Excel table, which are the header labels made into unique non-empty strings.
+        """
+        index_names = list(self.dataframe.index.names) if self.__include_index else []
+        names, seen = [], set()
+        for i, label in enumerate(index_names + list(self.columns), 1):
+            name = str(label) if label is not None and label != "" else "Column%d" % i
+            unique, n = name, 2
+            while unique.lower() in seen:
+                unique, n = "%s%d" % (name, n), n + 1
+            seen.add(unique.lower())
+            names.append(unique)
+        return names
+
     @property
     def column_styles(self):
         return self.__col_styles
@@ -146,29 +275,77 @@ class Table(object):
     @property
     def cell_styles(self):
         """dict of {(row name, col name): style}"""
-        styles = {}
-        for colname, col in self.dataframe.items():
-            for rowname, value in col.items():
-                if isinstance(value, Value) and value.style is not None:
-                    style = value.style
+        rows, cols, styles = self._get_cell_style_index()
+        index, columns = self.dataframe.index, self.dataframe.columns
+        return {(index[r], columns[c]): style for r, c, style in zip(rows, cols, styles)}
+
+    @property
+    def has_cell_styles(self):
+        """True if any cells in the dataframe are Values with a style"""
+        rows, cols, styles = self._get_cell_style_index()
+        return len(styles) > 0
+
+    def get_cell_style_offsets(self):
+        """
+        :return: list of (row offset, column offset, style) for each cell in the dataframe that
+                 is a Value with a style, with the offsets from the top left of the table.
+        """
+        rows, cols, styles = self._get_cell_style_index()
+        return list(zip((rows + self.header_height).tolist(),
+                        (cols + self.row_labels_width).tolist(),
+                        styles))
+
+    def _get_cell_style_index(self):
+        """
+        Return the (row positions, column positions, styles) of the styled Value instances
+        in the dataframe. Only object columns are scanned, and the result is kept until the
+        table is invalidated.
+        """
+        if self.__cell_style_index is None:
+            rows, cols, styles = [], [], []
+            for c, dtype in enumerate(self.dataframe.dtypes):
+                if dtype != object:
+                    continue
+                values = self.dataframe.iloc[:, c].values
+                is_styled = np.fromiter((isinstance(x, Value) and x.style is not None for x in values),
+                                        dtype=bool,
+                                        count=len(values))
+                for r in np.flatnonzero(is_styled):
+                    style = values[r].style
                     if not isinstance(style, CellStyle):
                         style = self._named_styles[style]
-                    styles[(rowname, colname)] = style
-        return styles
+                    rows.append(r)
+                    cols.append(c)
+                    styles.append(style)
+            self.__cell_style_index = (np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp), styles)
+        return self.__cell_style_index
+
+    @property
+    def fast_path_columns(self):
+        """
+        Number of columns in the dataframe that didn't need to be scanned for
+        Values or Expressions the last time :py:meth:`get_data` was called.
+        """
+        return self.__fast_path_columns
 
     @property
     def width(self):
-        return len(self.dataframe.columns) + self.row_labels_width
+        return len(self.columns) + self.row_labels_width
 
     @property
     def height(self):
         return len(self.dataframe.index) + self.header_height
 
+    @property
+    def height_known(self):
+        """False if the number of rows in the table isn't known until its data has been read"""
+        return True
+
     @property
     def header_height(self):
         if self.__include_columns:
-            if isinstance(self.dataframe.columns, pa.MultiIndex):
-                return len(self.dataframe.columns.names)
+            if isinstance(self.columns, pa.MultiIndex):
+                return len(self.columns.names)
             return 1
         return 0
 
@@ -181,12 +358,25 @@ class Table(object):
         return 0
 
     def get_column_offset(self, col):
+        """
+        :return: Offset of the column from the left of the table. If the label matches more
+                 than one column (e.g. a non-unique or partial MultiIndex label) a range, or a
+                 list if the columns aren't contiguous, of offsets is returned instead.
+        """
         try:
-            offset = self.dataframe.columns.get_loc(col)
+            return self._get_column_offset_map().get_offset(col)
         except KeyError:
             raise KeyError("Column '%s' not found in table %s" % (col, self.name))
-        offset += self.row_labels_width
-        return offset
+
+    def get_column_offsets(self, cols):
+        """
+        :return: List of offsets for the column labels in `cols`
+                 (see :py:meth:`get_column_offset`).
+        """
+        try:
+            return self._get_column_offset_map().get_offsets(cols)
+        except KeyError as e:
+            raise KeyError("Column '%s' not found in table %s" % (e.args[0], self.name))
 
     def get_index_offset(self):
         if self.__include_index:
@@ -194,14 +384,37 @@ class Table(object):
         raise KeyError("Table '%s' has no index" % self.name)
 
     def get_row_offset(self, row):
+        """
+        :return: Offset of the row from the top of the table. If the label matches more
+                 than one row (e.g. a non-unique or partial MultiIndex label) a range, or a
+                 list if the rows aren't contiguous, of offsets is returned instead.
+        """
         try:
-            offset = self.dataframe.index.get_loc(row)
+            return self._get_row_offset_map().get_offset(row)
         except KeyError:
             raise KeyError("Row '%s' not found in table %s" % (row, self.name))
-        offset += self.header_height
-        return offset
 
-    def get_data(self, workbook, row, col, formula_values={}):
+    def get_row_offsets(self, rows):
+        """
+        :return: List of offsets for the row labels in `rows`
+                 (see :py:meth:`get_row_offset`).
+        """
+        try:
+            return self._get_row_offset_map().get_offsets(rows)
+        except KeyError as e:
+            raise KeyError("Row '%s' not found in table %s" % (e.args[0], self.name))
+
+    def _get_column_offset_map(self):
+        if self.__column_offsets is None:
+            self.__column_offsets = _OffsetMap(self.columns, self.row_labels_width)
+        return self.__column_offsets
+
+    def _get_row_offset_map(self):
+        if self.__row_offsets is None:
+            self.__row_offsets = _OffsetMap(self.dataframe.index, self.header_height)
+        return self.__row_offsets
+
+    def get_data(self, workbook, row, col, formula_values={}, shared_formulas=None):
         """
         :return: 2d numpy array for this table with any formulas resolved to the final
                  excel formula.
@@ -209,122 +422,249 @@ class Table(object):
         :param int row: Row where the table will start in the sheet (used for resolving formulas).
         :param int col: Column where the table will start in the sheet (used for resolving formulas).
         :param formula_values: dict to add pre-calculated formula values to (keyed by row, col).
+        :param shared_formulas: dict to add the ranges of cells that can be written as shared
+                                formulas to, as {(first row, col) -> last row}, or None.
         """
         if workbook:
             prev_table = workbook.active_table
             workbook.active_table = self
         try:
-            return self._get_data_impl(workbook, row, col, formula_values)
+            return self._get_data_impl(workbook, row, col, formula_values, shared_formulas)
         finally:
             if workbook:
                 workbook.active_table = prev_table
 
-    def _get_data_impl(self, workbook, row, col, formula_values={}):
-        df = self.dataframe.copy()
-
-        # replace any Value instances with their value
-        if df.applymap(lambda x: isinstance(x, Value)).any().any():
-            df = df.applymap(lambda x: x.value if isinstance(x, Value) else x)
-
-        # create a mask for elements that are expressions
-        mask_df = df.applymap(lambda x: isinstance(x, Expression))
-
-        # resolve any expressions if there are any
-        if mask_df.any().any():
-            # create a dataframe for indexing both into the dataframe and with the column and
-            # row numbers.
-            idx = [[(r, c) for r in range(len((df.index)))] for c in range(len((df.columns)))]
-            index_df = pa.DataFrame(dict(zip(df.columns, idx)), columns=df.columns, index=df.index)
-
-            # convert everything to objects so mask setting works
-            df = df.astype(object)
-
-            col_offset = self.row_labels_width
-            row_offset = self.header_height
-
-            # resolve all elements and set back into the main dataframe
-            def get_formula(df, element):
-                if pa.isnull(element):
-                    return element
-                r, c = element
-                expr = df.iat[r, c]
-                r += row_offset
-                c += col_offset
-                if expr.has_value:
-                    formula_values[(r + row, c + col)] = expr.value
-                return expr.get_formula(workbook, r, c)
-
-            df[mask_df] = index_df[mask_df].applymap(partial(get_formula, df))
-
-        # add the index and or columns to the values part of the dataframe
-        if self.__include_index or self.__include_columns:
+    def _get_data_impl(self, workbook, row, col, formula_values={}, shared_formulas=None):
+        return self._get_block(workbook, row, col, self.dataframe, 0, True, formula_values, shared_formulas)
+
+    def _get_block(self, workbook, row, col, df, first_row, header, formula_values={}, shared_formulas=None):
+        """
+        Return the resolved 2d data array for the rows of df, which are the table's rows
+        starting first_row rows below its header, with the header above them if header is True.
+        """
+        columns = self.columns
+        header_height = self.header_height if header else 0
+        row_labels_width = self.row_labels_width
+
+        # offset of the block's first row from the top of the table
+        block_top = self.header_height + first_row
+
+        # The whole block is written into a single preallocated array, with the
+        # column headers above and the index to the left of the body.
+        data = np.empty((header_height + len(df.index), row_labels_width + len(columns)), dtype=object)
+        body = data[header_height:, row_labels_width:]
+
+        # Formulas' values are calculated from the dataframes if the workbook is set to
+        # evaluate them (see Workbook.set_evaluate_formulas)
+        evaluator = None
+        if workbook is not None and workbook.evaluate_formulas:
+            evaluator = FormulaEvaluator(workbook)
+
+        # Only object columns can contain Value or Expression instances. Columns of any
+        # other dtype are copied straight into the block without being scanned.
+        fast_path_columns = 0
+        for c, dtype in enumerate(df.dtypes):
+            series = df.iloc[:, c]
+            if dtype != object:
+                fast_path_columns += 1
+                body[:, c] = _object_values(series)
+                continue
+            values = self._resolve_column(workbook, series.values, c, row, col, formula_values,
+                                          evaluator, shared_formulas, block_top)
+            body[:, c] = series.values if values is None else values
+
+        self.__fast_path_columns = fast_path_columns
+        _log.debug("Table '%s': %d of %d columns took the fast path",
+                   self.name, fast_path_columns, len(df.columns))
+
+        # add any formula columns
+        if self.__formula_columns:
+            rows = np.arange(len(df.index)) + block_top
+            for colname, expr in self.__formula_columns.items():
+                c = self.get_column_offset(colname)
+                data[header_height:, c] = self._get_formulas(workbook, expr, rows, c, row, col,
+                                                             formula_values, evaluator, shared_formulas)
+
+        # add the column headers above the body, one row per level
+        if self.__include_columns and header:
+            if isinstance(columns, pa.MultiIndex):
+                for i in range(header_height):
+                    data[i, row_labels_width:] = _object_values(columns.get_level_values(i))
+            else:
+                data[0, row_labels_width:] = _object_values(columns)
+
+        # add the index to the left of the body, one column per level, with the
+        # index names in the bottom row of the header
+        if self.__include_index:
             index = df.index
+            if isinstance(index, pa.MultiIndex):
+                for i in range(row_labels_width):
+                    data[header_height:, i] = _object_values(index.get_level_values(i))
+                if header_height:
+                    for i, index_name in enumerate(index.names):
+                        data[header_height - 1, i] = index_name or ""
+            else:
+                data[header_height:, 0] = _object_values(index)
+                if header_height:
+                    data[header_height - 1, 0] = index.name
+
+        # the header of an Excel table has to match the names of the table's columns
+        if self.is_excel_table and header:
+            data[0, :] = self.get_excel_column_names()
 
-            if self.__include_columns:
-                # add the index names to the top of the index to create a new row for the column headers
-                if isinstance(index, pa.MultiIndex):
-                    index_names = tuple((x or "" for x in df.index.names))
-                    i = 1
-                    while index_names in df.index:
-                        index_names = tuple(("%s_%d" % (x or "", i) for x in df.index.names))
-                        i += 1
-                    index_tuples = [index_names] + list(df.index.astype(object))
-                    if isinstance(df.columns, pa.MultiIndex):
-                        blank_tuple = tuple([None] * len(df.index.names))
-                        index_tuples = ([blank_tuple] * (len(df.columns.levels) - 1)) + index_tuples
-                    index = pa.MultiIndex.from_tuples(index_tuples)
-                else:
-                    index_name = df.index.name
-                    i = 1
-                    while index_name in df.index:
-                        index_name = "%s_%d" % (df.index.name, i)
-                        i += 1
-                    index = [index_name] + list(df.index.astype(object))
-                    if isinstance(df.columns, pa.MultiIndex):
-                        index = ([None] * (len(df.columns.levels) - 1)) + index
-
-            columns = df.columns
-            if self.__include_index:
-                # add the column names to the left of the columns to create a new row for the index headers
-                if isinstance(columns, pa.MultiIndex):
-                    columns_names = tuple((x or "" for x in df.columns.names))
-                    i = 1
-                    while columns_names in df.columns:
-                        columns_names = tuple(("%s_%d" % (x or "", i) for x in df.columns.names))
-                        i += 1
-                    column_tuples = [columns_names] + list(df.columns.astype(object))
-                    if isinstance(df.index, pa.MultiIndex):
-                        blank_tuple = tuple([None] * len(df.columns.names))
-                        column_tuples = ([blank_tuple] * (len(df.index.levels) - 1)) + column_tuples
-                    columns = pa.MultiIndex.from_tuples(column_tuples)
-                else:
-                    columns_name = df.columns.name or ""
-                    i = 1
-                    while columns_name in df.columns:
-                        columns_name = "%s_%d" % (df.columns.name, i)
-                        i += 1
-                    columns = [columns_name] + list(df.columns.astype(object))
-                    if isinstance(df.index, pa.MultiIndex):
-                        columns = ([None] * (len(df.index.levels) - 1)) + columns
-
-            df = df.reindex(index=index, columns=columns).astype(object)
-
-            if self.__include_columns:
-                if isinstance(df.columns, pa.MultiIndex):
-                    for i in range(len(df.columns.levels)):
-                        df.iloc[i, :] = [c[i] for c in df.columns.values]
-                else:
-                    df.iloc[0, :] = df.columns
-
-            if self.__include_index:
-                if isinstance(df.index, pa.MultiIndex):
-                    for i in range(len(df.index.levels)):
-                        df.iloc[:, i] = [c[i] for c in df.index.values]
-                else:
-                    df.iloc[:, 0] = df.index
-
-        # return the values as an np array
-        return df.values
+        return data
+
+    def _resolve_column(self, workbook, values, c, row, col, formula_values, evaluator=None,
+                        shared_formulas=None, first_row=None):
+        """
+        Return a copy of the object array `values` for column `c` with any Value instances
+        replaced by their values and any Expressions resolved to formulas, or None
+        if there are neither.
+
+        :param int first_row: Offset of the first value's row from the top of the table
+                              (defaults to the first row below the header).
+        """
+        if first_row is None:
+            first_row = self.header_height
+        is_value = np.fromiter((isinstance(x, Value) for x in values), dtype=bool, count=len(values))
+        has_values = is_value.any()
+        if has_values:
+            values = values.copy()
+            for i in np.flatnonzero(is_value):
+                values[i] = values[i].value
+
+        is_expr = np.fromiter((isinstance(x, Expression) for x in values), dtype=bool, count=len(values))
+        if not is_expr.any():
+            return values if has_values else None
+
+        if not has_values:
+            values = values.copy()
+
+        # group the rows by expression so that an expression repeated down the column,
+        # or equal expressions (with the same key and no value set), are only resolved once
+        rows = np.flatnonzero(is_expr)
+        exprs = values[rows]
+        group_ids = {}
+        ids = np.fromiter((group_ids.setdefault(_get_group_key(x), len(group_ids)) for x in exprs),
+                          dtype=np.int64,
+                          count=len(exprs))
+        _unique_ids, first, groups, counts = np.unique(ids,
+                                                       return_index=True,
+                                                       return_inverse=True,
+                                                       return_counts=True)
+        order = np.argsort(groups.ravel(), kind="stable")
+        for expr, group_rows in zip(exprs[first], np.split(rows[order], np.cumsum(counts)[:-1])):
+            values[group_rows] = self._get_formulas(workbook,
+                                                    expr,
+                                                    group_rows + first_row,
+                                                    c + self.row_labels_width,
+                                                    row,
+                                                    col,
+                                                    formula_values,
+                                                    evaluator,
+                                                    shared_formulas)
+        return values
+
+    @staticmethod
+    def _get_formulas(workbook, expr, rows, c, row, col, formula_values, evaluator=None,
+                      shared_formulas=None):
+        """
+        Resolve `expr` for each of `rows` (offset from the top of the table) in column `c`,
+        adding the expression's value to formula_values if it has one, or the values
+        calculated by `evaluator` if it's set.
+
+        If shared_formulas is set, any runs of consecutive rows where the formula
+        can be filled down as an Excel shared formula are added to it.
+        """
+        if expr.has_value:
+            value = expr.value
+            for r in rows:
+                formula_values[(r + row, c + col)] = value
+        elif evaluator is not None:
+            values = evaluator.evaluate(expr, rows, c)
+            if values is not None:
+                for r, value in zip(rows.tolist(), values.tolist()):
+                    if value is not None:
+                        formula_values[(r + row, c + col)] = value
+        formulas = expr.get_formulas(workbook, rows, c)
+
+        if shared_formulas is not None and len(rows) > 1:
+            template = expr.get_template(workbook, int(rows[0]), c)
+            if template is not None and template.is_shareable:
+                for run in np.split(rows, np.flatnonzero(np.diff(rows) != 1) + 1):
+                    if len(run) > 1:
+                        shared_formulas[(int(run[0]) + row, c + col)] = int(run[-1]) + row
+
+        return formulas
+
+
+def _get_group_key(expr):
+    """return the key used to group equal expressions in a column"""
+    key = expr.key
+    if key is None or expr.has_value:
+        return id(expr)
+    return key
+
+
+class _OffsetMap(object):
+    """
+    Internal use - cached map of index labels to offsets.
+
+    Unique indexes are mapped up-front so lookups are a single dict access.
+    Other labels are looked up using Index.get_loc and the result is cached.
+
+    :param pandas.Index index: Index to map labels from.
+    :param int base: Amount to add to each label's position in the index.
+    """
+    def __init__(self, index, base):
+        self.__index = index
+        self.__base = base
+        self.__offsets = {}
+        if index.is_unique:
+            self.__offsets = dict(zip(index, range(base, base + len(index))))
+
+    def get_offset(self, label):
+        try:
+            return self.__offsets[label]
+        except KeyError:
+            pass
+        except TypeError:
+            raise KeyError(label)
+
+        loc = self.__index.get_loc(label)
+        if isinstance(loc, slice):
+            start, stop, step = loc.indices(len(self.__index))
+            offset = range(start + self.__base, stop + self.__base, step)
+        elif isinstance(loc, np.ndarray):
+            offsets = (np.flatnonzero(loc) + self.__base).tolist()
+            offset = offsets
+            if offsets[-1] - offsets[0] == len(offsets) - 1:
+                offset = range(offsets[0], offsets[-1] + 1)
+        else:
+            offset = int(loc) + self.__base
+
+        self.__offsets[label] = offset
+        return offset
+
+    def get_offsets(self, labels):
+        labels = list(labels)
+        if self.__index.is_unique and not isinstance(self.__index, pa.MultiIndex):
+            positions = self.__index.get_indexer(labels)
+            if (positions < 0).any():
+                raise KeyError(labels[int(np.flatnonzero(positions < 0)[0])])
+            return (positions + self.__base).tolist()
+        return [self.get_offset(label) for label in labels]
+
+
+def _object_values(x):
+    """
+    Return the values of a Series or Index as a numpy array that can be
+    assigned into an object array, converting to objects only where numpy
+    can't (e.g. datetimes, which would otherwise become integers).
+    """
+    if isinstance(x.dtype, np.dtype) and x.dtype.kind in "biufcOSU":
+        return x.values
+    return x.astype(object).values
 
 
 class ArrayFormula(Table):
@@ -373,7 +713,161 @@ class ArrayFormula(Table):
     def formula(self):
         return self.__formula
 
-    def _get_data_impl(self, workbook, row, col, formula_values):
+    @property
+    def is_excel_table(self):
+        # Excel tables can't contain array formulas
+        return False
+
+    def get_fingerprint(self, contents=True):
+        # without a value the dataframe is only used to hold the formula
+        if self.value is not None:
+            return super(ArrayFormula, self).get_fingerprint(contents)
+        return id(self.formula), self.dataframe.shape
+
+    def _iter_expressions(self):
+        yield self.formula
+
+    def _get_data_impl(self, workbook, row, col, formula_values, shared_formulas=None):
         if not self.value:
             self.dataframe[:] = "{%s}" % self.formula.get_formula(workbook, row, col)
+            self.invalidate()
         return super(ArrayFormula, self)._get_data_impl(workbook, row, col, formula_values)
+
+
+class LazyTable(Table):
+    """
+    Represents a table of data that's read a chunk at a time as the worksheet it's on is
+    written, from an iterator of dataframes or a DB-API cursor, so that all of its data
+    doesn't need to be in memory at once. The data can only be read once.
+
+    Subclass of :py:class:`xltable.Table`.
+
+    The number of rows must be given for tables that are referred to by expressions
+    that cover the whole table (e.g. :py:class:`xltable.Column`), or written as Excel
+    tables. Otherwise a table with an unknown number of rows must be the last table on
+    its worksheet, and its height is only known once it's been written.
+
+    Any Values and Expressions in the data are resolved as each chunk is written, but
+    cell styles and the formulas' values (see Workbook.set_evaluate_formulas) aren't
+    written, and rows can't be referred to by label.
+
+    :param str name: Name of the table so it can be referenced by other tables and charts.
+    :param source: Iterator of pandas.DataFrame chunks, or a DB-API cursor that the rows
+                   are fetched from using fetchmany.
+    :param columns: List of the column names, or dictionary of column names to dtypes.
+                    Chunks read from a cursor are converted to the dtypes.
+    :param int num_rows: Number of rows in the data, or None if it isn't known.
+    :param int chunk_size: Number of rows fetched from a cursor at once.
+    :param bool include_columns: Include the column names when outputting.
+    :param xltable.TableStyle style: Table style, or one of the named styles 'default', 'plain' or 'excel'.
+    :param xltable.CellStyle column_styles: Dictionary of column names to styles or named styles.
+    :param dict column_widths: Dictionary of column names to widths.
+    :param xltable.CellStyle header_style: Style or named style to use for the cells in the header row.
+    :param dict formula_columns: Dictionary of column names to :py:class:`xltable.Expression` instances.
+    """
+
+    def __init__(self,
+                 name,
+                 source,
+                 columns,
+                 num_rows=None,
+                 chunk_size=10000,
+                 include_columns=True,
+                 style="default",
+                 column_styles={},
+                 column_widths={},
+                 header_style=None,
+                 formula_columns={}):
+        if isinstance(columns, dict):
+            schema = pa.DataFrame({c: pa.Series([], dtype=dtype) for c, dtype in columns.items()})
+            self.__dtypes = dict(columns)
+        else:
+            schema = pa.DataFrame(columns=list(columns))
+            self.__dtypes = None
+        self.__source = source
+        self.__num_rows = num_rows
+        self.__chunk_size = chunk_size
+        self.__rows_read = 0
+        self.__read = False
+        super(LazyTable, self).__init__(name,
+                                        dataframe=schema,
+                                        include_columns=include_columns,
+                                        style=style,
+                                        column_styles=column_styles,
+                                        column_widths=column_widths,
+                                        header_style=header_style,
+                                        formula_columns=formula_columns)
+        assert num_rows is not None or not self.is_excel_table, \
+            "The number of rows must be given for table '%s' to be written as an Excel table" % name
+
+    @property
+    def height(self):
+        num_rows = self.__num_rows if self.__num_rows is not None else self.__rows_read
+        return num_rows + self.header_height
+
+    @property
+    def height_known(self):
+        return self.__num_rows is not None
+
+    def iter_chunks(self):
+        """
+        Yield the table's data as dataframes with the table's columns, as they're read
+        from the source. Once all of the data has been read the table's height is known.
+        """
+        assert not self.__read, "The data for table '%s' has already been read" % self.name
+        self.__read = True
+
+        columns = list(self.dataframe.columns)
+        chunks = self.__source
+        if hasattr(chunks, "fetchmany"):
+            chunks = _iter_cursor_chunks(chunks, columns, self.__dtypes, self.__chunk_size)
+
+        for chunk in chunks:
+            if list(chunk.columns) != columns:
+                chunk = chunk[columns]
+            self.__rows_read += len(chunk.index)
+            assert self.__num_rows is None or self.__rows_read <= self.__num_rows, \
+                "Table '%s' has more than the %d rows given" % (self.name, self.__num_rows)
+            yield chunk
+
+        assert self.__num_rows is None or self.__rows_read == self.__num_rows, \
+            "Table '%s' has %d rows instead of the %d given" % (self.name, self.__rows_read, self.__num_rows)
+        self.__num_rows = self.__rows_read
+
+    def get_chunk_data(self, workbook, row, col, chunk, first_row, header, formula_values={},
+                       shared_formulas=None):
+        """
+        :return: 2d numpy array for a chunk of the table's data (from :py:meth:`iter_chunks`)
+                 with any formulas resolved, as :py:meth:`get_data`.
+        :param xltable.Workbook workbook: Workbook the table has been added to.
+        :param int row: Row where the table starts in the sheet.
+        :param int col: Column where the table starts in the sheet.
+        :param pandas.DataFrame chunk: Chunk of the table's data.
+        :param int first_row: Number of rows of data before the chunk.
+        :param bool header: Include the column headers above the chunk's rows.
+        :param formula_values: dict to add pre-calculated formula values to (keyed by row, col).
+        :param shared_formulas: dict to add the ranges of shared formulas to, or None.
+        """
+        if workbook:
+            prev_table = workbook.active_table
+            workbook.active_table = self
+        try:
+            return self._get_block(workbook, row, col, chunk, first_row, header, formula_values, shared_formulas)
+        finally:
+            if workbook:
+                workbook.active_table = prev_table
+
+    def _get_data_impl(self, workbook, row, col, formula_values, shared_formulas=None):
+        raise AssertionError("The data for table '%s' can only be read a chunk at a time" % self.name)
+
+
+def _iter_cursor_chunks(cursor, columns, dtypes, chunk_size):
+    """yield the rows fetched from a DB-API cursor as dataframes of up to chunk_size rows"""
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        chunk = pa.DataFrame.from_records(rows, columns=columns)
+        if dtypes:
+            chunk = chunk.astype(dtypes)
+        yield chunk
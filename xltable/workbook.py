@@ -1,7 +1,15 @@
 """
 Collection of worksheet instances
 """
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+import threading
+import csv
+import gzip
+import os
+import tracemalloc
 import logging
+import re
 
 _log = logging.getLogger(__name__)
 
@@ -19,30 +27,247 @@ class Workbook(object):
     """
     def __init__(self, filename=None, worksheets=[]):
         self.filename = filename
-        self.worksheets = list(worksheets)
+        self.__registry_dirty = False
+        self.__worksheets = _WorksheetList(self.__worksheets_changed)
         self.calc_mode = "auto"
+        self.calc_on_load = None
+        self.nan_policy = "blank"
+        self.stripe_mode = "cells"
+        self.evaluate_formulas = False
+        self.incremental = False
+        self.fingerprint_tables = True
         self.workbook_obj = None
 
+        # False while writing with xlsxwriter's constant_memory option, which doesn't support
+        # Excel tables, so the tables' styles are written as formats on each cell instead
+        self._excel_tables = True
+
+        # list of (sheet name, phase, peak bytes) recorded when exporting with memory_stats set
+        self.memory_stats = []
+        self.__track_memory = False
+
         # The active table and worksheet objects are set during export, and
         # are used to resolve expressions where the table and/or sheet isn't
         # set explicitly (in which case the current table is used implicitly).
-        self.active_table = None
-        self.active_worksheet = None
+        # They're kept per thread so that sheets can be prepared concurrently.
+        self.__active = threading.local()
+
+        # Registry of the tables in the worksheets, used to look up tables by name when
+        # resolving expressions. It's kept up to date as sheets are added to the workbook
+        # and tables are added to the sheets, and is rebuilt the next time it's used if the
+        # list of worksheets is modified without add_sheet being used.
+        self.__tables_by_name = {}      # {table name -> [(table, worksheet)]} in sheet order
+        self.__tables_by_sheet = {}     # {(sheet name, table name) -> (table, worksheet)}
+        self.__sheet_names = set()
+        self.__sheet_order = {}         # {id(worksheet) -> position in self.worksheets}
+
+        # "sheet!table" names split into (sheet name, table name)
+        self.__qualified_names = {}
+
+        # Formulas resolved while the workbook is being written, keyed by the expressions'
+        # keys (see Expression.key), so that repeated expressions are only resolved once.
+        # It's only kept while writing as the tables can be moved between exports.
+        self.formula_cache = None
+
+        # names (lowercased) of the Excel tables in the file being written, which must be unique
+        self.__excel_table_names = set()
+
+        for worksheet in worksheets:
+            self.add_sheet(worksheet)
+
+    @property
+    def active_table(self):
+        return getattr(self.__active, "table", None)
+
+    @active_table.setter
+    def active_table(self, table):
+        self.__active.table = table
+
+    @property
+    def active_worksheet(self):
+        return getattr(self.__active, "worksheet", None)
+
+    @active_worksheet.setter
+    def active_worksheet(self, worksheet):
+        self.__active.worksheet = worksheet
+
+    @property
+    def worksheets(self):
+        """List of the worksheets in the workbook."""
+        return self.__worksheets
+
+    @worksheets.setter
+    def worksheets(self, worksheets):
+        self.__worksheets = _WorksheetList(self.__worksheets_changed, worksheets)
+        self.__worksheets_changed()
+
+    def __worksheets_changed(self):
+        """called when the list of worksheets is modified directly"""
+        self.__registry_dirty = True
 
     def add_sheet(self, worksheet):
         """
         Adds a worksheet to the workbook.
         """
+        registry_dirty = self.__registry_dirty
         self.worksheets.append(worksheet)
+        self.__registry_dirty = registry_dirty
+        if not registry_dirty:
+            self.__register_sheet(worksheet)
+        worksheet._add_workbook(self)
 
     # alias for add_sheet
     append = add_sheet
 
-    def set_calc_mode(self, mode):
+    def set_calc_mode(self, mode, calc_on_load=None):
         """
         Set the calculation mode for the Excel workbook
+
+        :param str mode: "auto", "manual" or "auto_except_tables".
+        :param bool calc_on_load: If True Excel recalculates all the formulas when the
+            file is opened. Defaults to True unless the mode is "manual". Files can be
+            opened without recalculating if the formulas' values have been set or
+            calculated (see :py:meth:`set_evaluate_formulas`).
         """
         self.calc_mode = mode
+        self.calc_on_load = calc_on_load
+
+    def set_evaluate_formulas(self, evaluate=True):
+        """
+        Calculate the values of formulas from the tables' dataframes when the workbook
+        is written, so they can be saved in the file along with the formulas. Values set
+        on expressions (see :py:attr:`xltable.Expression.value`) are used instead if set.
+
+        References to cells and ranges in tables, constants, arithmetic and comparison
+        operators and the functions SUM, SUMPRODUCT, AVERAGE, MIN, MAX, IF and ROUND
+        can be evaluated. Results that are errors in Excel (e.g. dividing by zero) are
+        written as Excel's error values. Any other formulas are written without a value.
+        """
+        self.evaluate_formulas = evaluate
+
+    def set_nan_policy(self, policy):
+        """
+        Set how NaN, inf and NaT values are written to xlsx files.
+
+        :param str policy: "blank" to leave the cell empty, "#N/A" to write an
+                           #N/A error or "zero" to write 0.
+        """
+        assert policy in ("blank", "#N/A", "zero"), "Unknown nan policy '%s'." % policy
+        self.nan_policy = policy
+
+    def set_stripe_mode(self, mode):
+        """
+        Set how the stripes of tables (see :py:class:`xltable.TableStyle`) are written to xlsx files.
+
+        :param str mode: "cells" to format each cell with its stripe color, or "conditional"
+                         to write the stripes as a conditional format over each table's body,
+                         so cells that aren't otherwise styled don't need a format.
+                         Cells with a background color from a column, row or cell style
+                         are left out of the conditional format.
+        """
+        assert mode in ("cells", "conditional"), "Unknown stripe mode '%s'." % mode
+        self.stripe_mode = mode
+
+    def set_incremental(self, incremental=True, fingerprints=True):
+        """
+        Keep the resolved data of each table between exports, so that when the workbook is
+        written again only the tables that have changed are resolved again, along with the
+        tables with expressions that refer to them (directly or through other tables).
+        The styles of worksheets where nothing has changed are kept too.
+
+        A table has changed if it's been moved, invalidated (see :py:meth:`invalidate`) or
+        given a new dataframe, or if its fingerprint has changed (see
+        :py:meth:`xltable.Table.get_fingerprint`). The resolved data is kept in memory
+        until it's discarded by :py:meth:`invalidate`.
+
+        :param bool incremental: Keep the tables' data between exports.
+        :param bool fingerprints: Hash the contents of every table's dataframe each time
+            the workbook is written, so that dataframes changed in place are detected.
+            If False only tables that have been moved, invalidated or given new dataframes
+            are resolved again.
+        """
+        self.incremental = incremental
+        self.fingerprint_tables = fingerprints
+        if not incremental:
+            self.invalidate()
+
+    def invalidate(self, table=None):
+        """
+        Mark a table as changed so it's resolved again the next time the workbook is written,
+        when writing incrementally (see :py:meth:`set_incremental`).
+
+        :param xltable.Table table: Table that has changed, or None to discard the data and
+                                    styles kept from previous exports for all tables.
+        """
+        if table is not None:
+            table.invalidate()
+            return
+        for worksheet in self.worksheets:
+            worksheet._clear_resolved()
+
+    def validate(self):
+        """
+        Check the references made by the expressions in the workbook's tables, values and
+        charts without resolving any formulas, so that problems can be found quickly before
+        the workbook is written. Each distinct expression is only checked once.
+
+        The sheets must have unique names, the tables, columns, rows and indexes referred to
+        must exist, tables on other sheets must be referred to by their qualified names
+        (e.g. "sheet!table"), and tables mustn't refer to each other in a cycle.
+
+        Lazy tables with an unknown number of rows (see :py:class:`xltable.LazyTable`) can
+        only be referred to as a whole (e.g. by :py:class:`xltable.Column`) from later sheets
+        or charts on the same sheet, as their height isn't known until they've been written.
+        Sheets prepared concurrently (see :py:meth:`to_xlsx`) may be resolved before earlier
+        sheets have been written, so this isn't checked when using threads.
+
+        :return: List of the problems found, as strings. Empty if there are none.
+        """
+        self.__check_registry()
+
+        problems = []
+        sheet_positions = {id(ws): i for i, ws in enumerate(self.worksheets)}
+        sheet_names = [ws.name for ws in self.worksheets]
+        for name in sorted(set(x for x in sheet_names if sheet_names.count(x) > 1)):
+            problems.append("Worksheet name '%s' is used more than once" % name)
+
+        # {(sheet name, table name) -> list of the (sheet name, table name) it refers to}
+        references = {}
+        for worksheet in self.worksheets:
+            for location, table, expr, after_tables in worksheet._iter_expressions():
+                expr_references = expr._get_references()
+                if expr_references is None:
+                    continue
+                prefix = "Worksheet '%s', %s: " % (worksheet.name, location)
+                for table_name, columns, rows, index, to_bottom in expr_references:
+                    try:
+                        target, target_ws = self.__find_referenced_table(table_name, table, worksheet)
+                        for col in columns:
+                            target.get_column_offset(col)
+                        for row in rows:
+                            target.get_row_offset(row)
+                        if index:
+                            target.get_index_offset()
+                    except KeyError as e:
+                        problems.append(prefix + str(e.args[0]))
+                        continue
+                    if to_bottom and not target.height_known:
+                        # the table's height is only known once it's been written
+                        ws_pos, target_pos = sheet_positions[id(worksheet)], sheet_positions[id(target_ws)]
+                        if not (ws_pos > target_pos or (ws_pos == target_pos and after_tables)):
+                            problems.append(prefix + "Table '%s' has an unknown number of rows so can "
+                                            "only be referred to as a whole from later worksheets"
+                                            % target.name)
+                    if table is not None and target is not table:
+                        referrer = (worksheet.name, table.name)
+                        references.setdefault(referrer, []).append((target_ws.name, target.name))
+
+        for cycle in _find_cycles(references):
+            problems.append("Tables refer to each other in a cycle: %s" %
+                            " -> ".join("%s!%s" % x for x in cycle + [cycle[0]]))
+
+        # the same problem can be found from several expressions
+        return list(dict.fromkeys(problems))
 
     def itersheets(self):
         """
@@ -59,26 +284,252 @@ class Workbook(object):
             finally:
                 self.active_worksheet = prev_ws
 
-    def to_xlsx(self, **kwargs):
+    def to_xlsx(self, low_memory=False, constant_memory=False, threads=None, engine="xlsxwriter",
+                shared_formulas=False, memory_stats=False, **kwargs):
         """
         Write workbook to a .xlsx file using xlsxwriter.
-        Return a xlsxwriter.workbook.Workbook.
-
+        Return a xlsxwriter.workbook.Workbook, or None if using the native engine.
+
+        :param bool low_memory: Release each sheet's intermediate data as soon as the sheet
+            has been written.
+        :param bool constant_memory: Use xlsxwriter's constant_memory option, so each row is
+            written to disk once it's complete. Cells are always written in row order so
+            this is equivalent to passing options={"constant_memory": True}. xlsxwriter can't
+            add Excel tables in this mode, so tables with Excel table styles are written with
+            their header, index and stripe styles formatted on each cell instead.
+        :param int threads: Number of threads used to prepare the worksheets (resolve the
+            tables' expressions and work out the styles) concurrently. The prepared sheets
+            are written in order as they become ready. If None each sheet is prepared as
+            it's written. Preparing sheets ahead of writing them holds the resolved data
+            for those sheets in memory at once.
+        :param str engine: "xlsxwriter" to write the file using xlsxwriter, or "native" to
+            write the sheets' XML directly, which is much faster for large sheets. The native
+            engine streams each sheet to the file as it's written, and supports cell values,
+            formulas, styles, column widths and row groups but not charts. Strings are
+            always written as strings (urls aren't converted to hyperlinks).
+        :param bool shared_formulas: Write formulas that are filled down a column with only
+            their row references changing as Excel shared formulas, where only the first cell
+            holds the formula's text. This makes files with long formula columns smaller
+            and quicker to load. Only supported by the native engine.
+        :param bool memory_stats: Record the peak memory allocated during each phase of the
+            export in :py:attr:`memory_stats` (using :py:mod:`tracemalloc`). Tracing memory
+            allocations slows the export down considerably, and uses memory itself.
         :param kwargs: Extra arguments passed to the xlsxwriter.Workbook
-        constructor.
+        constructor, or for the native engine to xltable.native.NativeXlsxWriter
+        (e.g. compresslevel).
         """
-        from xlsxwriter.workbook import Workbook as _Workbook
-        self.workbook_obj = _Workbook(**kwargs)
-        self.workbook_obj.set_calc_mode(self.calc_mode)
-
-        for worksheet in self.itersheets():
-            worksheet.to_xlsx(workbook=self)
+        assert engine in ("xlsxwriter", "native"), "Unknown engine '%s'." % engine
+        assert not shared_formulas or engine == "native", "Shared formulas require the native engine"
+        calc_on_load = self.calc_on_load
+        if calc_on_load is None:
+            calc_on_load = self.calc_mode != "manual"
+
+        if engine == "native":
+            from .native import NativeXlsxWriter
+            assert self.filename, "A filename is required to write using the native engine"
+            writer = NativeXlsxWriter(self.filename,
+                                      calc_mode=self.calc_mode,
+                                      calc_on_load=calc_on_load,
+                                      **kwargs)
+            self.workbook_obj = None
+            write_sheet = lambda worksheet: worksheet._to_native_xlsx(self, writer, shared_formulas)
+        else:
+            from xlsxwriter.workbook import Workbook as _Workbook
+            if constant_memory:
+                kwargs["options"] = dict(kwargs.get("options") or {}, constant_memory=True)
+            self._excel_tables = not (kwargs.get("options") or {}).get("constant_memory")
+            self.workbook_obj = _Workbook(**kwargs)
+            self.workbook_obj.set_calc_mode(self.calc_mode)
+            self.workbook_obj.calc_on_load = calc_on_load
+            write_sheet = lambda worksheet: worksheet.to_xlsx(workbook=self)
+
+        self.memory_stats = []
+        self.__excel_table_names = set()
+        self.__track_memory = memory_stats
+        started_tracing = memory_stats and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        try:
+            with self._cache_formulas():
+                self.__write_sheets(write_sheet, threads, low_memory, engine == "native", shared_formulas)
+
+            if engine == "native":
+                with self._track_memory(None, "close"):
+                    writer.close()
+            else:
+                self.workbook_obj.filename = self.filename
+                if self.filename:
+                    with self._track_memory(None, "close"):
+                        self.workbook_obj.close()
+        finally:
+            self._excel_tables = True
+            self.__track_memory = False
+            if started_tracing:
+                tracemalloc.stop()
 
-        self.workbook_obj.filename = self.filename
-        if self.filename:
-            self.workbook_obj.close()
         return self.workbook_obj
 
+    def __write_sheets(self, write_sheet, threads, low_memory, native=False, shared_formulas=False):
+        """write each sheet using write_sheet, preparing them on threads if set"""
+        if threads:
+            with ThreadPoolExecutor(threads) as executor:
+                futures = [executor.submit(self._prepare_sheet, ws, native, shared_formulas)
+                           for ws in self.worksheets]
+                try:
+                    for worksheet, future in zip(self.itersheets(), futures):
+                        future.result()
+                        write_sheet(worksheet)
+                        if low_memory:
+                            worksheet._release()
+                except:
+                    # don't leave prepared data behind for the next export
+                    for future in futures:
+                        future.cancel()
+                    wait(futures)
+                    for worksheet in self.worksheets:
+                        worksheet._release()
+                    raise
+        else:
+            for worksheet in self.itersheets():
+                write_sheet(worksheet)
+                if low_memory:
+                    worksheet._release()
+
+    def to_csv(self, directory=".", values=False, compression=None, compresslevel=6, threads=None, **kwargs):
+        """
+        Write each worksheet to its own csv file, named after the worksheet.
+        Return the list of filenames written.
+
+        :param str directory: Directory to write the files to.
+        :param bool values: Write the values of any formulas instead of the formulas
+            (see :py:meth:`xltable.Worksheet.to_csv`).
+        :param str compression: None, or "gzip" to write gzip compressed files (with the
+            extension .csv.gz).
+        :param int compresslevel: gzip compression level, from 1 (fastest) to 9 (smallest).
+        :param int threads: Number of threads used to write the worksheets concurrently.
+            If None the worksheets are written one after another.
+        :param kwargs: Extra arguments passed to csv.writer (e.g. dialect or delimiter).
+        """
+        assert compression in (None, "gzip"), "Unknown compression '%s'." % compression
+        extension = ".csv.gz" if compression == "gzip" else ".csv"
+        filenames = [os.path.join(directory, ws.name + extension) for ws in self.worksheets]
+        assert len(set(filenames)) == len(filenames), "Worksheets must have unique names"
+
+        def write_sheet(worksheet, filename):
+            prev_ws = self.active_worksheet
+            self.active_worksheet = worksheet
+            try:
+                if compression == "gzip":
+                    fh = gzip.open(filename, "wt", compresslevel=compresslevel, encoding="utf-8", newline="")
+                else:
+                    fh = open(filename, "w", encoding="utf-8", newline="")
+                with fh:
+                    worksheet.to_csv(csv.writer(fh, **kwargs), workbook=self, values=values)
+            finally:
+                self.active_worksheet = prev_ws
+
+        with self._cache_formulas():
+            if threads:
+                with ThreadPoolExecutor(threads) as executor:
+                    futures = [executor.submit(write_sheet, ws, filename)
+                               for ws, filename in zip(self.worksheets, filenames)]
+                    try:
+                        for future in futures:
+                            future.result()
+                    except:
+                        for future in futures:
+                            future.cancel()
+                        raise
+            else:
+                for worksheet, filename in zip(self.worksheets, filenames):
+                    write_sheet(worksheet, filename)
+
+        return filenames
+
+    def _get_excel_table_name(self, table):
+        """
+        return the name to give a table written as an Excel table, which is the table's
+        name made into a valid Excel table name that's unique within the file being written.
+        """
+        name = _invalid_table_name_chars_re.sub("_", str(table.name))
+        if not name or name[0].isdigit() or name[0] == "." or _cell_like_name_re.match(name):
+            name = "_" + name
+        unique, i = name, 2
+        while unique.lower() in self.__excel_table_names:
+            unique, i = "%s_%d" % (name, i), i + 1
+        self.__excel_table_names.add(unique.lower())
+        return unique
+
+    @contextmanager
+    def _cache_formulas(self):
+        """cache resolved formulas (see formula_cache) while in the context"""
+        if self.formula_cache is not None:
+            yield
+            return
+        self.formula_cache = {}
+        try:
+            yield
+        finally:
+            self.formula_cache = None
+
+    def _get_table_fingerprint(self, table):
+        """
+        return the table's fingerprint (see Table.get_fingerprint), which is only
+        calculated once per table while the workbook is being written.
+        """
+        if self.formula_cache is None:
+            return table.get_fingerprint(self.fingerprint_tables)
+        cache_key = ("fingerprint", id(table))
+        fingerprint = self.formula_cache.get(cache_key)
+        if fingerprint is None:
+            fingerprint = self.formula_cache[cache_key] = table.get_fingerprint(self.fingerprint_tables)
+        return fingerprint
+
+    def _get_referenced_tables(self, table):
+        """
+        return the names of the tables the table refers to (see Table.get_referenced_tables),
+        which are only found once per table while the workbook is being written.
+        """
+        if self.formula_cache is None:
+            return table.get_referenced_tables()
+        cache_key = ("references", id(table))
+        names = self.formula_cache.get(cache_key, _MISSING)
+        if names is _MISSING:
+            names = self.formula_cache[cache_key] = table.get_referenced_tables()
+        return names
+
+    def _prepare_sheet(self, worksheet, native=False, shared_formulas=False):
+        """prepare a worksheet to be written with the worksheet set as the active one"""
+        prev_ws = self.active_worksheet
+        self.active_worksheet = worksheet
+        try:
+            worksheet._prepare(self, native, shared_formulas)
+        finally:
+            self.active_worksheet = prev_ws
+
+    @contextmanager
+    def _track_memory(self, worksheet, phase):
+        """
+        Record the peak memory allocated while in the context in :py:attr:`memory_stats`,
+        if tracking memory use (see :py:meth:`to_xlsx`).
+        """
+        if not self.__track_memory:
+            yield
+            return
+
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        else:
+            # before Python 3.9 the peak can only be reset by clearing the traces
+            tracemalloc.clear_traces()
+        try:
+            yield
+        finally:
+            _current, peak = tracemalloc.get_traced_memory()
+            sheet_name = worksheet.name if worksheet is not None else None
+            self.memory_stats.append((sheet_name, phase, peak))
+            _log.debug("Peak memory writing %s (%s): %d bytes", sheet_name or "workbook", phase, peak)
+
     def to_excel(self, xl_app=None, resize_columns=True):
         from win32com.client import Dispatch, gencache
 
@@ -112,13 +563,14 @@ class Workbook(object):
 
         # Export each sheet (have to use itersheets for this as it sets the
         # current active sheet before yielding each one).
-        for worksheet, sheet in zip(self.workbook_obj.Sheets, self.itersheets()):
-            worksheet.Select()
-            sheet.to_excel(workbook=self,
-                           worksheet=worksheet,
-                           xl_app=xl_app,
-                           rename=False,
-                           resize_columns=resize_columns)
+        with self._cache_formulas():
+            for worksheet, sheet in zip(self.workbook_obj.Sheets, self.itersheets()):
+                worksheet.Select()
+                sheet.to_excel(workbook=self,
+                               worksheet=worksheet,
+                               xl_app=xl_app,
+                               rename=False,
+                               resize_columns=resize_columns)
 
         return self.workbook_obj
 
@@ -142,6 +594,9 @@ class Workbook(object):
         """
         Return a table, worksheet pair for the named table
         """
+        if self.__registry_dirty:
+            self.__rebuild_registry()
+
         if name is None:
             assert self.active_table, "Can't get table without name unless an active table is set"
             name = self.active_table.name
@@ -151,24 +606,22 @@ class Workbook(object):
                 assert table is self.active_table, "Active table is not from the active sheet"
                 return table, self.active_worksheet
 
-            for ws in self.worksheets:
-                try:
-                    table = ws.get_table(name)
-                    if table is self.active_table:
-                        return table, ws
-                except KeyError:
-                    pass
+            for table, ws in self.__tables_by_name.get(name, ()):
+                if table is self.active_table:
+                    return table, ws
 
             raise RuntimeError("Active table not found in any sheet")
 
         # if the tablename explicitly uses the sheetname find the right sheet
         if "!" in name:
-            ws_name, table_name = map(lambda x: x.strip("'"), name.split("!", 1))
-            for ws in self.worksheets:
-                if ws.name == ws_name:
-                    table = ws.get_table(table_name)
-                    return table, ws
-            raise KeyError(name)
+            qualified_name = self.__qualified_names.get(name)
+            if qualified_name is None:
+                qualified_name = tuple(x.strip("'") for x in name.split("!", 1))
+                self.__qualified_names[name] = qualified_name
+            try:
+                return self.__tables_by_sheet[qualified_name]
+            except KeyError:
+                raise KeyError(name)
 
         # otherwise look in the current table
         if self.active_worksheet:
@@ -176,11 +629,153 @@ class Workbook(object):
             return table, self.active_worksheet
 
         # or fallback to the first matching name in any table
-        for ws in self.worksheets:
+        tables = self.__tables_by_name.get(name)
+        if not tables:
+            raise KeyError(name)
+        return tables[0]
+
+    def __find_referenced_table(self, name, table, worksheet):
+        """
+        return the (table, worksheet) that get_table would find for an expression referring
+        to a table by name, from table (or None) on worksheet, or raise a KeyError explaining
+        why it can't be found.
+        """
+        if name is None:
+            if table is None:
+                raise KeyError("Expressions outside of tables must name the table they refer to")
+            return table, worksheet
+
+        if "!" in name:
             try:
-                table = ws.get_table(name)
-                return table, ws
+                return self.get_table(name)
             except KeyError:
-                pass
+                raise KeyError("Table '%s' not found" % name)
 
-        raise KeyError(name)
+        try:
+            return worksheet.get_table(name), worksheet
+        except KeyError:
+            pass
+
+        # bare names only refer to tables on the same sheet
+        sheets = [ws.name for _table, ws in self.__tables_by_name.get(name, ())]
+        if not sheets:
+            raise KeyError("Table '%s' not found" % name)
+        if len(sheets) > 1:
+            raise KeyError("Table name '%s' is ambiguous as it's on worksheets %s" %
+                           (name, ", ".join("'%s'" % x for x in sheets)))
+        raise KeyError("Table '%s' is on worksheet '%s' and must be referred to as '%s!%s'" %
+                       (name, sheets[0], sheets[0], name))
+
+    def _add_table(self, worksheet, table):
+        """called by Worksheet.add_table to add a table to the registry"""
+        if self.__sheet_order.get(id(worksheet)) is not None and not self.__registry_dirty:
+            self.__register_table(worksheet, table)
+
+    def __register_sheet(self, worksheet):
+        """add a worksheet and its tables to the registry"""
+        self.__sheet_order.setdefault(id(worksheet), len(self.__sheet_order))
+        if worksheet.name in self.__sheet_names:
+            _log.warning("Workbook has more than one worksheet named '%s'", worksheet.name)
+        self.__sheet_names.add(worksheet.name)
+        for table in worksheet._get_tables():
+            self.__register_table(worksheet, table)
+
+    def __register_table(self, worksheet, table):
+        """add a table to the registry"""
+        self.__tables_by_sheet.setdefault((worksheet.name, table.name), (table, worksheet))
+        tables = self.__tables_by_name.setdefault(table.name, [])
+        sheets = set(id(ws) for _table, ws in tables)
+        if len(sheets) == 1 and id(worksheet) not in sheets:
+            _log.warning("Table name '%s' is used on more than one worksheet. References to it "
+                         "from other worksheets should use the sheet name, e.g. '%s!%s'",
+                         table.name, tables[0][1].name, table.name)
+        tables.append((table, worksheet))
+        tables.sort(key=lambda x: self.__sheet_order[id(x[1])])
+
+    def __check_registry(self):
+        """rebuild the registry if the list of worksheets has been modified directly"""
+        if self.__registry_dirty:
+            self.__rebuild_registry()
+
+    def __rebuild_registry(self):
+        """rebuild the registry after the list of worksheets has been modified directly"""
+        self.__tables_by_name = {}
+        self.__tables_by_sheet = {}
+        self.__sheet_names = set()
+        self.__sheet_order = {}
+        self.__registry_dirty = False
+        for worksheet in self.worksheets:
+            self.__register_sheet(worksheet)
+            worksheet._add_workbook(self)
+
+
+class _WorksheetList(list):
+    """
+    Internal use - list of a workbook's worksheets that calls on_change whenever it's
+    modified, so the workbook knows its table registry needs rebuilding.
+    """
+    def __init__(self, on_change, worksheets=()):
+        super(_WorksheetList, self).__init__(worksheets)
+        self.__on_change = on_change
+
+    def _changed(self):
+        self.__on_change()
+
+
+def _notify_change(name):
+    """return a list method that calls _WorksheetList._changed after modifying the list"""
+    method = getattr(list, name)
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._changed()
+        return result
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in ("__setitem__", "__delitem__", "__iadd__", "__imul__", "append", "extend",
+              "insert", "remove", "pop", "clear", "sort", "reverse"):
+    setattr(_WorksheetList, _name, _notify_change(_name))
+del _name
+
+
+def _find_cycles(graph):
+    """
+    return a list of the cycles in a graph of {node -> list of nodes}, each as a
+    list of nodes. Every node in a cycle is in at least one of the cycles returned.
+    """
+    cycles = []
+    done = set()
+    for start in graph:
+        if start in done:
+            continue
+        # depth first search, with the path to the current node kept on a stack
+        path, on_path = [], {}
+        stack = [(start, iter(graph.get(start, ())))]
+        path.append(start)
+        on_path[start] = 0
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if child in on_path:
+                    cycles.append(path[on_path[child]:])
+                elif child not in done:
+                    on_path[child] = len(path)
+                    path.append(child)
+                    stack.append((child, iter(graph.get(child, ()))))
+                    break
+            else:
+                stack.pop()
+                done.add(path.pop())
+                del on_path[node]
+    return cycles
+
+
+# marker for values not found in the formula cache
+_MISSING = object()
+
+# characters that can't be used in Excel table names
+_invalid_table_name_chars_re = re.compile(r"[^\w\\.]")
+
+# table names that Excel would take as cell references
+_cell_like_name_re = re.compile(r"^([a-zA-Z]{1,3}\d+|[rcRC]|[rcRC]\d+[rcRC]\d+)$")
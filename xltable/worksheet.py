@@ -6,14 +6,22 @@ the rows can be iterated over, and any expressions present in the
 tables will be resolved to absolute cell references.
 """
 from .style import CellStyle
-from .table import ArrayFormula, Value
+from .table import ArrayFormula, LazyTable, Value
 from .expression import Expression
 import re
+import bisect
+import logging
+import weakref
 import datetime as dt
 import pandas as pa
 import numpy as np
 from copy import copy
 
+_log = logging.getLogger(__name__)
+
+# number of columns in an Excel worksheet
+_MAX_COLS = 16384
+
 
 class Worksheet(object):
     """
@@ -29,12 +37,29 @@ class Worksheet(object):
 
     def __init__(self, name="Sheet1"):
         self.__name = name
+        self.__formula_values = {}
         self.__tables = {}
         self.__values = {}
         self.__charts = []
         self.__next_row = 0
         self.__groups = []
 
+        # index of the tables and values on the sheet by position
+        self.__index = _RectangleIndex()
+
+        # data, styles and column widths worked out ahead of writing by _prepare
+        self.__prepared = None
+
+        # Resolved tables and styles kept between exports when the workbook is incremental
+        # (see Workbook.set_incremental). The version is incremented whenever a table or
+        # value is added, so anything depending on what's on the sheet can tell it's changed.
+        self.__resolved = {}            # {table name -> _ResolvedTable}
+        self.__style_layers = {}        # {style layer args -> (state, _StyleLayers)}
+        self.__version = 0
+
+        # workbooks the worksheet has been added to, which are told about any tables added
+        self.__workbooks = weakref.WeakSet()
+
     @property
     def name(self):
         """Worksheet name"""
@@ -57,6 +82,20 @@ class Worksheet(object):
             row = self.__next_row
         self.__next_row = max(row + table.height + row_spaces, self.__next_row)
         self.__tables[name] = (table, (row, col))
+        self.__version += 1
+
+        bottom, right = row + table.height - 1, col + table.width - 1
+        for other in self.__index.find(row, col, bottom, right):
+            if isinstance(other, tuple):
+                _log.warning("Table '%s' overlaps the value at %s on worksheet '%s'",
+                             name, other, self.name)
+            else:
+                _log.warning("Table '%s' overlaps table '%s' on worksheet '%s'",
+                             name, other.name, self.name)
+        self.__index.add(row, col, bottom, right, table)
+
+        for workbook in self.__workbooks:
+            workbook._add_table(self, table)
         return row, col
 
     def add_value(self, value, row, col):
@@ -68,7 +107,13 @@ class Worksheet(object):
         :param row: Row where the value should be written.
         :param col: Column where the value should be written.
         """
+        if (row, col) not in self.__values:
+            for other in self.__index.find(row, col, row, col):
+                _log.warning("Value at %s overlaps table '%s' on worksheet '%s'",
+                             (row, col), other.name, self.name)
+            self.__index.add(row, col, row, col, (row, col))
         self.__values[(row, col)] = value
+        self.__version += 1
 
     def add_chart(self, chart, row, col):
         """
@@ -112,78 +157,527 @@ class Worksheet(object):
         table, (_row, _col) = self.__tables[tablename]
         return table
 
+    def _add_workbook(self, workbook):
+        """called by Workbook.add_sheet so the workbook's table registry is kept up to date"""
+        self.__workbooks.add(workbook)
+
+    def _get_tables(self):
+        """return the list of tables on the worksheet, in the order they were added"""
+        return [table for name, (table, _pos) in self.__tables.items() if name is not None]
+
+    def _iter_expressions(self):
+        """
+        Yield (location, table, expression, after_tables) for each distinct expression in the
+        sheet's tables (see Table._iter_expressions), values and charts, where location describes
+        where the expression is, table is the table it's in, or None, and after_tables is True
+        if the expression is resolved after all of the sheet's tables have been written.
+        """
+        for table in self._get_tables():
+            for expr in table._iter_expressions():
+                yield "table '%s'" % table.name, table, expr, False
+        for (row, col), value in self.__values.items():
+            if isinstance(value, Value):
+                value = value.value
+            if isinstance(value, Expression):
+                yield "value at %s" % ((row, col),), None, value, False
+        for chart, (row, col) in self.__charts:
+            for expr in chart._iter_expressions():
+                yield "chart at %s" % ((row, col),), None, expr, True
+
     def iterrows(self, workbook=None):
         """
         Yield rows as lists of data.
 
         The data is exactly as it is in the source pandas DataFrames and
         any formulas are not resolved.
+
+        Tables are resolved as the rows they start on are reached, and released
+        once their last row has been yielded, so only the tables overlapping the
+        current row are held at once.
         """
-        resolved_tables = []
+        _height, width = self._get_size()
+        for r, blocks, values in self._iter_row_parts(workbook):
+            row = [None] * width
+            for table, top, col, data in blocks:
+                row_values = data[r - top]
+                row[col:col + len(row_values)] = row_values.tolist()
+            for c, value in values:
+                row[c] = value
+            yield row
+
+    def _get_size(self):
+        """return (height, width) of the area covered by the tables and values"""
         max_height = 0
         max_width = 0
+        for table, (row, col) in self.__tables.values():
+            max_height = max(max_height, row + table.height)
+            max_width = max(max_width, col + table.width)
+        for (row, col) in self.__values:
+            max_height = max(max_height, row + 1)
+            max_width = max(max_width, col + 1)
+        return max_height, max_width
+
+    def _get_tables_by_row(self):
+        """
+        return a list of (top, i, table, col) for the tables on the sheet in the order
+        they're resolved, where i is the order the table was added in.
+        """
+        # tables are resolved in order of their top row, and where tables overlap the
+        # table added last is written last
+        tables = [(row, i, table, col) for i, (table, (row, col)) in enumerate(self.__tables.values())]
+        tables.sort(key=lambda x: (x[0], x[1]))
+        return tables
 
-        # while yielding rows __formula_values is updated with any formula values set on Expressions
-        self.__formula_values = {}
-
-        for name, (table, (row, col)) in list(self.__tables.items()):
-            # get the resolved 2d data array from the table
-            #
-            # expressions with no explicit table will use None when calling
-            # get_table/get_table_pos, which should return the current table.
-            #
-            self.__tables[None] = (table, (row, col))
-            data = table.get_data(workbook, row, col, self.__formula_values)
-            del self.__tables[None]
+    def _resolve_table(self, workbook, table, top, col, formula_values, shared_formulas=None):
+        """
+        return the resolved 2d data array for a table on this sheet.
 
-            height, width = data.shape
-            upper_left = (row, col)
-            lower_right = (row + height - 1, col + width - 1)
+        If the workbook is incremental the data is kept, and reused by the next export
+        if neither the table nor the tables it refers to have changed since.
 
-            max_height = max(max_height, lower_right[0] + 1)
-            max_width = max(max_width, lower_right[1] + 1)
-            
-            resolved_tables.append((name, data, upper_left, lower_right))
+        :param dict shared_formulas: Dictionary to add the ranges of any shared formulas
+                                     in the table to (see Table.get_data), or None.
+        """
+        if workbook is not None and workbook.incremental:
+            resolved = self.__get_resolved_table(workbook, table, top, col, shared_formulas is not None)
+            data, table_shared_formulas = resolved.data, resolved.shared_formulas
+            formula_values.update(resolved.formula_values)
+        elif shared_formulas is None:
+            return self.__get_table_data(workbook, table, top, col, formula_values)
+        else:
+            table_shared_formulas = {}
+            data = self.__get_table_data(workbook, table, top, col, formula_values, table_shared_formulas)
+
+        if shared_formulas is not None and table_shared_formulas:
+            self.__add_shared_formulas(table, table_shared_formulas, shared_formulas)
+        return data
+
+    def __add_shared_formulas(self, table, table_shared_formulas, shared_formulas):
+        """add the ranges of a table's shared formulas that can be written to shared_formulas"""
+        # A shared formula can only be used if all of its cells get written, so
+        # any overlapping other tables or values are written as normal formulas.
+        others = [(r, c, r + t.height, c + t.width)
+                  for t, (r, c) in self.__tables.values() if t is not table]
+        others.extend((r, c, r + 1, c + 1) for r, c in self.__values)
+        for (first, c), last in table_shared_formulas.items():
+            if not any(r0 <= last and first < r1 and c0 <= c < c1 for r0, c0, r1, c1 in others):
+                shared_formulas[(first, c)] = last
+
+    def __iter_lazy_blocks(self, workbook, table, top, col, formula_values, shared_formulas=None):
+        """
+        Yield (chunk, top, col, data) for each chunk of a LazyTable's data as it's read,
+        where chunk is a _LazyTableChunk that's written in place of the table and top is
+        the row the chunk's data starts on. The header is included in the first chunk.
+        """
+        first_row = 0
+        for df in table.iter_chunks():
+            if len(df.index):
+                yield self.__get_lazy_block(workbook, table, top, col, df, first_row, formula_values,
+                                            shared_formulas)
+                first_row += len(df.index)
+
+        # a table without any data still has its header
+        if first_row == 0 and table.header_height:
+            yield self.__get_lazy_block(workbook, table, top, col, table.dataframe, 0, formula_values,
+                                        shared_formulas)
+
+    def __get_lazy_block(self, workbook, table, top, col, df, first_row, formula_values, shared_formulas):
+        """return a (chunk, top, col, data) block for a chunk of a LazyTable (see __iter_lazy_blocks)"""
+        header = first_row == 0
+        table_shared_formulas = {} if shared_formulas is not None else None
+        self.__tables[None] = (table, (top, col))
+        try:
+            data = table.get_chunk_data(workbook, top, col, df, first_row, header,
+                                        formula_values, table_shared_formulas)
+        finally:
+            del self.__tables[None]
+        if table_shared_formulas:
+            self.__add_shared_formulas(table, table_shared_formulas, shared_formulas)
+        chunk_top = top if header else top + table.header_height + first_row
+        return _LazyTableChunk(table, df, header), chunk_top, col, data
+
+    def __get_table_data(self, workbook, table, top, col, formula_values, shared_formulas=None):
+        """return table.get_data with the table set as the current table on this sheet"""
+        # expressions with no explicit table will use None when calling
+        # get_table/get_table_pos, which should return the current table.
+        self.__tables[None] = (table, (top, col))
+        try:
+            return table.get_data(workbook, top, col, formula_values, shared_formulas)
+        finally:
+            del self.__tables[None]
 
-        for row, col in self.__values.keys():
-            max_width = max(max_width, row+1)
-            max_height = max(max_height, col+1)
+    def __get_resolved_table(self, workbook, table, top, col, shared_formulas):
+        """
+        return a _ResolvedTable for a table on this sheet, reusing the one kept from the
+        last export if the table and everything it depends on are unchanged.
+        """
+        state = (id(workbook),
+                 top,
+                 col,
+                 workbook._get_table_fingerprint(table),
+                 workbook.evaluate_formulas,
+                 shared_formulas)
+        resolved = self.__resolved.get(table.name)
+        if resolved is not None \
+                and resolved.table is table \
+                and resolved.state == state \
+                and resolved.dependencies is not None \
+                and self.__get_dependency_state(workbook, resolved.dependencies) == resolved.dependency_state:
+            _log.debug("Reusing the resolved data for table '%s' on worksheet '%s'", table.name, self.name)
+            return resolved
+
+        formula_values = {}
+        table_shared_formulas = {} if shared_formulas else None
+        data = self.__get_table_data(workbook, table, top, col, formula_values, table_shared_formulas)
+        dependencies = self.__get_dependencies(workbook, table)
+        resolved = _ResolvedTable(table,
+                                  state,
+                                  dependencies,
+                                  self.__get_dependency_state(workbook, dependencies),
+                                  data,
+                                  formula_values,
+                                  table_shared_formulas)
+        self.__resolved[table.name] = resolved
+        return resolved
+
+    def __get_dependencies(self, workbook, table):
+        """
+        return a list of (table, worksheet) for the tables a table on this sheet refers to,
+        directly or through other tables, or None if they can't all be found.
+        """
+        dependencies = []
+        seen = {id(table)}
+        pending = [(table, self)]
+        while pending:
+            referrer, worksheet = pending.pop()
+            names = workbook._get_referenced_tables(referrer)
+            if names is None:
+                return None
+            for name in names:
+                # names are resolved as Workbook.get_table does with the referrer's sheet active
+                try:
+                    if isinstance(name, str) and "!" in name:
+                        dependency = workbook.get_table(name)
+                    else:
+                        dependency = (worksheet.get_table(name), worksheet)
+                except KeyError:
+                    return None
+                if id(dependency[0]) not in seen:
+                    seen.add(id(dependency[0]))
+                    dependencies.append(dependency)
+                    pending.append(dependency)
+        return dependencies
+
+    @staticmethod
+    def __get_dependency_state(workbook, dependencies):
+        """
+        return a tuple describing the tables in dependencies (see __get_dependencies) that
+        changes if any of them change or move, or anything is added to their sheets.
+        """
+        if dependencies is None:
+            return None
+        return tuple((id(table),
+                      id(worksheet),
+                      worksheet.name,
+                      worksheet.__version,
+                      worksheet.get_table_pos(table.name),
+                      workbook._get_table_fingerprint(table))
+                     for table, worksheet in dependencies)
+
+    def _clear_resolved(self):
+        """discard the tables' data and styles kept for incremental exports"""
+        self.__resolved = {}
+        self.__style_layers = {}
+
+    def _prepare(self, workbook, native=False, shared_formulas=False):
+        """
+        Resolve the data of all the tables on the sheet and work out the styles and
+        column widths ahead of writing the sheet, so that sheets can be prepared
+        concurrently. The prepared data is used and released by the next call to to_xlsx.
 
-        # Build the whole table up-front. Doing it row by row is too slow.
-        table = [[None] * max_width for i in range(max_height)]
-        for name, data, upper_left, lower_right in resolved_tables:
-            for i, r in enumerate(range(upper_left[0], lower_right[0]+1)):
-                for j, c in enumerate(range(upper_left[1], lower_right[1]+1)):
-                    table[r][c] = data[i][j]
+        :param bool native: The sheet will be written by the native xlsx engine.
+        :param bool shared_formulas: Find the formulas that can be written as shared formulas.
+        """
+        formula_values = {}
+        shared_formula_ranges = {} if shared_formulas else None
+        data = {}
+        for top, i, table, col in self._get_tables_by_row():
+            # lazy tables are read as they're written
+            if not isinstance(table, LazyTable):
+                data[i] = self._resolve_table(workbook, table, top, col, formula_values, shared_formula_ranges)
+        conditional_stripes = workbook.stripe_mode == "conditional"
+        excel_tables = native or workbook._excel_tables
+        self.__prepared = _PreparedWorksheet(data,
+                                             formula_values,
+                                             self.__get_style_layers(workbook, excel_tables, native,
+                                                                     conditional_stripes),
+                                             self._get_column_widths(),
+                                             shared_formula_ranges)
+
+    def _iter_row_parts(self, workbook=None, prepared=None, formula_values=None, shared_formulas=None):
+        """
+        Yield (row, blocks, values) for each row of the worksheet, where blocks is a list
+        of (table, top, left, data) for the tables overlapping the row in the order they
+        should be written, and values is a list of (col, value) for the single values
+        on the row with any expressions resolved.
+
+        :param prepared: _PreparedWorksheet to take the tables' data from instead of
+                         resolving the tables.
+        :param dict formula_values: Dictionary to record formula values in, if not prepared.
+        :param dict shared_formulas: Dictionary to record the ranges of shared formulas in as
+                                     each table is resolved (see Table.get_data), if not prepared.
+        """
+        # while yielding rows __formula_values is updated with any formula values set on Expressions
+        if prepared:
+            formula_values = prepared.formula_values
+        self.__formula_values = formula_values if formula_values is not None else {}
 
-        for (r, c), value in self.__values.items():
-            if isinstance(value, Value):
-                value = value.value
-            if isinstance(value, Expression):
-                if value.has_value:
-                    self.__formula_values[(r, c)] = value.value
-                value = value.get_formula(workbook, r, c)
-            table[r][c] = value
+        max_height, _width = self._get_size()
 
-        for row in table:
-            yield row
+        values_by_row = {}
+        for (row, col), value in self.__values.items():
+            values_by_row.setdefault(row, []).append((col, value))
+
+        pending = self._get_tables_by_row()
+        pending.reverse()
+        active = []
+
+        # {table number -> iterator of blocks} for lazy tables that are still being read
+        lazy_blocks = {}
+
+        r = 0
+        while r < max_height:
+            # resolve any tables starting on this row
+            while pending and pending[-1][0] <= r:
+                top, i, table, col = pending.pop()
+
+                if isinstance(table, LazyTable):
+                    # lazy tables are read and resolved a chunk at a time
+                    assert table.height_known or (not pending and all(vr < top for vr in values_by_row)), \
+                        "Table '%s' has an unknown number of rows so must be the last table on worksheet '%s'" \
+                        % (table.name, self.name)
+                    lazy_blocks[i] = self.__iter_lazy_blocks(workbook, table, top, col,
+                                                             self.__formula_values, shared_formulas)
+                    block = next(lazy_blocks[i], None)
+                    if block is None:
+                        del lazy_blocks[i]
+                        continue
+                else:
+                    # get the resolved 2d data array from the table
+                    if prepared:
+                        data = prepared.data.pop(i)
+                    else:
+                        data = self._resolve_table(workbook, table, top, col, self.__formula_values, shared_formulas)
+                    block = (table, top, col, data)
+
+                if block[3].shape[0] > 0:
+                    active.append((i, block))
+                    active.sort(key=lambda x: x[0])
+                    max_height = max(max_height, block[1] + block[3].shape[0])
+
+            blocks = [block for _i, block in active]
+
+            # release any tables that finish on this row, reading the next chunk of any lazy tables
+            still_active = []
+            for i, block in active:
+                if block[1] + block[3].shape[0] > r + 1:
+                    still_active.append((i, block))
+                elif i in lazy_blocks:
+                    block = next(lazy_blocks[i], None)
+                    if block is None:
+                        del lazy_blocks[i]
+                        continue
+                    still_active.append((i, block))
+                    max_height = max(max_height, block[1] + block[3].shape[0])
+            active = still_active
+
+            values = []
+            for c, value in values_by_row.pop(r, ()):
+                if isinstance(value, Value):
+                    value = value.value
+                if isinstance(value, Expression):
+                    if value.has_value:
+                        self.__formula_values[(r, c)] = value.value
+                    elif workbook is not None and workbook.evaluate_formulas:
+                        evaluated = value.evaluate(workbook, [r], c)
+                        if evaluated is not None and evaluated[0] is not None:
+                            self.__formula_values[(r, c)] = evaluated[0]
+                    value = value.get_formula(workbook, r, c)
+                values.append((c, value))
+
+            yield r, blocks, values
+            r += 1
+
+    def _release(self):
+        """release any data kept from the last time the rows were iterated over or prepared"""
+        self.__formula_values = {}
+        self.__prepared = None
  
-    def to_csv(self, writer):
+    def to_csv(self, writer, workbook=None, values=False):
         """
         Writes worksheet to a csv.writer object.
+
+        Rows covered by the same tables are copied from the tables' data a block
+        at a time and written in chunks using writer.writerows.
+
         :param writer: csv writer instance.
+        :param xltable.Workbook workbook: Workbook the worksheet is in, used to resolve
+            expressions referencing tables on other worksheets.
+        :param bool values: Write the values of any formulas (see :py:attr:`xltable.Expression.value`)
+            instead of the formulas. Formulas without a value are written as blanks.
+
+        NaN, inf and NaT values are written as empty fields.
         """
-        for row in self.iterrows():
-            writer.writerow(row)
+        for rows in self._iter_csv_chunks(workbook, values):
+            writer.writerows(rows)
+
+    def _iter_csv_chunks(self, workbook=None, values=False, chunk_size=None):
+        """
+        Yield the rows of the worksheet as lists of up to about chunk_size rows.
+
+        Consecutive rows covered by the same tables, and without any single values,
+        are copied from the tables' data as a single block.
+        """
+        chunk_size = chunk_size or _CSV_CHUNK_SIZE
+        _height, width = self._get_size()
+        formula_values = {}
+
+        # {id(data) -> (data, data as written to the csv file)} for the current tables
+        csv_data = {}
+
+        chunk = []
+        run_start, run_blocks, run_key = None, None, None
+        for r, blocks, row_values in self._iter_row_parts(workbook, formula_values=formula_values):
+            key = [id(data) for _table, _top, _left, data in blocks]
+
+            if key != run_key:
+                for data_id in set(csv_data) - set(key):
+                    del csv_data[data_id]
+                for table, top, left, data in blocks:
+                    if id(data) not in csv_data:
+                        table_values = formula_values if values else None
+                        csv_data[id(data)] = (data, _get_csv_data(table, top, left, data, table_values))
+            blocks = [(table, top, left, csv_data[id(data)][1]) for table, top, left, data in blocks]
+            if values:
+                row_values = [(c, formula_values.get((r, c)) if _is_formula(value) else value)
+                              for c, value in row_values]
+            row_values = [(c, "" if _is_nan(value) else value) for c, value in row_values]
+
+            # write out the current run of rows if it can't be extended by this row
+            if run_start is not None \
+                    and (key != run_key or row_values or r - run_start >= chunk_size):
+                chunk.extend(_get_csv_block(run_blocks, run_start, r - run_start, width))
+                run_start = None
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+
+            if row_values:
+                row = _get_csv_block(blocks, r, 1, width)[0]
+                for c, value in row_values:
+                    row[c] = value
+                chunk.append(row)
+            elif run_start is None:
+                run_start, run_blocks, run_key = r, blocks, key
+
+        if run_start is not None:
+            chunk.extend(_get_csv_block(run_blocks, run_start, r + 1 - run_start, width))
+        if chunk:
+            yield chunk
+
+    def _is_in_array_formula_table(self, row, col):
+        """returns True if this cell is part of an array formula table"""
+        return any(isinstance(x, ArrayFormula) for x in self.__index.find(row, col, row, col))
+
+    def _get_array_formula_tables(self, row):
+        """
+        return a list of (table, top, left, right) for the array formula tables
+        that include a row.
+        """
+        tables = []
+        for table in self.__index.find(row, 0, row, _MAX_COLS):
+            if isinstance(table, ArrayFormula):
+                top, left = self.get_table_pos(table.name)
+                tables.append((table, top, left, left + table.width - 1))
+        return tables
+
+    def _write_xlsx_array_formula_row(self, workbook, ws, row, table, top, left, data, row_styles):
+        """write the cells of an array formula table on a row to an xlsxwriter worksheet"""
+        for ic, cell in enumerate(data[row - top].tolist(), left):
+            style = row_styles[ic]
+            if (row, ic) == (top, left):
+                bottom, right = (top + table.height - 1, left + table.width - 1)
+                formula = table.formula.get_formula(workbook, top, left)
+                ws.write_array_formula(top, left, bottom, right, formula, style, value=cell)
+            elif isinstance(cell, str):
+                cell_str = cell.encode("ascii", "xmlcharrefreplace").decode("ascii")
+                ws.write_formula(row, ic, cell_str, style)
+            else:
+                ws.write(row, ic, cell, style)
+
+    def _add_xlsx_excel_table(self, workbook, ws, table, top, left):
+        """add a table written as an Excel table to an xlsxwriter worksheet"""
+        # Excel tables need at least one row below the header
+        bottom = top + max(table.height, 2) - 1
+        ws.add_table(top, left, bottom, left + table.width - 1, {
+            "name": workbook._get_excel_table_name(table),
+            "style": table.style.excel_table_style,
+            "columns": [{"header": name} for name in table.get_excel_column_names()],
+            "first_column": table.row_labels_width > 0,
+        })
+
+    def _write_xlsx_cell(self, ws, row, col, cell, style, nan_policy):
+        """write a single cell of any type to an xlsxwriter worksheet"""
+        if isinstance(cell, str):
+            if cell.startswith("="):
+                formula_value = self.__formula_values.get((row, col), 0)
+                ws.write_formula(row, col, cell, style, value=formula_value)
+            elif cell.startswith("{="):
+                formula_value = self.__formula_values.get((row, col), 0)
+                ws.write_array_formula(row, col, row, col,
+                                       cell, style,
+                                       value=formula_value)
+            else:
+                ws.write(row, col, cell, style)
+        elif isinstance(cell, float) and not np.isfinite(cell):
+            _write_xlsx_nan(ws, row, col, style, nan_policy)
+        elif cell is pa.NaT:
+            _write_xlsx_nan(ws, row, col, style, nan_policy)
+        else:
+            if isinstance(cell, self._xlsx_unsupported_types):
+                ws.write(row, col, str(cell), style)
+            else:
+                try:
+                    ws.write(row, col, cell, style)
+                except TypeError:
+                    ws.write(row, col, str(cell), style)
+                    unsupported_types = set(self._xlsx_unsupported_types)
+                    unsupported_types.add(type(cell))
+                    self.__class__._xlsx_unsupported_types = tuple(unsupported_types)
+
+    def _get_group_rows(self):
+        """return a dictionary of {row -> {'level': level, 'hidden': hidden}} for rows in groups"""
+        group_rows = {}
+        for tables, collapsed in self.__groups:
+            min_row, max_row = 1000000, -1
+
+            for table, (row, col) in self.__tables.values():
+                if table in tables:
+                    min_row = min(min_row, row)
+                    max_row = max(max_row, row + table.height)
+            for i in range(min_row, max_row+1):
+                group_rows[i] = {'level': 1, 'hidden': collapsed}
+        return group_rows
 
     def _get_column_widths(self):
         """return a dictionary of {col -> width}"""
         col_widths = {}
         for table, (row, col) in self.__tables.values():
             for colname, width in table.column_widths.items():
-                ic = col + table.get_column_offset(colname)
-                current_width = col_widths.setdefault(ic, width)
-                col_widths[ic] = max(width, current_width)
+                for col_offset in _iter_offsets(table.get_column_offset(colname)):
+                    ic = col + col_offset
+                    current_width = col_widths.setdefault(ic, width)
+                    col_widths[ic] = max(width, current_width)
         return col_widths
 
     def _get_all_styles(self):
@@ -191,6 +685,47 @@ class Worksheet(object):
         return a dictionary of {(row, col) -> CellStyle}
         for all cells that use a non-default style.
         """
+        style_layers = self._get_style_layers()
+        ws_styles = {}
+        for r in range(style_layers.height):
+            for c, style in enumerate(style_layers.get_row(r)):
+                if style is not None:
+                    ws_styles[(r, c)] = style
+        return ws_styles
+
+    def __get_style_layers(self, workbook, *args):
+        """
+        return _get_style_layers(*args), reusing the styles from the last export if the
+        workbook is incremental and nothing on the sheet has changed since.
+        """
+        if not workbook.incremental:
+            return self._get_style_layers(*args)
+        state = (self.__version,
+                 tuple((id(table),
+                        workbook._get_table_fingerprint(table),
+                        id(table.style),
+                        id(table.header_style),
+                        id(table.index_style))
+                       for table, _pos in self.__tables.values()))
+        cached_state, style_layers = self.__style_layers.get(args, (None, None))
+        if cached_state != state:
+            style_layers = self._get_style_layers(*args)
+            self.__style_layers[args] = (state, style_layers)
+        return style_layers
+
+    def _get_style_layers(self, excel_tables=False, custom_table_styles=False, conditional_stripes=False):
+        """
+        return a :py:class:`_StyleLayers` instance with the styled regions of
+        all the tables and values in the sheet.
+
+        :param bool excel_tables: The sheet is being written with Excel tables (see TableStyle),
+            so the default header, index and stripe styles of those tables come from their table
+            styles instead of being applied to each cell.
+        :param bool custom_table_styles: The writer can write custom table styles, and not
+            just refer to built-in ones.
+        :param bool conditional_stripes: The tables' stripe colors are written as conditional
+            formats (see _get_conditional_stripes) and aren't applied to each cell.
+        """
         _styles = {}
         def _get_style(bold=False, bg_col=None, border=None):
             if (bold, bg_col, border) not in _styles:
@@ -199,83 +734,161 @@ class Worksheet(object):
                                                             border=border)
             return _styles[(bold, bg_col, border)]
 
-        ws_styles = {}
+        layers = _StyleLayers()
         for table, (row, col) in self.__tables.values():
-            for r in range(row, row + table.header_height):
-                for c in range(col, col + table.width):
-                    if isinstance(table.header_style, dict):
-                        col_name = table.dataframe.columns[c - col]
-                        style = table.header_style.get(col_name, _get_style(bold=True))
-                    else:
-                        style = table.header_style or _get_style(bold=True)
-                    ws_styles[(r, c)] = style
-
-            for c in range(col, col + table.row_labels_width):
-                for r in range(row + table.header_height, row + table.height):
-                    if isinstance(table.index_style, dict):
-                        row_name = table.dataframe.index[r - row]
-                        style = table.index_style.get(row_name, _get_style(bold=True))
-                    else:
-                        style = table.index_style or _get_style(bold=True)
-                    ws_styles[(r, c)] = style
+            body_top = row + table.header_height
+            bottom = row + table.height - 1
+            if not table.height_known:
+                # the table's rows are styled to the bottom of the sheet as they're not known yet
+                bottom = _MAX_ROWS - 1
+            right = col + table.width - 1
+            table_styled = _is_table_styled(table, excel_tables, custom_table_styles)
+
+            if table.header_height and not (table_styled and table.header_style is None):
+                if isinstance(table.header_style, dict):
+                    layers.add(row, col, body_top - 1, right, _get_style(bold=True), _StyleLayers.REPLACE)
+                    for col_name, style in table.header_style.items():
+                        try:
+                            col_offsets = _iter_offsets(table.get_column_offset(col_name))
+                        except KeyError:
+                            continue
+                        for col_offset in col_offsets:
+                            c = col + col_offset
+                            layers.add(row, c, body_top - 1, c, style, _StyleLayers.REPLACE)
+                else:
+                    style = table.header_style or _get_style(bold=True)
+                    layers.add(row, col, body_top - 1, right, style, _StyleLayers.REPLACE)
+
+            if table.row_labels_width and not (table_styled and table.index_style is None):
+                index_right = col + table.row_labels_width - 1
+                if isinstance(table.index_style, dict):
+                    layers.add(body_top, col, bottom, index_right, _get_style(bold=True), _StyleLayers.REPLACE)
+                    for row_name, style in table.index_style.items():
+                        try:
+                            row_offsets = _iter_offsets(table.get_row_offset(row_name))
+                        except KeyError:
+                            continue
+                        for row_offset in row_offsets:
+                            r = row + row_offset
+                            layers.add(r, col, r, index_right, style, _StyleLayers.REPLACE)
+                else:
+                    style = table.index_style or _get_style(bold=True)
+                    layers.add(body_top, col, bottom, index_right, style, _StyleLayers.REPLACE)
 
-            if table.style.stripe_colors or table.style.border:
-                num_bg_cols = len(table.style.stripe_colors) if \
-                    table.style.stripe_colors else 1
-                bg_cols = table.style.stripe_colors if \
-                    table.style.stripe_colors else None
-
-                for i, row_offset in enumerate(range(table.header_height,
-                                                     table.height)):
-                    for c in range(col, col + table.width):
-                        bg_col = bg_cols[i % num_bg_cols] if bg_cols else None
-                        style = _get_style(bold=None, bg_col=bg_col, border=table.style.border)
-                        if (row + row_offset, c) in ws_styles:
-                            style = style + ws_styles[(row + row_offset, c)]
-                        ws_styles[(row + row_offset, c)] = style
+            # stripes go underneath the header and index styles, alternating every row
+            if (table.style.stripe_colors or table.style.border) and not table_styled:
+                bg_cols = table.style.stripe_colors or (None,)
+                if conditional_stripes:
+                    bg_cols = (None,)
+                styles = [_get_style(bold=None, bg_col=bg_col, border=table.style.border) for bg_col in bg_cols]
+                layers.add(body_top, col, bottom, right, styles, _StyleLayers.UNDER)
 
             for col_name, col_style in table.column_styles.items():
                 try:
-                    col_offset = table.get_column_offset(col_name)
+                    col_offsets = _iter_offsets(table.get_column_offset(col_name))
                 except KeyError:
                     continue
-                for i, r in enumerate(range(row + table.header_height, row + table.height)):
-                    style = col_style
-                    if (r, col + col_offset) in ws_styles:
-                        style = ws_styles[(r, col + col_offset)] + style
-                    ws_styles[(r, col + col_offset)] = style
+                for col_offset in col_offsets:
+                    c = col + col_offset
+                    layers.add(body_top, c, bottom, c, col_style, _StyleLayers.OVER)
 
             for row_name, row_style in table.row_styles.items():
                 try:
-                    row_offset = table.get_row_offset(row_name)
+                    row_offsets = _iter_offsets(table.get_row_offset(row_name))
                 except KeyError:
                     continue
-                for i, c in enumerate(range(col + table.row_labels_width, col + table.width)):
-                    style = row_style
-                    if (row + row_offset, c) in ws_styles:
-                        style = ws_styles[(row + row_offset, c)] + style
-                    ws_styles[(row + row_offset, c)] = style
+                for row_offset in row_offsets:
+                    r = row + row_offset
+                    layers.add(r, col + table.row_labels_width, r, right, row_style, _StyleLayers.OVER)
 
-            for (row_name, col_name), cell_style in table.cell_styles.items():
-                try:
-                    col_offset = table.get_column_offset(col_name)
-                    row_offset = table.get_row_offset(row_name)
-                except KeyError:
-                    continue
-                style = cell_style
-                if (row + row_offset, col + col_offset) in ws_styles:
-                    style = ws_styles[(row + row_offset, col + col_offset)] + style
-                ws_styles[(row + row_offset, col + col_offset)] = style
+            if not table.has_cell_styles:
+                continue
 
+            for row_offset, col_offset, cell_style in table.get_cell_style_offsets():
+                r, c = row + row_offset, col + col_offset
+                layers.add(r, c, r, c, cell_style, _StyleLayers.OVER)
+
+        # styles on single values go underneath any table styles
         for (row, col), value in self.__values.items():
-            if isinstance(value, Value):
-                style = value.style
-                if style:
-                    if (row, col) in ws_styles:
-                        style = style + ws_styles[(row, col)]
-                    ws_styles[(row, col)] = style
+            if isinstance(value, Value) and value.style:
+                layers.add(row, col, row, col, value.style, _StyleLayers.UNDER)
 
-        return ws_styles
+        return layers
+
+    def _get_conditional_stripes(self, excel_tables=False, custom_table_styles=False):
+        """
+        return a list of (ranges, formula, bg_color) for the conditional formats that write the
+        tables' stripes when the workbook's stripe mode is "conditional", where ranges is a list
+        of (top, left, bottom, right) for the cells the formula's background color applies to.
+
+        Cells with a background color from their index, column, row or cell style are left out,
+        as the conditional format would take precedence over it.
+        """
+        stripes = []
+        for table, (row, col) in self.__tables.values():
+            stripe_colors = table.style.stripe_colors
+            header_height, height, width = table.header_height, table.height, table.width
+            if (not stripe_colors
+                    or height <= header_height
+                    or _is_table_styled(table, excel_tables, custom_table_styles)):
+                continue
+
+            # {column offset -> set of row offsets} for the cells left out, or None for all rows
+            excluded = {}
+            def _exclude(row_offsets, col_offsets):
+                for c in col_offsets:
+                    if row_offsets is None:
+                        excluded[c] = None
+                    elif excluded.get(c, ()) is not None:
+                        excluded.setdefault(c, set()).update(row_offsets)
+
+            def _get_offsets(get_offset, label):
+                try:
+                    return _iter_offsets(get_offset(label))
+                except KeyError:
+                    return ()
+
+            labels_width = table.row_labels_width
+            if isinstance(table.index_style, dict):
+                for row_name, style in table.index_style.items():
+                    if _has_bg_color(style):
+                        _exclude(_get_offsets(table.get_row_offset, row_name), range(labels_width))
+            elif _has_bg_color(table.index_style):
+                _exclude(None, range(labels_width))
+
+            for col_name, style in table.column_styles.items():
+                if _has_bg_color(style):
+                    _exclude(None, _get_offsets(table.get_column_offset, col_name))
+
+            for row_name, style in table.row_styles.items():
+                if _has_bg_color(style):
+                    _exclude(_get_offsets(table.get_row_offset, row_name), range(labels_width, width))
+
+            if table.has_cell_styles:
+                for row_offset, col_offset, style in table.get_cell_style_offsets():
+                    if _has_bg_color(style):
+                        _exclude((row_offset,), (col_offset,))
+
+            # runs of rows for each column, with columns that have the same runs merged together
+            ranges = []
+            prev_runs, first_col = None, 0
+            for c in range(width + 1):
+                runs = None
+                if c < width:
+                    runs = _get_runs(header_height, height - 1, excluded.get(c, ()))
+                if runs != prev_runs:
+                    for r0, r1 in prev_runs or ():
+                        ranges.append((row + r0, col + first_col, row + r1, col + c - 1))
+                    prev_runs, first_col = runs, c
+
+            if not ranges:
+                continue
+            body_top = row + header_height
+            for i, bg_color in enumerate(stripe_colors):
+                if bg_color is not None:
+                    formula = "MOD(ROW()-%d,%d)=%d" % (body_top + 1, len(stripe_colors), i)
+                    stripes.append((ranges, formula, bg_color))
+        return stripes
 
     def to_excel(self,
                  workbook=None,
@@ -334,19 +947,6 @@ class Worksheet(object):
                 worksheet.Cells.Interior.ColorIndex = 0
                 worksheet.Cells.NumberFormat = "General"
 
-            # get any array formula tables
-            array_formula_tables = []
-            for table, (row, col) in self.__tables.values():
-                if isinstance(table, ArrayFormula):
-                    array_formula_tables.append((row, col, row + table.height, col + table.width))
-
-            def _is_in_array_formula_table(row, col):
-                """returns True if this formula cell is part of an array formula table"""
-                for top, left, bottom, right in array_formula_tables:
-                    if bottom >= row >= top and left <= col <= right:
-                        return True
-                return False
-
             origin = worksheet.Range("A1")
             xl_cell = origin
             for r, row in enumerate(self.iterrows(workbook)):
@@ -370,7 +970,7 @@ class Worksheet(object):
                             xl_cell.Offset(1, 1 + c).Value = formula_value
                             xl_cell.Offset(1, 1 + c).Formula = value
                         elif value.startswith("{=") \
-                        and not _is_in_array_formula_table(r, c):
+                        and not self._is_in_array_formula_table(r, c):
                             formula_value = self.__formula_values.get((r, c), 0)
                             xl_cell.Offset(1, 1 + c).Value = formula_value
                             xl_cell.Offset(1, 1 + c).FormulaArray = value
@@ -446,24 +1046,23 @@ class Worksheet(object):
             return workbook.to_xlsx()
         ws = workbook.add_xlsx_worksheet(self, self.name)
 
+        # use the data prepared ahead of time by _prepare, if any
+        prepared, self.__prepared = self.__prepared, None
+
         _styles = {}
+        _formats = {}
         def _get_xlsx_style(cell_style):
             """
             convert rb.excel style to xlsx writer style
             """
-            style_args = (
-                cell_style.bold,
-                cell_style.excel_number_format,
-                cell_style.text_color,
-                cell_style.bg_color,
-                cell_style.size,
-                cell_style.text_wrap,
-                cell_style.text_wrap,
-                cell_style.border,
-                cell_style.align,
-                cell_style.valign
-            )
-            if (style_args) not in _styles:
+            try:
+                return _styles[cell_style]
+            except KeyError:
+                pass
+
+            # styles that would be written the same way share a format
+            style_args = cell_style.format_key
+            if style_args not in _formats:
                 style = workbook.add_format()
                 if cell_style.bold:
                     style.set_bold()
@@ -497,85 +1096,98 @@ class Worksheet(object):
                 if cell_style.valign:
                     style.set_valign(cell_style.valign)
 
-                _styles[style_args] = style
+                _formats[style_args] = style
 
-            return _styles[style_args]
+            _styles[cell_style] = _formats[style_args]
+            return _styles[cell_style]
 
         # pre-compute the cells with non-default styles
-        ws_styles = self._get_all_styles()
-        ws_styles = {(r, c): _get_xlsx_style(s) for ((r, c), s) in ws_styles.items()}
-        plain_style = _get_xlsx_style(CellStyle())
-
-        # get any array formula tables
-        array_formula_tables = []
-        for table, (row, col) in self.__tables.values():
-            if isinstance(table, ArrayFormula):
-                array_formula_tables.append((row, col, row + table.height, col + table.width))
-
-        def _is_in_array_formula_table(row, col):
-            """returns True if this formula cell is part of an array formula table"""
-            for top, left, bottom, right in array_formula_tables:
-                if bottom >= row >= top and left <= col <= right:
-                    return True
-            return False
-
-        # write the rows to the worksheet
-        for ir, row in enumerate(self.iterrows(workbook)):
-            for ic, cell in enumerate(row):
-                style = ws_styles.get((ir, ic), plain_style)
-                if isinstance(cell, str):
-                    if cell.startswith("="):
-                        formula_value = self.__formula_values.get((ir, ic), 0)
-                        ws.write_formula(ir, ic, cell, style, value=formula_value)
-                    elif cell.startswith("{="):
-                        # array formulas tables are written after everything else,
-                        # but individual cells can also be array formulas
-                        if not _is_in_array_formula_table(ir, ic):
-                            formula_value = self.__formula_values.get((ir, ic), 0)
-                            ws.write_array_formula(ir, ic, ir, ic,
-                                                   cell, style,
-                                                   value=formula_value)
-                    else:
-                        ws.write(ir, ic, cell, style)
-                else:
-                    if isinstance(cell, self._xlsx_unsupported_types):
-                        ws.write(ir, ic, str(cell), style)
-                    else:
-                        try:
-                            ws.write(ir, ic, cell, style)
-                        except TypeError:
-                            ws.write(ir, ic, str(cell), style)
-                            unsupported_types = set(self._xlsx_unsupported_types)
-                            unsupported_types.add(type(cell))
-                            self.__class__._xlsx_unsupported_types = tuple(unsupported_types)
-
-        # set any array formulas
-        for table, (row, col) in self.__tables.values():
-            if isinstance(table, ArrayFormula):
-                style = ws_styles.get((row, col), plain_style)
-                data = table.get_data(workbook, row, col)
-                height, width = data.shape
-                bottom, right = (row + height - 1, col + width -1)
-                formula = table.formula.get_formula(workbook, row, col)
-                ws.write_array_formula(row, col, bottom, right, formula, style, value=data[0][0])
-
-                for y in range(height):
-                    for x in range(width):
-                        if y == 0 and x == 0:
-                            continue
-                        ir, ic = row + y, col + x
-                        style = ws_styles.get((ir, ic), plain_style)
-                        cell = data[y][x]
-                        if isinstance(cell, str):
-                            cell_str = cell.encode("ascii", "xmlcharrefreplace").decode("ascii")
-                            ws.write_formula(ir, ic, cell_str, style)
-                        else:
-                            ws.write(ir, ic, cell, style)
+        with workbook._track_memory(self, "styles"):
+            conditional_stripes = workbook.stripe_mode == "conditional"
+            excel_tables = workbook._excel_tables
+            style_layers = (prepared.style_layers if prepared
+                            else self.__get_style_layers(workbook, excel_tables, False, conditional_stripes))
+            plain_style = _get_xlsx_style(CellStyle())
+
+        # the xlsxwriter formats for each distinct row of styles, padded to the
+        # width of the sheet
+        _height, width = self._get_size()
+        _row_styles = {}
+        def _get_xlsx_row_styles(row):
+            cell_styles = style_layers.get_row(row)
+            try:
+                return _row_styles[id(cell_styles)]
+            except KeyError:
+                pass
+            xlsx_styles = [_get_xlsx_style(s) if s is not None else plain_style for s in cell_styles]
+            xlsx_styles.extend([plain_style] * (width - len(xlsx_styles)))
+            _row_styles[id(cell_styles)] = xlsx_styles
+            return xlsx_styles
+
+        # options for any rows in groups, set as each row is written
+        group_rows = self._get_group_rows()
+
+        # Write the rows to the worksheet. Everything in a row (including the row
+        # options and array formulas) is written before moving on to the next row so
+        # that xlsxwriter can write out each row as it's finished when its
+        # constant_memory option is used.
+        #
+        # Each table is written by a _XlsxTableWriter, which works out how to write
+        # each column once when the table is first reached rather than checking
+        # the type of every cell.
+        nan_policy = workbook.nan_policy
+        with workbook._track_memory(self, "cells"):
+            writers = {}
+            for ir, blocks, values in self._iter_row_parts(workbook, prepared):
+                if ir in group_rows:
+                    ws.set_row(ir, None, None, group_rows.pop(ir))
+
+                row_styles = _get_xlsx_row_styles(ir)
+                for table, top, left, data in blocks:
+                    if isinstance(table, ArrayFormula):
+                        self._write_xlsx_array_formula_row(workbook, ws, ir, table, top, left, data, row_styles)
+                        continue
+
+                    writer = writers.get(id(data))
+                    if writer is None:
+                        writer = _XlsxTableWriter(self, ws, table, top, left, data,
+                                                  self.__formula_values, nan_policy)
+                        writers[id(data)] = writer
+                        if table.is_excel_table and excel_tables:
+                            self._add_xlsx_excel_table(workbook, ws, table, top, left)
+                    writer.write_row(ir, row_styles)
+
+                    # release the writer after the last row of the table
+                    if ir == top + data.shape[0] - 1:
+                        del writers[id(data)]
+
+                for ic, value in values:
+                    self._write_xlsx_cell(ws, ir, ic, value, row_styles[ic], nan_policy)
+
+            # any grouped rows below the last row written
+            for i in sorted(group_rows):
+                ws.set_row(i, None, None, group_rows[i])
+                if ws.constant_memory:
+                    # xlsxwriter only writes out rows with cells in constant_memory mode
+                    ws.write_blank(i, 0, None, plain_style)
 
         # set any non-default column widths
-        for ic, width in self._get_column_widths().items():
+        column_widths = prepared.column_widths if prepared else self._get_column_widths()
+        for ic, width in column_widths.items():
             ws.set_column(ic, ic, width)
 
+        # add the tables' stripes as conditional formats
+        if conditional_stripes:
+            from xlsxwriter.utility import xl_range
+            stripe_formats = {}
+            for ranges, formula, bg_color in self._get_conditional_stripes(excel_tables=excel_tables):
+                if bg_color not in stripe_formats:
+                    stripe_formats[bg_color] = workbook.add_format({"bg_color": "#%06x" % bg_color})
+                options = {"type": "formula", "criteria": "=" + formula, "format": stripe_formats[bg_color]}
+                if len(ranges) > 1:
+                    options["multi_range"] = " ".join(xl_range(*r) for r in ranges)
+                ws.conditional_format(*ranges[0], options)
+
         # add any charts
         for chart, (row, col) in self.__charts:
             kwargs = {"type": chart.type}
@@ -614,21 +1226,298 @@ class Worksheet(object):
 
             ws.insert_chart(row, col, xl_chart)
 
-        # add any groups
-        for tables, collapsed in self.__groups:
-            min_row, max_row = 1000000, -1
-
-            for table, (row, col) in self.__tables.values():
-                if table in tables:
-                    min_row = min(min_row, row)
-                    max_row = max(max_row, row + table.height)
-            for i in range(min_row, max_row+1):
-                ws.set_row(i, None, None, {'level': 1, 'hidden': collapsed})
-
         if filename:
             workbook.close()
         return workbook
 
+    def _to_native_xlsx(self, workbook, writer, shared_formulas=False):
+        """
+        Write the worksheet using the native xlsx writer (see Workbook.to_xlsx).
+
+        :param xltable.Workbook workbook: Workbook this sheet belongs to.
+        :param xltable.native.NativeXlsxWriter writer: Writer for the file being written.
+        :param bool shared_formulas: Write formulas filled down columns as shared formulas.
+        """
+        from .native import NativeTableWriter
+        assert not self.__charts, "Charts can't be written using the native xlsx engine"
+
+        # use the data prepared ahead of time by _prepare, if any
+        prepared, self.__prepared = self.__prepared, None
+
+        conditional_stripes = workbook.stripe_mode == "conditional"
+        with workbook._track_memory(self, "styles"):
+            style_layers = (prepared.style_layers if prepared
+                            else self.__get_style_layers(workbook, True, True, conditional_stripes))
+        column_widths = prepared.column_widths if prepared else self._get_column_widths()
+        group_rows = self._get_group_rows()
+        height, width = self._get_size()
+        if group_rows:
+            height = max(height, max(group_rows) + 1)
+        if not all(table.height_known for table in self._get_tables()):
+            # the sheet's dimension is left out if the height isn't known until it's written
+            height = 0
+
+        # formula values and shared formula ranges are recorded as the rows are iterated over
+        formula_values = prepared.formula_values if prepared else {}
+        shared_formula_ranges = None
+        if shared_formulas:
+            shared_formula_ranges = prepared.shared_formulas if prepared else {}
+
+        sheet = writer.add_worksheet(self.name)
+        with workbook._track_memory(self, "cells"):
+            try:
+                sheet.open(height, width, style_layers,
+                           column_widths=column_widths,
+                           outline_level=max([x["level"] for x in group_rows.values()] or [0]),
+                           nan_policy=workbook.nan_policy,
+                           formula_values=formula_values,
+                           shared_formulas=shared_formula_ranges)
+
+                for table, (row, col) in self.__tables.values():
+                    if table.is_excel_table:
+                        # Excel tables need at least one row below the header
+                        sheet.add_table(row, col, row + max(table.height, 2) - 1, col + table.width - 1,
+                                        workbook._get_excel_table_name(table),
+                                        table.get_excel_column_names(),
+                                        table.style,
+                                        table.row_labels_width > 0)
+
+                # Each table is formatted by a NativeTableWriter, and the cells of any
+                # overlapping tables and values are merged by column.
+                writers = {}
+                for ir, blocks, values in self._iter_row_parts(workbook, prepared, formula_values,
+                                                               shared_formula_ranges):
+                    if len(blocks) == 1 and not values and not isinstance(blocks[0][0], ArrayFormula):
+                        table, top, left, data = blocks[0]
+                        table_writer = writers.get(id(data))
+                        if table_writer is None:
+                            table_writer = writers[id(data)] = NativeTableWriter(sheet, table, top, left, data, formula_values)
+                        cells = table_writer.get_row(ir)
+                    else:
+                        cells_by_col = {}
+                        for table, top, left, data in blocks:
+                            native_cells = self._get_native_xlsx_cells(workbook, sheet, writers, ir, table, top, left, data)
+                            cells_by_col.update(enumerate(native_cells, left))
+                        row_attrs = sheet.get_row_attrs(ir)
+                        for ic, value in values:
+                            cells_by_col[ic] = sheet.get_cell(ir, ic, value, row_attrs[ic])
+                        cells = "".join(cells_by_col[ic] for ic in sorted(cells_by_col))
+
+                    group = group_rows.pop(ir, None) or {}
+                    sheet.write_row(ir, cells, group.get("level", 0), group.get("hidden", False))
+
+                    # release the writers for any tables that end on this row
+                    for table, top, left, data in blocks:
+                        if ir == top + data.shape[0] - 1:
+                            writers.pop(id(data), None)
+
+                # any grouped rows below the last row written
+                for ir in sorted(group_rows):
+                    sheet.write_row(ir, "", group_rows[ir]["level"], group_rows[ir]["hidden"])
+
+                # the stripes are added once all the rows are written, when the heights
+                # of any lazy tables are known
+                if conditional_stripes:
+                    for ranges, formula, bg_color in self._get_conditional_stripes(True, True):
+                        sheet.add_conditional_format(ranges, formula, bg_color)
+            finally:
+                sheet.close()
+
+    def _get_native_xlsx_cells(self, workbook, sheet, writers, row, table, top, left, data):
+        """return the native xlsx cells for a table on a row"""
+        from .native import NativeTableWriter
+        if isinstance(table, ArrayFormula):
+            row_attrs = sheet.get_row_attrs(row)
+            cells = []
+            for ic, cell in enumerate(data[row - top].tolist(), left):
+                attrs = row_attrs[ic]
+                if (row, ic) == (top, left):
+                    ref = sheet.get_letter(left) + str(top + 1)
+                    range_ref = "%s:%s%d" % (ref, sheet.get_letter(left + table.width - 1), top + table.height)
+                    formula = table.formula.get_formula(workbook, top, left)
+                    cells.append(sheet.get_array_formula_cell(ref, range_ref, attrs, formula, cell))
+                elif isinstance(cell, str):
+                    # cells within the array formula only store their cached values
+                    cells.append(sheet.get_cell(row, ic, None, attrs))
+                else:
+                    cells.append(sheet.get_cell(row, ic, cell, attrs))
+            return cells
+
+        writer = writers.get(id(data))
+        if writer is None:
+            writer = writers[id(data)] = NativeTableWriter(sheet, table, top, left, data, self.__formula_values)
+        return writer.get_cells(row)
+
+
+class _RectangleIndex(object):
+    """
+    Internal use - index of rectangles for finding the items at a cell or
+    overlapping a range.
+
+    Rows are split into bands at the top and bottom of every rectangle and each
+    band keeps the rectangles covering it, so finding the items at a row is a
+    binary search for its band followed by a scan of the rectangles in that band.
+    """
+    def __init__(self):
+        # first row of each band, and the (left, right, item) tuples covering each band
+        self.__bounds = []
+        self.__bands = []
+
+    def __split(self, row):
+        """make sure a band starts at row and return its index"""
+        i = bisect.bisect_left(self.__bounds, row)
+        if i < len(self.__bounds) and self.__bounds[i] == row:
+            return i
+        items = list(self.__bands[i - 1]) if i > 0 else []
+        self.__bounds.insert(i, row)
+        self.__bands.insert(i, items)
+        return i
+
+    def add(self, top, left, bottom, right, item):
+        """add an item covering rows top to bottom and columns left to right (inclusive)"""
+        if bottom < top or right < left:
+            return
+        start = self.__split(top)
+        end = self.__split(bottom + 1)
+        for band in self.__bands[start:end]:
+            band.append((left, right, item))
+
+    def find(self, top, left, bottom, right):
+        """return the items overlapping rows top to bottom and columns left to right (inclusive)"""
+        start = max(bisect.bisect_right(self.__bounds, top) - 1, 0)
+        end = bisect.bisect_right(self.__bounds, bottom)
+        seen = set()
+        items = []
+        for band in self.__bands[start:end]:
+            for l, r, item in band:
+                if l <= right and r >= left and id(item) not in seen:
+                    seen.add(id(item))
+                    items.append(item)
+        return items
+
+    def find_band(self, row):
+        """
+        return (band, items) for the band containing a row, where band is the first row
+        of the band (or None if the row is above all the items). Every row in a band
+        has the same items.
+        """
+        i = bisect.bisect_right(self.__bounds, row) - 1
+        if i < 0:
+            return None, []
+        return self.__bounds[i], [item for l, r, item in self.__bands[i]]
+
+
+class _StyleLayers(object):
+    """
+    Internal use - styles for the cells of a worksheet as an ordered list of styled
+    rectangles (layers), composed when the styles for a row are needed.
+
+    Each layer either replaces the style of the cells beneath it, or is
+    combined with it by going under or over it. A layer may have a list of
+    styles, in which case the style used alternates every row (e.g. stripes).
+
+    Rows with the same layers (and stripe phase) share the same composed styles,
+    so the work done depends on the number of distinct regions and not cells.
+    """
+    REPLACE = "replace"
+    UNDER = "under"
+    OVER = "over"
+
+    def __init__(self):
+        self.__index = _RectangleIndex()
+        self.__rows = {}
+        self.__bands = {}
+        self.__count = 0
+        self.height = 0
+        self.width = 0
+
+    def add(self, top, left, bottom, right, style, mode):
+        """add a style, or list of alternating styles, for the cells from (top, left) to (bottom, right)"""
+        if bottom < top or right < left:
+            return
+        styles = tuple(style) if isinstance(style, (list, tuple)) else (style,)
+        self.__index.add(top, left, bottom, right, (self.__count, top, left, right, styles, mode))
+        self.__count += 1
+        self.__rows.clear()
+        self.__bands.clear()
+        self.height = max(self.height, bottom + 1)
+        self.width = max(self.width, right + 1)
+
+    def get_row(self, row):
+        """return a tuple of the style (or None) of each cell in a row"""
+        band, layers = self.__index.find_band(row)
+        try:
+            layers = self.__bands[band]
+        except KeyError:
+            layers.sort(key=lambda x: x[0])
+            self.__bands[band] = layers
+        key = tuple((i, (row - top) % len(styles)) for i, top, left, right, styles, mode in layers)
+        try:
+            return self.__rows[key]
+        except KeyError:
+            pass
+
+        cells = [None] * self.width
+        for i, top, left, right, styles, mode in layers:
+            style = styles[(row - top) % len(styles)]
+            for c in range(left, right + 1):
+                current = cells[c]
+                if mode == self.REPLACE or current is None:
+                    cells[c] = style
+                elif mode == self.UNDER:
+                    cells[c] = style + current
+                else:
+                    cells[c] = current + style
+
+        cells = tuple(cells)
+        self.__rows[key] = cells
+        return cells
+
+    def get_style(self, row, col):
+        """return the style of a single cell, or None"""
+        cells = self.get_row(row)
+        return cells[col] if col < len(cells) else None
+
+
+def _is_table_styled(table, excel_tables, custom_table_styles):
+    """
+    return True if a table is written as an Excel table with its default styles coming
+    from its table style (see Worksheet._get_style_layers).
+    """
+    return (excel_tables
+            and table.is_excel_table
+            and (custom_table_styles or table.style.excel_table_style is not None))
+
+
+def _has_bg_color(style):
+    """return True if a style sets a background color"""
+    return getattr(style, "bg_color", None) is not None
+
+
+def _get_runs(first, last, excluded):
+    """
+    return a list of (first, last) for the runs of consecutive numbers from first to last,
+    not including those in excluded, or an empty list if excluded is None.
+    """
+    if excluded is None:
+        return []
+    runs = []
+    start = first
+    for x in sorted(excluded):
+        if x < first or x > last:
+            continue
+        if x > start:
+            runs.append((start, x - 1))
+        start = x + 1
+    if start <= last:
+        runs.append((start, last))
+    return runs
+
+
+def _iter_offsets(offset):
+    """return a sequence of offsets from the result of Table.get_column_offset or get_row_offset"""
+    return (offset,) if isinstance(offset, int) else offset
+
 
 def _to_bgr(rgb):
     """excel expects colors as BGR instead of the usual RGB"""
@@ -702,3 +1591,343 @@ def _to_excel_chart_type(type, subtype):
             "filled": constants.xlRadarFilled,
         },
     }[type][subtype]
+
+
+class _LazyTableChunk(object):
+    """
+    Internal use - a chunk of a LazyTable's data, which is written as if it were a table
+    of its own. Anything that isn't specific to the chunk is taken from the LazyTable.
+
+    :param xltable.LazyTable table: Table the chunk is from.
+    :param pandas.DataFrame dataframe: The chunk's data.
+    :param bool header: True if the table's header is written above the chunk's rows.
+    """
+    def __init__(self, table, dataframe, header):
+        self.table = table
+        self.dataframe = dataframe
+        self.header_height = table.header_height if header else 0
+        self.is_excel_table = header and table.is_excel_table
+
+    def __getattr__(self, name):
+        return getattr(self.table, name)
+
+
+class _ResolvedTable(object):
+    """
+    Internal use - a table's resolved data kept between incremental exports
+    (see Workbook.set_incremental).
+
+    :param xltable.Table table: Table the data was resolved from.
+    :param tuple state: Position, fingerprint and settings the table was resolved with.
+    :param list dependencies: List of (table, worksheet) for the tables the table
+                              refers to, or None if they aren't known.
+    :param tuple dependency_state: State of the dependencies (see Worksheet.__get_dependency_state).
+    :param data: Resolved 2d data array.
+    :param dict formula_values: Dictionary of {(row, col) -> value} for the table's formulas.
+    :param dict shared_formulas: Ranges of the table's shared formulas, or None.
+    """
+    def __init__(self, table, state, dependencies, dependency_state, data, formula_values, shared_formulas):
+        self.table = table
+        self.state = state
+        self.dependencies = dependencies
+        self.dependency_state = dependency_state
+        self.data = data
+        self.formula_values = formula_values
+        self.shared_formulas = shared_formulas
+
+
+class _PreparedWorksheet(object):
+    """
+    Data worked out for a worksheet ahead of writing it (see Worksheet._prepare).
+
+    :param dict data: Dictionary of {table number -> resolved data array}.
+    :param dict formula_values: Dictionary of {(row, col) -> value} for formulas.
+    :param _StyleLayers style_layers: Styles for the sheet.
+    :param dict column_widths: Dictionary of {col -> width}.
+    :param dict shared_formulas: Dictionary of {(first row, col) -> last row} for shared
+                                 formulas, or None if not writing shared formulas.
+    """
+    def __init__(self, data, formula_values, style_layers, column_widths, shared_formulas=None):
+        self.data = data
+        self.formula_values = formula_values
+        self.style_layers = style_layers
+        self.column_widths = column_widths
+        self.shared_formulas = shared_formulas
+
+
+# number of rows in an Excel worksheet
+_MAX_ROWS = 1048576
+
+# approximate number of rows passed to csv.writer.writerows at once
+_CSV_CHUNK_SIZE = 4096
+
+
+def _get_csv_block(blocks, row, height, width):
+    """
+    return `height` rows starting at `row` as a list of lists, copied from the tables'
+    data in blocks (a list of (table, top, left, data) in the order they should be written).
+    """
+    block = np.full((height, width), None, dtype=object)
+    for _table, top, left, data in blocks:
+        block[:, left:left + data.shape[1]] = data[row - top:row - top + height]
+    return block.tolist()
+
+
+def _is_formula(value):
+    """return True if value is a formula or array formula string"""
+    return type(value) is str and value.startswith(("=", "{="))
+
+
+_is_formula_array = np.frompyfunc(_is_formula, 1, 1)
+
+
+def _is_nan(value):
+    """return True if value is NaN, inf or NaT"""
+    return (isinstance(value, float) and not np.isfinite(value)) or value is pa.NaT
+
+
+_is_nan_array = np.frompyfunc(_is_nan, 1, 1)
+
+
+def _get_csv_data(table, top, left, data, formula_values=None):
+    """
+    return a table's data as it's written to a csv file, with NaN, inf and NaT values
+    as empty strings and, if formula_values is set, any formulas replaced by their values
+    from formula_values, or None if there's no value. Only the header, index and body
+    columns that can contain formulas or NaNs (see _get_column_kinds) are checked.
+    """
+    if data.size == 0:
+        return data
+    kinds, nan_mask = _get_column_kinds(table, data)
+    header_height = table.header_height
+    row_labels_width = table.row_labels_width
+    object_cols = list(range(row_labels_width))
+    object_cols.extend(row_labels_width + j for j, kind in enumerate(kinds) if kind == _OBJECT)
+
+    is_nan = np.zeros(data.shape, dtype=bool)
+    is_nan[header_height:, row_labels_width:] = nan_mask
+    is_nan[:header_height] = _is_nan_array(data[:header_height]).astype(bool)
+    if object_cols:
+        is_nan[:, object_cols] |= _is_nan_array(data[:, object_cols]).astype(bool)
+
+    is_formula = None
+    if formula_values is not None:
+        cols = object_cols + [row_labels_width + j for j, kind in enumerate(kinds) if kind == _FORMULA]
+        is_formula = np.zeros(data.shape, dtype=bool)
+        is_formula[:header_height] = _is_formula_array(data[:header_height]).astype(bool)
+        if cols:
+            is_formula[:, cols] = _is_formula_array(data[:, cols]).astype(bool)
+        if not is_formula.any():
+            is_formula = None
+
+    if is_formula is None and not is_nan.any():
+        return data
+
+    data = data.copy()
+    data[is_nan] = ""
+    if is_formula is not None:
+        for r, c in zip(*np.nonzero(is_formula)):
+            value = formula_values.get((top + r, left + c))
+            data[r, c] = "" if _is_nan(value) else value
+    return data
+
+
+# ways NaN, inf and NaT values can be written to xlsx files
+_nan_policies = ("blank", "#N/A", "zero")
+
+
+def _write_xlsx_nan(ws, row, col, style, nan_policy):
+    """write a NaN, inf or NaT value to an xlsxwriter worksheet according to the nan policy"""
+    if nan_policy == "blank":
+        ws.write_blank(row, col, None, style)
+    elif nan_policy == "#N/A":
+        ws.write_formula(row, col, "=NA()", style, "#N/A")
+    elif nan_policy == "zero":
+        ws.write_number(row, col, 0, style)
+    else:
+        raise AssertionError("Unknown nan policy '%s'." % nan_policy)
+
+
+# strings xlsxwriter's generic write method would write as urls
+_url_re = re.compile("(ftp|http)s?://|mailto:|(in|ex)ternal:|file://")
+
+# kinds of table columns, used to pick how each column is written
+_NUMBER = "number"
+_BOOL = "bool"
+_DATETIME = "datetime"
+_STRING = "string"
+_FORMULA = "formula"
+_OBJECT = "object"
+
+
+def _get_column_kinds(table, data, strings_to_urls=False, strings_to_numbers=False):
+    """
+    Classify each column of a table's body once from its dtype (or its values
+    for object columns) so that the cells can be written without checking
+    the type of each one.
+
+    :param xltable.Table table: Table the data is from.
+    :param data: 2d object array from Table.get_data.
+    :param bool strings_to_urls: True if strings that look like urls are written as urls.
+    :param bool strings_to_numbers: True if strings that look like numbers are written as numbers.
+    :return: (kinds, nan_mask) where kinds is a list of the kind of each column in the body
+             and nan_mask is a 2d bool array that is True for cells in number and datetime
+             columns that are NaN, inf or NaT.
+    """
+    body = data[table.header_height:, table.row_labels_width:]
+    dtypes = list(table.dataframe.dtypes) + [None] * len(table.formula_columns)
+    kinds = [_get_column_kind(dtype, body[:, j], strings_to_urls, strings_to_numbers)
+             for j, dtype in enumerate(dtypes)]
+
+    nan_mask = np.zeros(body.shape, dtype=bool)
+    for j, kind in enumerate(kinds):
+        if kind == _NUMBER:
+            nan_mask[:, j] = ~np.isfinite(body[:, j].astype(float))
+        elif kind == _DATETIME:
+            nan_mask[:, j] = pa.isnull(body[:, j])
+
+    return kinds, nan_mask
+
+
+def _get_column_kind(dtype, values, strings_to_urls, strings_to_numbers):
+    """return the kind of a column from its dtype and values"""
+    kind = dtype.kind if isinstance(dtype, np.dtype) else "O"
+    if kind in "iuf":
+        return _NUMBER
+    if kind == "b":
+        return _BOOL
+    if kind in "mM":
+        return _DATETIME
+    if kind != "O" or len(values) == 0:
+        return _OBJECT
+
+    # object columns can be written as strings or formulas if all their values are strings
+    is_str = np.fromiter((type(x) is str for x in values), dtype=bool, count=len(values))
+    if not is_str.all():
+        return _OBJECT
+    str_values = values.astype(str)
+    is_formula = np.char.startswith(str_values, "=")
+    if is_formula.all():
+        return _FORMULA
+    if is_formula.any() \
+            or np.char.startswith(str_values, "{=").any() \
+            or (str_values == "").any() \
+            or strings_to_numbers:
+        return _OBJECT
+    if strings_to_urls:
+        maybe_urls = str_values[np.char.find(str_values, ":") >= 0]
+        if any(_url_re.match(x) for x in maybe_urls):
+            return _OBJECT
+    return _STRING
+
+
+class _XlsxTableWriter(object):
+    """
+    Writes the rows of a table's resolved data to an xlsxwriter worksheet.
+
+    Each column of the table body is classified once (see _get_column_kinds)
+    so that each cell can be written using the xlsxwriter method for its type,
+    instead of checking the type of every cell. Cells with NaN, inf or NaT
+    values are found up front and written according to the nan policy.
+    Headers, the index and any columns with mixed types are written cell
+    by cell using Worksheet._write_xlsx_cell.
+
+    :param xltable.Worksheet worksheet: Worksheet the table is on.
+    :param ws: xlsxwriter worksheet to write to.
+    :param xltable.Table table: Table being written.
+    :param int top: Row the table starts on.
+    :param int left: Column the table starts on.
+    :param data: 2d object array from Table.get_data.
+    :param dict formula_values: Dictionary of {(row, col) -> value} for formulas.
+    :param str nan_policy: How to write NaN values ("blank", "#N/A" or "zero").
+    """
+    def __init__(self, worksheet, ws, table, top, left, data, formula_values, nan_policy):
+        assert nan_policy in _nan_policies, "Unknown nan policy '%s'." % nan_policy
+        self.__worksheet = worksheet
+        self.__ws = ws
+        self.__top = top
+        self.__left = left
+        self.__data = data
+        self.__formula_values = formula_values
+        self.__nan_policy = nan_policy
+        self.__header_height = table.header_height
+        self.__row_labels_width = table.row_labels_width
+
+        self.__kinds, self.__nan_mask = _get_column_kinds(table,
+                                                          data,
+                                                          strings_to_urls=ws.strings_to_urls,
+                                                          strings_to_numbers=ws.strings_to_numbers)
+        self.__nan_rows = self.__nan_mask.any(axis=1)
+
+        self.__is_numeric = all(kind == _NUMBER for kind in self.__kinds)
+        self.__writers = [self._get_writer(kind) for kind in self.__kinds]
+
+    @property
+    def kinds(self):
+        """list of the kinds of each column in the table body"""
+        return list(self.__kinds)
+
+    def _get_writer(self, kind):
+        """return a function (row, col, value, style) for writing cells of a kind"""
+        ws = self.__ws
+        if kind == _NUMBER:
+            return ws.write_number
+        if kind == _BOOL:
+            return ws.write_boolean
+        if kind == _DATETIME:
+            return ws.write_datetime
+        if kind == _STRING:
+            return ws.write_string
+        if kind == _FORMULA:
+            formula_values = self.__formula_values
+            def write_formula(row, col, value, style):
+                ws.write_formula(row, col, value, style, value=formula_values.get((row, col), 0))
+            return write_formula
+
+        worksheet = self.__worksheet
+        nan_policy = self.__nan_policy
+        def write_object(row, col, value, style):
+            worksheet._write_xlsx_cell(ws, row, col, value, style, nan_policy)
+        return write_object
+
+    def write_row(self, row, row_styles):
+        """
+        Write a row of the table to the worksheet.
+
+        :param int row: Worksheet row to write.
+        :param list row_styles: xlsxwriter formats for each column on the row.
+        """
+        ws = self.__ws
+        i = row - self.__top
+        values = self.__data[i].tolist()
+        left = self.__left
+        styles = row_styles[left:left + len(values)]
+
+        # headers and the index are written cell by cell
+        body_left = self.__row_labels_width if i >= self.__header_height else len(values)
+        for j in range(body_left):
+            self.__worksheet._write_xlsx_cell(ws, row, left + j, values[j], styles[j], self.__nan_policy)
+        if i < self.__header_height:
+            return
+
+        b = i - self.__header_height
+        cols = range(left + body_left, left + len(values))
+        body_values = values[body_left:]
+        body_styles = styles[body_left:]
+
+        if not self.__nan_rows[b]:
+            if self.__is_numeric:
+                write_number = ws.write_number
+                for col, value, style in zip(cols, body_values, body_styles):
+                    write_number(row, col, value, style)
+            else:
+                for write, col, value, style in zip(self.__writers, cols, body_values, body_styles):
+                    write(row, col, value, style)
+            return
+
+        nan_mask = self.__nan_mask[b]
+        for write, is_nan, col, value, style in zip(self.__writers, nan_mask, cols, body_values, body_styles):
+            if is_nan:
+                _write_xlsx_nan(ws, row, col, style, self.__nan_policy)
+            else:
+                write(row, col, value, style)